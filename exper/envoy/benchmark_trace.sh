@@ -10,6 +10,38 @@ CONNECTIONS=$4
 RPS=$5
 DURATION=$6
 
+# copy the trace of every pod back, envoy_trace.py -f binary writes .bin instead of .log
+# rotated segments (trace_output.1.log, ...) and --compress (.zst) files are copied under the same pod prefix
+copy_pod_traces() {
+    local namespace=$1
+    local pod=$2
+    shift 2
+    local files=$(kubectl exec -n "$namespace" "$pod" "$@" -- sh -c 'ls /tmp/trace_output.* 2>/dev/null')
+    for file in $files; do
+        local suffix=${file#/tmp/trace_output}
+        kubectl cp "$namespace/$pod:$file" "$@" ~/trace_res/trace_output_"$pod""$suffix" 2>/dev/null
+    done
+}
+
+collect_traces() {
+    # tracers started with --collector already streamed everything to trace_collector.py
+    if [ -n "$COLLECTOR" ]; then
+        echo "Traces were streamed to $COLLECTOR, nothing to copy."
+        return
+    fi
+    if [ "$MESH_TYPE" == "cilium" ]; then
+        PODS=$(kubectl get pods -n kube-system -o jsonpath='{.items[*].metadata.name}')
+        for pod in $PODS; do
+            copy_pod_traces kube-system "$pod"
+        done
+    elif [ "$MESH_TYPE" == "istio" ]; then
+        PODS=$(kubectl get pods -n $NAMESPACE -o jsonpath='{.items[*].metadata.name}')
+        for pod in $PODS; do
+            copy_pod_traces "$NAMESPACE" "$pod" -c istio-proxy
+        done
+    fi
+}
+
 trace_bookinfo() {
     NAMESPACE="bookinfo"
     local ip=$(kubectl get service productpage -n "$NAMESPACE" -o jsonpath='{.spec.clusterIP}')
@@ -23,18 +55,7 @@ trace_bookinfo() {
 
     wait
 
-    if [ "$MESH_TYPE" == "cilium" ]; then
-        PODS=$(kubectl get pods -n kube-system -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "kube-system/$pod:/tmp/trace_output.log" ~/trace_res/trace_output_"$pod".log
-        done
-    else if [ "$MESH_TYPE" == "istio" ]; then
-        PODS=$(kubectl get pods -n $NAMESPACE -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "$NAMESPACE/$pod:/tmp/trace_output.log" -c istio-proxy ~/trace_res/trace_output_"$pod".log
-        done
-    fi
-    fi
+    collect_traces
 
     echo "Experiment completed."
 }
@@ -52,18 +73,7 @@ trace_hotel() {
 
     wait
 
-    if [ "$MESH_TYPE" == "cilium" ]; then
-        PODS=$(kubectl get pods -n kube-system -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "kube-system/$pod:/tmp/trace_output.log" ~/trace_res/trace_output_"$pod".log
-        done
-    else if [ "$MESH_TYPE" == "istio" ]; then
-        PODS=$(kubectl get pods -n $NAMESPACE -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "$NAMESPACE/$pod:/tmp/trace_output.log" -c istio-proxy ~/trace_res/trace_output_"$pod".log
-        done
-    fi
-    fi
+    collect_traces
 
     wait
 
@@ -83,18 +93,7 @@ trace_social() {
 
     wait
 
-    if [ "$MESH_TYPE" == "cilium" ]; then
-        PODS=$(kubectl get pods -n kube-system -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "kube-system/$pod:/tmp/trace_output.log" ~/trace_res/trace_output_"$pod".log
-        done
-    else if [ "$MESH_TYPE" == "istio" ]; then
-        PODS=$(kubectl get pods -n $NAMESPACE -o jsonpath='{.items[*].metadata.name}')
-        for pod in $PODS; do
-            kubectl cp "$NAMESPACE/$pod:/tmp/trace_output.log" -c istio-proxy ~/trace_res/trace_output_"$pod".log
-        done
-    fi
-    fi
+    collect_traces
 
     wait
 
@@ -6,18 +6,13 @@ import argparse
 import os
 import matplotlib.pyplot as plt
 
-def analyze_raw_http_parse(file_path):
+from exper.graph_gen.trace_loader import iter_files
+
+def read_elapsed_times(file_path):
     '''
-    analyze results look like '[parse-end] connection_id: 15, elapsed_time: 24694'
+    extract elapsed times from lines look like '[parse-end] connection_id: 15, elapsed_time: 24694'
     '''
-
-    # extract pod name from file path
-    # for example trace_output_details-v1-6768f6584f-w9xx5.log, I need to extract details-v1-6768f6584f-w9xx5
-    podname = file_path.split('trace_output')[-1].split('.')[0]
-
-    output_file = "output.log"
     elapsed_times = []
-    values = ...
     if not os.path.exists(file_path):
         raise FileNotFoundError(f'File not found: {file_path}')
     with open(file_path, 'r') as f:
@@ -26,8 +21,21 @@ def analyze_raw_http_parse(file_path):
             if match:
                 if int(match.group(1)) < 6300000:
                     elapsed_times.append(int(match.group(1)))
-        
-        values = np.array(elapsed_times)
+
+    return np.array(elapsed_times)
+
+def analyze_raw_http_parse(file_path, values=None):
+    '''
+    analyze results look like '[parse-end] connection_id: 15, elapsed_time: 24694'
+    '''
+
+    # extract pod name from file path
+    # for example trace_output_details-v1-6768f6584f-w9xx5.log, I need to extract details-v1-6768f6584f-w9xx5
+    podname = file_path.split('trace_output')[-1].split('.')[0]
+
+    output_file = "output.log"
+    if values is None:
+        values = read_elapsed_times(file_path)
     
     avg = np.mean(values)
     p50 = np.percentile(values, 50)
@@ -69,9 +77,9 @@ if __name__ == '__main__':
     if args.type == 'raw_http' and args.file_path:
         analyze_raw_http_parse(args.file_path)
     elif args.type == 'raw_http' and args.dir_name:
-        for file in os.listdir(args.dir_name):
-            if file.endswith('.log'):
-                file_path = os.path.join(args.dir_name, file)
-                analyze_raw_http_parse(file_path)
+        # parse all files in parallel, then summarize and plot them one by one
+        file_paths = [os.path.join(args.dir_name, file) for file in os.listdir(args.dir_name) if file.endswith('.log')]
+        for file_path, values in iter_files(file_paths, read_elapsed_times):
+            analyze_raw_http_parse(file_path, values)
     else:
         raise ValueError(f'Unknown type: {args.type}')
\ No newline at end of file
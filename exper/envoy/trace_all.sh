@@ -6,6 +6,8 @@ PODS=
 
 MESH_TYPE=$1
 NAMESPACE=$2
+# everything after the namespace is passed to envoy_trace.py, e.g. --sample 10
+TRACE_ARGS=("${@:3}")
 if [ "$MESH_TYPE" == "cilium" ]; then
   NAMESPACE="kube-system"
   PODS=$(kubectl get pods -n "$NAMESPACE" -o jsonpath='{.items[*].metadata.name}' \
@@ -18,13 +20,42 @@ else
 fi
 
 
+SCRIPTS="envoy_trace.py http_uprobe.py trace_record.py calibrate.py symbol_cache.py bpf_cache.py trace_writer.py trace_sender.py"
+if [ "$MESH_TYPE" == "cilium" ]; then
+  CONTAINER=()
+  PYTHON="python3"
+  BINARY="/usr/bin/cilium-envoy"
+else
+  CONTAINER=(-c istio-proxy)
+  PYTHON="sudo python3"
+  BINARY="/usr/local/bin/envoy"
+fi
+
+copy_scripts() {
+  local pod=$1
+  for script in $SCRIPTS; do
+    kubectl cp "./uprobe_script/$script" "$NAMESPACE/$pod:/tmp/$script" "${CONTAINER[@]}"
+  done
+  if [ -f ./uprobe_script/symbol_cache.json ]; then
+    kubectl cp ./uprobe_script/symbol_cache.json "$NAMESPACE/$pod:/tmp/symbol_cache.json" "${CONTAINER[@]}"
+  fi
+  if [ -d ./uprobe_script/bpf_cache ]; then
+    kubectl cp ./uprobe_script/bpf_cache "$NAMESPACE/$pod:/tmp/bpf_cache" "${CONTAINER[@]}"
+  fi
+}
+
+# resolve the hook symbols once on the first pod, every other pod attaches from the cached addresses
+FIRST_POD=$(echo $PODS | awk '{print $1}')
+copy_scripts "$FIRST_POD"
+kubectl exec -i -n "$NAMESPACE" "$FIRST_POD" "${CONTAINER[@]}" -- $PYTHON /tmp/symbol_cache.py -b "$BINARY"
+kubectl cp "$NAMESPACE/$FIRST_POD:/tmp/symbol_cache.json" ./uprobe_script/symbol_cache.json "${CONTAINER[@]}"
+# same for the compiled program, only the first pod runs clang
+kubectl exec -i -n "$NAMESPACE" "$FIRST_POD" "${CONTAINER[@]}" -- $PYTHON /tmp/envoy_trace.py -t "$MESH_TYPE" "${TRACE_ARGS[@]}" --compile-only
+kubectl cp "$NAMESPACE/$FIRST_POD:/tmp/bpf_cache" ./uprobe_script/bpf_cache "${CONTAINER[@]}"
+
 for pod in $PODS; do
-  if [ "$MESH_TYPE" == "cilium" ]; then
-      kubectl cp ./uprobe_script/envoy_trace.py "$NAMESPACE/$pod:/tmp/envoy_trace.py"
-      kubectl cp ./uprobe_script/http_uprobe.py "$NAMESPACE/$pod:/tmp/http_uprobe.py"
-  else
-      kubectl cp ./uprobe_script/envoy_trace.py "$NAMESPACE/$pod:/tmp/envoy_trace.py" -c istio-proxy
-      kubectl cp ./uprobe_script/http_uprobe.py "$NAMESPACE/$pod:/tmp/http_uprobe.py" -c istio-proxy
+  if [ "$pod" != "$FIRST_POD" ]; then
+      copy_scripts "$pod" &
   fi
 done
 
@@ -34,9 +65,9 @@ wait
 for pod in $PODS; do
   echo "Running trace on pod: $pod"
   if [ "$MESH_TYPE" == "cilium" ]; then
-      kubectl exec -i -n "$NAMESPACE" "$pod" -- python3 /tmp/envoy_trace.py -t cilium &
+      kubectl exec -i -n "$NAMESPACE" "$pod" -- python3 /tmp/envoy_trace.py -t cilium "${TRACE_ARGS[@]}" &
   else
-      kubectl exec -i -n "$NAMESPACE" "$pod" -c istio-proxy -- sudo python3 /tmp/envoy_trace.py -t istio&
+      kubectl exec -i -n "$NAMESPACE" "$pod" -c istio-proxy -- sudo python3 /tmp/envoy_trace.py -t istio "${TRACE_ARGS[@]}" &
   fi
 done
 
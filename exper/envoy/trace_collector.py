@@ -0,0 +1,207 @@
+# receive binary records streamed by envoy_trace.py --collector and write one shard per pod
+
+import os
+import io
+import time
+import argparse
+import tempfile
+import threading
+import socketserver
+import numpy as np
+
+from exper.envoy.uprobe_script.trace_record import RECORD_DTYPE, read_header, read_records, write_header
+from exper.envoy.uprobe_script.trace_sender import (TraceSender, read_frame, DEFAULT_PORT,
+                                                    FRAME_HELLO, FRAME_RECORDS)
+from exper.envoy.uprobe_script.trace_writer import RotatingWriter
+
+REPORT_INTERVAL = 10.0
+REPORT_PERCENTILES = [50, 90, 99]
+
+class Collector:
+    '''
+    shards are trace_output_<pod>.bin in the output directory, the names benchmark_trace.sh copies back
+    records received since the last report are kept for the live summary
+    '''
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.recent = {}
+        self.totals = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def shard_path(self, pod):
+        return os.path.join(self.output_dir, f"trace_output_{pod}.bin")
+
+    def write(self, pod, header, dtype, payload):
+        records = np.frombuffer(payload, dtype=dtype)
+        with self.lock:
+            shard = self.shards.get(pod)
+            if shard is None:
+                shard = self.shards[pod] = RotatingWriter(self.shard_path(pod), header)
+            elif shard.header != header:
+                print(f"[!] {pod} sent records of another layout than its shard, dropping {len(records)} records")
+                return
+            shard.write(payload)
+            self.recent.setdefault(pod, []).append(records)
+            self.totals[pod] = self.totals.get(pod, 0) + len(records)
+
+    def flush(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.flush()
+
+    def close(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards = {}
+
+    def take_recent(self):
+        with self.lock:
+            recent, self.recent = self.recent, {}
+        return {pod: np.concatenate(batches) for pod, batches in recent.items()}
+
+    def report(self, interval):
+        '''
+        print records/s and end-to-end latency percentiles of every pod since the last report
+        '''
+        recent = self.take_recent()
+        if not recent:
+            print("[*] No records in the last interval")
+            return
+        print(f"    {'Pod':<50}{'Records/s':>12}" + "".join(f"{'p' + str(p):>12}" for p in REPORT_PERCENTILES) + f"{'Total':>12}")
+        for pod, records in sorted(recent.items()):
+            start = records["time_http_start"].astype(np.int64)
+            end = records["time_end"].astype(np.int64)
+            valid = (start != 0) & (end != 0) & (end >= start)
+            elapsed = end[valid] - start[valid]
+            line = f"    {pod:<50}{len(records) / interval:>12.1f}"
+            if elapsed.size:
+                line += "".join(f"{v / 1e6:>9.3f} ms" for v in np.percentile(elapsed, REPORT_PERCENTILES))
+            else:
+                line += "".join(f"{'-':>12}" for _ in REPORT_PERCENTILES)
+            print(line + f"{self.totals[pod]:>12}")
+
+class TraceHandler(socketserver.BaseRequestHandler):
+    # one connection per tracer, it starts with the record layout and then sends batches of one pod each
+    def handle(self):
+        collector = self.server.collector
+        peer = f"{self.client_address[0]}:{self.client_address[1]}"
+        header = dtype = None
+        try:
+            while True:
+                frame_type, pod, payload = read_frame(self.request)
+                if frame_type == FRAME_HELLO:
+                    header = payload
+                    dtype, _ = read_header(io.BytesIO(header))
+                elif frame_type == FRAME_RECORDS:
+                    if dtype is None:
+                        print(f"[!] {peer} sent records before its header, closing")
+                        return
+                    collector.write(pod, header, dtype, payload)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"[!] Connection from {peer} failed: {e}")
+
+class CollectorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, collector):
+        super().__init__(address, TraceHandler)
+        self.collector = collector
+
+def serve(collector, host, port, interval=REPORT_INTERVAL, duration=None):
+    '''
+    accept tracers until Ctrl+C (or duration seconds), flushing every shard and printing a live summary every interval
+    '''
+    server = CollectorServer((host, port), collector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[*] Collecting traces on {host}:{server.server_address[1]} into {collector.output_dir}")
+
+    deadline = time.monotonic() + duration if duration else float("inf")
+    last_report = time.monotonic()
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            collector.flush()
+            now = time.monotonic()
+            collector.report(now - last_report)
+            last_report = now
+    except KeyboardInterrupt:
+        pass
+
+    server.shutdown()
+    server.server_close()
+    collector.close()
+    total = sum(collector.totals.values())
+    print(f"[*] Collected {total} records of {len(collector.totals)} pods in {collector.output_dir}")
+
+def run_loopback(output_dir, pods=2, batches=20, batch_records=1000):
+    '''
+    send synthetic records of a few pods through a collector on 127.0.0.1 and check the shards read back
+    shards of an earlier loopback run in output_dir are removed first, the collector would append to them
+    '''
+    collector = Collector(output_dir)
+    for i in range(pods):
+        path = collector.shard_path(f"loopback-{i}")
+        if os.path.exists(path):
+            os.remove(path)
+    server = CollectorServer(("127.0.0.1", 0), collector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{server.server_address[1]}"
+
+    header = io.BytesIO()
+    write_header(header)
+    rng = np.random.default_rng(0)
+    expected = {}
+    for i in range(pods):
+        pod = f"loopback-{i}"
+        sender = TraceSender(address, header.getvalue())
+        for _ in range(batches):
+            records = np.zeros(batch_records, dtype=RECORD_DTYPE)
+            records["time_http_start"] = rng.integers(1, 1 << 40, batch_records)
+            records["time_end"] = records["time_http_start"] + rng.integers(100000, 5000000, batch_records)
+            sender.send(pod, records)
+        sender.close()
+        expected[pod] = batches * batch_records
+
+    # the handlers finish once they see the closed connections
+    deadline = time.monotonic() + 10
+    while collector.totals != expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    server.shutdown()
+    server.server_close()
+    collector.report(1.0)
+    collector.close()
+
+    for pod, count in expected.items():
+        shard_records = len(read_records(collector.shard_path(pod)))
+        status = "ok" if shard_records == count else "MISMATCH"
+        print(f"[*] {pod}: sent {count}, shard has {shard_records} records ({status})")
+        if shard_records != count:
+            raise RuntimeError(f"Loopback shard of {pod} is incomplete")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect trace records streamed by envoy_trace.py --collector")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Directory of the per-pod shards trace_output_<pod>.bin, ~/trace_res by default "
+                             "and a temporary directory for --loopback")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("-i", "--interval", type=float, default=REPORT_INTERVAL, help="Seconds between two live summaries")
+    parser.add_argument("-d", "--duration", type=float, help="Stop after this many seconds instead of waiting for Ctrl+C")
+    parser.add_argument("--loopback", action="store_true",
+                        help="Send synthetic records through a collector on 127.0.0.1 and check the shards, no tracer needed")
+    args = parser.parse_args()
+
+    if args.loopback and not args.output:
+        # keep the synthetic shards out of the real trace directory
+        with tempfile.TemporaryDirectory() as output_dir:
+            run_loopback(output_dir)
+    elif args.loopback:
+        run_loopback(args.output)
+    else:
+        serve(Collector(args.output or os.path.expanduser("~/trace_res")), args.host, args.port, args.interval, args.duration)
@@ -0,0 +1,271 @@
+# compile HttpUprobe.program once per (program, kernel, cflags) and load the cached bytecode on later runs
+
+from bcc import BPF, lib
+from bcc.table import HashTable, LruHash, Array, PerfEventArray, RingBuf
+from bcc.utils import get_possible_cpus
+import bcc
+
+import atexit
+import base64
+import ctypes
+import hashlib
+import json
+import os
+import struct
+
+BPF_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bpf_cache")
+CACHE_VERSION = 2
+
+BPF_PROG_TYPE_KPROBE = 2    # uprobes are loaded as kprobe programs
+BPF_PROG_TYPE_TRACEPOINT = 5
+BPF_MAP_TYPE_PERF_EVENT_ARRAY = 4
+
+# map type -> bcc table class, only the types http_uprobe.py declares
+TABLE_CLASSES = {1: HashTable, 2: Array, 4: PerfEventArray, 9: LruHash, 27: RingBuf}
+
+INSN = struct.Struct("<BBhi")
+BPF_LD_IMM64 = 0x18
+BPF_PSEUDO_MAP_FD = 1
+
+def declare_lib():
+    # libbcc entry points, declared here so they do not depend on what bcc.libbcc declares
+    lib.bpf_num_tables.restype = ctypes.c_ulonglong
+    lib.bpf_num_tables.argtypes = [ctypes.c_void_p]
+    lib.bpf_table_name.restype = ctypes.c_char_p
+    lib.bpf_table_name.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_fd_id.restype = ctypes.c_int
+    lib.bpf_table_fd_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_type_id.restype = ctypes.c_int
+    lib.bpf_table_type_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_max_entries_id.restype = ctypes.c_ulonglong
+    lib.bpf_table_max_entries_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_flags_id.restype = ctypes.c_int
+    lib.bpf_table_flags_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_key_desc_id.restype = ctypes.c_char_p
+    lib.bpf_table_key_desc_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_leaf_desc_id.restype = ctypes.c_char_p
+    lib.bpf_table_leaf_desc_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_key_size_id.restype = ctypes.c_size_t
+    lib.bpf_table_key_size_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_table_leaf_size_id.restype = ctypes.c_size_t
+    lib.bpf_table_leaf_size_id.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+    lib.bpf_module_license.restype = ctypes.c_char_p
+    lib.bpf_module_license.argtypes = [ctypes.c_void_p]
+    lib.bpf_module_kern_version.restype = ctypes.c_uint
+    lib.bpf_module_kern_version.argtypes = [ctypes.c_void_p]
+    lib.bcc_create_map.restype = ctypes.c_int
+    lib.bcc_create_map.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.bcc_prog_load.restype = ctypes.c_int
+    lib.bcc_prog_load.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_uint, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+
+def cache_key(program, cflags):
+    # the bytecode depends on the source, the config flags, the kernel headers and build, and the bcc rewriter
+    h = hashlib.sha256()
+    for part in [program, " ".join(cflags), os.uname().release, os.uname().version,
+                 getattr(bcc, "__version__", "unknown"), str(CACHE_VERSION)]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+def get_cache_path(program, cflags, cache_dir=BPF_CACHE_DIR):
+    return os.path.join(cache_dir, f"{cache_key(program, cflags)}.json")
+
+def describe_attrs(obj):
+    '''
+    {attribute: kind} of a bcc object, kind is an empty container, a plain value or an object which cannot be rebuilt
+    '''
+    attrs = {}
+    for attr, value in vars(obj).items():
+        if type(value) in (dict, list, set):
+            attrs[attr] = [type(value).__name__]
+        elif value is None or type(value) in (bool, str) or value == 0:
+            attrs[attr] = ["value", value]
+        else:
+            attrs[attr] = ["object", type(value).__name__]
+    return attrs
+
+def fill_attrs(target, attrs):
+    # set the attributes target lacks to their empty value, return the ones that cannot be
+    missing = []
+    for attr, kind in attrs.items():
+        if attr in vars(target):
+            continue
+        if kind[0] in ("dict", "list", "set"):
+            setattr(target, attr, {"dict": dict, "list": list, "set": set}[kind[0]]())
+        elif kind[0] == "value":
+            setattr(target, attr, kind[1])
+        else:
+            missing.append(f"{attr} ({kind[1]})")
+    return missing
+
+def save_object(b, fn_names, path, prog_types=None):
+    '''
+    write the maps and the bytecode of fn_names of a compiled BPF module, map fds are replaced by map names
+    prog_types: {fn_name: program type} of the functions which are not uprobes
+    '''
+    maps = []
+    fd_to_name = {}
+    for i in range(lib.bpf_num_tables(b.module)):
+        name = lib.bpf_table_name(b.module, i).decode()
+        fd_to_name[lib.bpf_table_fd_id(b.module, i)] = name
+        maps.append({
+            "name": name,
+            "type": lib.bpf_table_type_id(b.module, i),
+            "key_size": lib.bpf_table_key_size_id(b.module, i),
+            "leaf_size": lib.bpf_table_leaf_size_id(b.module, i),
+            "max_entries": lib.bpf_table_max_entries_id(b.module, i),
+            "flags": lib.bpf_table_flags_id(b.module, i),
+            "key_desc": lib.bpf_table_key_desc_id(b.module, i).decode(),
+            "leaf_desc": lib.bpf_table_leaf_desc_id(b.module, i).decode(),
+        })
+
+    funcs = {}
+    for fn_name in fn_names:
+        insns = bytearray(b.dump_func(fn_name))
+        relocs = []
+        for index in range(len(insns) // INSN.size):
+            code, regs, off, imm = INSN.unpack_from(insns, index * INSN.size)
+            if code == BPF_LD_IMM64 and regs >> 4 == BPF_PSEUDO_MAP_FD:
+                relocs.append([index, fd_to_name[imm]])
+                INSN.pack_into(insns, index * INSN.size, code, regs, off, 0)
+        funcs[fn_name] = {"insns": base64.b64encode(bytes(insns)).decode(), "relocs": relocs,
+                          "prog_type": (prog_types or {}).get(fn_name, BPF_PROG_TYPE_KPROBE)}
+
+    obj = {
+        "version": CACHE_VERSION,
+        # what this bcc sets up in a compiled object, CachedBPF checks it builds the same attributes by hand
+        "bpf_attrs": describe_attrs(b),
+        "table_attrs": {spec["name"]: describe_attrs(b[spec["name"]]) for spec in maps},
+        "license": lib.bpf_module_license(b.module).decode(),
+        "kern_version": lib.bpf_module_kern_version(b.module),
+        "maps": maps,
+        "funcs": funcs,
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+class CachedBPF(BPF):
+    '''
+    BPF object whose maps and programs come from a cached object instead of clang
+    there is no bpf module, so every table and function is created up front
+    '''
+    def __init__(self, obj):
+        if obj.get("version") != CACHE_VERSION:
+            raise ValueError(f"cache version {obj.get('version')} instead of {CACHE_VERSION}")
+        # the bookkeeping BPF.__init__ sets up before it compiles
+        self.kprobe_fds = {}
+        self.uprobe_fds = {}
+        self.tracepoint_fds = {}
+        self.raw_tracepoint_fds = {}
+        self.kfunc_entry_fds = {}
+        self.kfunc_exit_fds = {}
+        self.lsm_fds = {}
+        self.perf_buffers = {}
+        self.open_perf_events = {}
+        self._ringbuf_manager = None
+        self.tracefile = None
+        self.debug = 0
+        self.module = None
+        self.funcs = {}
+        self.tables = {}
+        map_fds = {}
+        try:
+            self.load(obj, map_fds)
+            self.check_attrs(obj)
+        except Exception:
+            # close what was created so far, the caller compiles the program instead
+            for fd in map_fds.values():
+                os.close(fd)
+            for func in self.funcs.values():
+                os.close(func.fd)
+            raise
+        atexit.register(self.cleanup)
+
+    def load(self, obj, map_fds):
+        for map_id, spec in enumerate(obj["maps"]):
+            max_entries = spec["max_entries"]
+            if spec["type"] == BPF_MAP_TYPE_PERF_EVENT_ARRAY:
+                # one slot per cpu of this node, not of the node the object was compiled on
+                max_entries = max(get_possible_cpus()) + 1
+            fd = lib.bcc_create_map(spec["type"], spec["name"].encode(), spec["key_size"], spec["leaf_size"], max_entries, spec["flags"])
+            if fd < 0:
+                raise OSError(-fd, f"Failed to create map {spec['name']}")
+            map_fds[spec["name"]] = fd
+            table = self._make_table(map_id, fd, spec, max_entries)
+            self.tables[spec["name"]] = table
+            self.tables[spec["name"].encode()] = table
+
+        for fn_name, func in obj["funcs"].items():
+            insns = bytearray(base64.b64decode(func["insns"]))
+            for index, map_name in func["relocs"]:
+                code, regs, off, _ = INSN.unpack_from(insns, index * INSN.size)
+                INSN.pack_into(insns, index * INSN.size, code, regs, off, map_fds[map_name])
+            buffer = (ctypes.c_char * len(insns)).from_buffer(insns)
+            log_buf = ctypes.create_string_buffer(65536)
+            fd = lib.bcc_prog_load(func.get("prog_type", BPF_PROG_TYPE_KPROBE), fn_name.encode(), ctypes.addressof(buffer), len(insns),
+                                   obj["license"].encode(), obj["kern_version"], 0, log_buf, len(log_buf))
+            if fd < 0:
+                raise OSError(-fd, f"Failed to load {fn_name}: {log_buf.value.decode(errors='replace')}")
+            self.funcs[fn_name.encode()] = BPF.Function(self, fn_name.encode(), fd)
+
+    def check_attrs(self, obj):
+        '''
+        give this object and its tables every attribute a compiled one of this bcc has
+        one that cannot be rebuilt fails the load here, instead of somewhere later in the trace
+        '''
+        missing = fill_attrs(self, obj["bpf_attrs"])
+        for name, attrs in obj["table_attrs"].items():
+            missing += [f"{name}.{attr}" for attr in fill_attrs(self.tables[name], attrs)]
+        if missing:
+            raise RuntimeError(f"bcc {getattr(bcc, '__version__', 'unknown')} objects have {', '.join(missing)}")
+
+    def _make_table(self, map_id, fd, spec, max_entries):
+        # the table classes read their type and size from the bpf module, fill them in directly
+        cls = TABLE_CLASSES[spec["type"]]
+        table = cls.__new__(cls)
+        table.bpf = self
+        table.map_id = map_id
+        table.map_fd = fd
+        table.Key = BPF._decode_table_type(json.loads(spec["key_desc"]))
+        table.Leaf = BPF._decode_table_type(json.loads(spec["leaf_desc"]))
+        table.ttype = spec["type"]
+        table.flags = spec["flags"]
+        table.max_entries = max_entries
+        table._cbs = {}
+        table._name = spec["name"].encode()
+        if cls in (PerfEventArray, RingBuf):
+            table._event_class = None
+        if cls is PerfEventArray:
+            table._open_key_fds = {}
+        if cls is RingBuf:
+            table._ringbuf = None
+        return table
+
+def load_bpf(program, cflags, fn_names, prog_types=None, cache_dir=BPF_CACHE_DIR):
+    '''
+    return (BPF object, cache hit), a miss compiles the program as before and stores it for the next run
+    '''
+    try:
+        declare_lib()
+    except AttributeError as e:
+        print(f"[!] libbcc is missing {e}, the BPF object is not cached")
+        return BPF(text=program, cflags=cflags), False
+
+    path = get_cache_path(program, cflags, cache_dir)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return CachedBPF(json.load(f)), True
+        except Exception as e:
+            print(f"[!] Failed to load cached BPF object {path}: {e}, compiling instead")
+
+    b = BPF(text=program, cflags=cflags)
+    try:
+        save_object(b, fn_names, path, prog_types)
+    except Exception as e:
+        print(f"[!] Failed to cache the BPF object: {e}")
+    return b, False
@@ -0,0 +1,106 @@
+# measure what the tracer itself costs Envoy, per hookpoint and per request stage
+
+from bcc import BPF
+
+import json
+import os
+import time
+
+STATS_SYSCTL = "/proc/sys/kernel/bpf_stats_enabled"
+OVERHEAD_FILE = "/tmp/trace_output.overhead"
+
+LIBC = "c"
+SYMBOL = "getpid"
+
+noop_program = r"""
+    #include <uapi/linux/ptrace.h>
+    int noop(struct pt_regs *ctx) {
+        return 0;
+    }
+"""
+
+def enable_bpf_stats():
+    # run_time_ns and run_cnt are only counted while the sysctl is on, return the old value
+    with open(STATS_SYSCTL, 'r') as f:
+        old_value = f.read().strip()
+    with open(STATS_SYSCTL, 'w') as f:
+        f.write("1")
+    return old_value
+
+def restore_bpf_stats(old_value):
+    with open(STATS_SYSCTL, 'w') as f:
+        f.write(old_value)
+
+def read_prog_stats(fd):
+    # /proc/self/fdinfo/<fd> of a bpf program has "run_time_ns:" and "run_cnt:" lines
+    stats = {"run_time_ns": 0, "run_cnt": 0}
+    with open(f"/proc/self/fdinfo/{fd}", 'r') as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in stats:
+                stats[key] = int(value.strip())
+    return stats
+
+def read_hook_stats(b, uprobe):
+    # bcc keys its loaded functions by bytes
+    return {fn_name: read_prog_stats(b.funcs[fn_name.encode()].fd) for fn_name in uprobe.hook_functions()}
+
+def time_getpid(calls):
+    start = time.perf_counter_ns()
+    for _ in range(calls):
+        os.getpid()
+    return (time.perf_counter_ns() - start) / calls
+
+def measure_trap_cost(calls=200000, rounds=5):
+    '''
+    ns a uprobe adds to a call besides the bpf program, measured on libc getpid() of this process
+    '''
+    b = BPF(text=noop_program)
+    baseline = min(time_getpid(calls) for _ in range(rounds))
+    b.attach_uprobe(name=LIBC, sym=SYMBOL, fn_name="noop", pid=os.getpid())
+    traced = min(time_getpid(calls) for _ in range(rounds))
+    noop = read_prog_stats(b.funcs[b"noop"].fd)
+    b.cleanup()
+
+    # the empty program still runs, its own run time is not part of the trap
+    noop_ns = noop["run_time_ns"] / noop["run_cnt"] if noop["run_cnt"] else 0
+    return max(traced - baseline - noop_ns, 0)
+
+def compute_overhead(uprobe, start_stats, end_stats, trap_ns):
+    '''
+    cost of every hookpoint over the calibration window and the ns it adds to each stage of a request
+    '''
+    hooks = {}
+    for fn_name in uprobe.hook_functions():
+        run_cnt = end_stats[fn_name]["run_cnt"] - start_stats[fn_name]["run_cnt"]
+        run_time_ns = end_stats[fn_name]["run_time_ns"] - start_stats[fn_name]["run_time_ns"]
+        hooks[fn_name] = {
+            "run_cnt": run_cnt,
+            "run_time_ns": run_time_ns,
+            "avg_run_ns": run_time_ns / run_cnt if run_cnt else 0,
+            "total_ns": run_time_ns + run_cnt * trap_ns,
+        }
+
+    # every request ends in request_end exactly once
+    requests = hooks["request_end"]["run_cnt"]
+    stages = {stage: 0.0 for stage in uprobe.stage_list}
+    for fn_name, hook in hooks.items():
+        hook["per_request_ns"] = hook["total_ns"] / requests if requests else 0
+        charged = uprobe.hook_stage_map.get(fn_name, [])
+        for stage in charged:
+            stages[stage] += hook["per_request_ns"] / len(charged)
+    stages["Total"] = sum(hook["per_request_ns"] for hook in hooks.values())
+
+    return {"trap_ns": trap_ns, "requests": requests, "hooks": hooks, "stages": stages}
+
+def write_overhead(overhead, output_file=OVERHEAD_FILE):
+    with open(output_file, 'w') as f:
+        json.dump(overhead, f, indent=4)
+
+def print_overhead(overhead):
+    print(f"[*] Uprobe trap cost: {overhead['trap_ns']:.0f} ns, {overhead['requests']} requests")
+    print(f"    {'Hookpoint':<30}{'Calls':>12}{'Avg run':>12}{'Per request':>14}")
+    for fn_name, hook in overhead["hooks"].items():
+        print(f"    {fn_name:<30}{hook['run_cnt']:>12}{hook['avg_run_ns']:>9.0f} ns{hook['per_request_ns']:>11.0f} ns")
+    for stage, ns in overhead["stages"].items():
+        print(f"    {stage:<30}{ns:>11.0f} ns per request")
@@ -1,16 +1,50 @@
 #!/usr/bin/python3
 
 from bcc import BPF
-import ctypes
 import subprocess
 
 import argparse
+import io
 import json
-import queue, threading
+import os
+import socket
+import time
+import queue
+import numpy as np
 
 from http_uprobe import HttpUprobe
+from bpf_cache import load_bpf
+from symbol_cache import resolve_symbols, read_build_id
+from calibrate import (enable_bpf_stats, restore_bpf_stats, read_hook_stats, measure_trap_cost,
+                       compute_overhead, write_overhead, print_overhead, OVERHEAD_FILE)
+from trace_record import RecordBuffer, RECORD_DTYPE, record_dtype, records_to_lines, write_header
+from trace_writer import RotatingWriter, AsyncWriter, install_shutdown_handlers, BUFFER_SIZE, QUEUE_SIZE
+from trace_sender import TraceSender
 
-log_queue = queue.Queue()
+BUFFER_RECORDS = 4096
+FLUSH_INTERVAL = 1.0
+DRAIN_INTERVAL = 0.01
+HIST_INTERVAL = 10.0
+STATS_INTERVAL = 10.0
+STATS_FILE = "/tmp/trace_output.stats"
+HIST_PERCENTILES = [50, 90, 99]
+DISCOVER_INTERVAL = 5.0
+LEVEL_FILE = "/tmp/trace_output.level"
+
+ENVOY_BINARIES = {"cilium": "/usr/bin/cilium-envoy", "istio": "/usr/local/bin/envoy"}
+
+writer = None
+free_buffers = queue.Queue()
+current_buffer = None
+current_dtype = RECORD_DTYPE
+lost_events = 0
+total_records = 0
+dropped_records = 0
+pod_names = {}      # pid -> pod of every attached Envoy in node mode
+processes = {}      # pid -> (binary path, resolved hookpoint addresses) of every attached Envoy
+process_ids = {}    # pid -> (start time, exe) in node mode, a reused pid or an exec gives another one
+active_level = None     # level whose hookpoints are attached right now
+level_request = None    # last content of LEVEL_FILE, so an invalid one is only reported once
 
 def find_envoy_pid(type):
     cmd = ...
@@ -29,83 +63,611 @@ def find_envoy_pid(type):
     
     raise RuntimeError("Envoy process not found")
 
+def find_envoy_processes(type, build_id=None):
+    '''
+    return {pid: build-id} of every Envoy process on the node, the ones inside containers included
+    '''
+    binary_path = ENVOY_BINARIES[type]
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            # the link target is the path inside the container's mount namespace
+            exe = os.readlink(f"/proc/{entry}/exe")
+            if exe.replace(" (deleted)", "") != binary_path:
+                continue
+            process_build_id = read_build_id(f"/proc/{entry}/exe")
+        except (OSError, ValueError):
+            continue
+        if build_id and not process_build_id.startswith(build_id):
+            continue
+        processes[int(entry)] = process_build_id
+    return processes
+
+def get_pod_name(pid):
+    # a pod's containers share its hostname, which is the pod name
+    try:
+        with open(f"/proc/{pid}/root/etc/hostname", 'r') as f:
+            return f.read().strip() or f"pid{pid}"
+    except OSError:
+        return f"pid{pid}"
+
+def get_free_buffer():
+    try:
+        return free_buffers.get_nowait()
+    except queue.Empty:
+        return RecordBuffer(BUFFER_RECORDS, current_dtype)
+
+def flush_buffer():
+    # hand the filled buffer to the writer thread and continue with an empty one
+    global current_buffer, dropped_records
+    if not current_buffer.count:
+        return
+    if writer.submit(current_buffer):
+        current_buffer = get_free_buffer()
+    else:
+        # the writer is behind, drop this batch rather than stall the polling thread
+        dropped_records += current_buffer.count
+        current_buffer.reset()
+
 def callback(cpu, data, size):
-    class ConnInfo(ctypes.Structure):
-        _fields_ = [
-            ("x_request_id", ctypes.c_char * 37),
-            ("time_http_start", ctypes.c_ulonglong),
-            ("time_request_filter_start", ctypes.c_ulonglong),
-            ("time_process_start", ctypes.c_ulonglong),
-            ("time_response_filter_start", ctypes.c_ulonglong),
-            ("time_end", ctypes.c_ulonglong),
-            ("response_parse_start", ctypes.c_ulonglong),
-            ("write_start_time", ctypes.c_ulonglong),
-            ("write_end_time", ctypes.c_ulonglong),
-            ("read_start_time", ctypes.c_ulonglong),
-            ("read_end_time", ctypes.c_ulonglong),
-        ]
-    event = ctypes.cast(data, ctypes.POINTER(ConnInfo)).contents
-    x_request_id_str = event.x_request_id.split(b'\x00', 1)[0].decode(errors="replace")
-    log_data = {
-        "X-Request-ID": x_request_id_str,
-        "Time HTTP Start": event.time_http_start,
-        "Time Request Filter Start": event.time_request_filter_start,
-        "Write Start Time": event.write_start_time,
-        "Write End Time": event.write_end_time,
-        "Read Start Time": event.read_start_time,
-        "Read End Time": event.read_end_time,
-        "Time Process Start": event.time_process_start,
-        "Time Response Filter Start": event.time_response_filter_start,
-        "Time End": event.time_end,
-        "Response Parse Start": event.response_parse_start,
-    }
-    log_queue.put(json.dumps(log_data))
-
-def start_trace(type):
-    binary_path = ...
-
-    uprobe = HttpUprobe()
-    b = BPF(text=uprobe.program)
-
-    # start working thread to collect logs
-    output_file = "/tmp/trace_output.log"
-    def log_worker():
-        with open(output_file, "a") as f:
-            while True:
-                try:
-                    line = log_queue.get(timeout=1)
-                    f.write(line)
-                    f.write("\n")
-                    f.flush()
-                except queue.Empty:
-                    continue
-    threading.Thread(target=log_worker, daemon=True).start()
+    # runs on the perf-buffer polling thread, only copy the raw request_info_t
+    if current_buffer.append(data, size):
+        flush_buffer()
+
+def lost_callback(lost):
+    global lost_events
+    lost_events += lost
+
+def open_transport(b, transport, event_callback, drain_interval=DRAIN_INTERVAL):
+    '''
+    register event_callback on trace_events, return (poll, get_lost) for the polling loop
+    '''
+    if transport == "ringbuf":
+        # ringbuf callbacks are (ctx, data, size), same shape as the perf ones
+        b["trace_events"].open_ring_buffer(event_callback)
+        drops = b["transport_drops"]
+
+        def poll():
+            # records are submitted without a wakeup, drain everything that piled up since the last batch
+            time.sleep(drain_interval)
+            b.ring_buffer_consume()
+
+        def get_lost():
+            return sum(value.value for value in drops.values())
+        return poll, get_lost
+
+    b["trace_events"].open_perf_buffer(event_callback, page_cnt=256, lost_cb=lost_callback)
+
+    def poll():
+        b.perf_buffer_poll(timeout=5)
 
+    def get_lost():
+        return lost_events
+    return poll, get_lost
+
+def get_header(output_format):
+    if output_format != "binary":
+        return b""
+    header = io.BytesIO()
+    write_header(header, current_dtype)
+    return header.getvalue()
+
+def start_writer(output_file, output_format, node=False, writer_options=None, queue_size=QUEUE_SIZE, collector=None):
+    '''
+    start the writer thread, in node mode output_file has a {pod} field and every pod gets its own file
+    with a collector address the records are sent there instead, tagged with their pod
+    '''
+    global writer
+    files = {}
+    header = get_header(output_format)
+    sender = TraceSender(collector, get_header("binary")) if collector else None
+
+    def get_file(path):
+        if path not in files:
+            files[path] = RotatingWriter(path, header, **(writer_options or {}))
+        return files[path]
+
+    def encode(records):
+        if output_format == "binary":
+            return records.tobytes()
+        return ("\n".join(records_to_lines(records)) + "\n").encode()
+
+    def split_by_pod(records):
+        if not node:
+            # inside the sidecar the hostname is the pod name
+            return [(socket.gethostname(), records)]
+        pods = []
+        for pid in np.unique(records["pid"]):
+            pods.append((pod_names.get(int(pid)) or get_pod_name(int(pid)), records[records["pid"] == pid]))
+        return pods
+
+    def write_batch(buffer):
+        global total_records
+        records = buffer.filled()
+        if sender:
+            for pod, pod_records in split_by_pod(records):
+                sender.send(pod, pod_records)
+        elif node:
+            for pod, pod_records in split_by_pod(records):
+                get_file(output_file.format(pod=pod)).write(encode(pod_records))
+        else:
+            get_file(output_file).write(encode(records))
+        total_records += len(records)
+
+    def recycle(buffer):
+        buffer.reset()
+        free_buffers.put(buffer)
+
+    writer = AsyncWriter(write_batch, recycle, queue_size)
+    writer.files = files
+    writer.sender = sender
+    return writer
+
+def stop_writer():
+    # write everything still queued, then flush and close every file
+    writer.close()
+    for f in writer.files.values():
+        f.close()
+    if writer.sender:
+        writer.sender.close()
+
+def compile_program(uprobe):
+    # reuse the bytecode of an earlier run with the same program, kernel and flags
+    start = time.monotonic()
+    prog_types = {fn_name: BPF.TRACEPOINT for fn_name in uprobe.sched_tracepoint_map}
+    b, hit = load_bpf(uprobe.program, uprobe.get_cflags(), uprobe.function_list(), prog_types)
+    print(f"[*] BPF program ready in {time.monotonic() - start:.2f}s" + (" (cached object)" if hit else " (compiled)"))
+    return b
+
+def attach_envoy(b, uprobe, type):
     # attach uprobes
-    if type == "cilium":
-        binary_path = "/usr/bin/cilium-envoy"
-    elif type == "istio":
-        binary_path = "/usr/local/bin/envoy"
-    else:
+    if type not in ENVOY_BINARIES:
         print("Unknown type")
+        return False
+
+    attach_process(b, uprobe, ENVOY_BINARIES[type], find_envoy_pid(type))
+    return True
+
+def process_identity(pid):
+    '''
+    (start time in clock ticks since boot, exe link) of a process, None once it exited
+    '''
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            # the command name may contain spaces and parentheses, the fields after it do not
+            fields = f.read().rsplit(")", 1)[1].split()
+        return int(fields[19]), os.readlink(f"/proc/{pid}/exe")
+    except (OSError, IndexError, ValueError):
+        return None
+
+def prune_node(b, uprobe):
+    '''
+    forget Envoys which exited or whose pid now belongs to another process, detaching what is left of their uprobes
+    '''
+    for pid in list(pod_names):
+        if process_identity(pid) == process_ids.get(pid):
+            continue
+        if pid in processes:
+            binary_path, addresses = processes.pop(pid)
+            try:
+                detach_hooks(b, uprobe.hook_symbols(active_level), binary_path, addresses, pid)
+            except Exception as e:
+                # the kernel drops the probes of an exited process itself, only bcc's bookkeeping stays behind
+                print(f"[!] Failed to detach the uprobes of Envoy {pid}: {e}")
+        print(f"[*] Envoy {pid} of {pod_names[pid]} is gone")
+        del pod_names[pid]
+        process_ids.pop(pid, None)
+
+def attach_node(b, uprobe, type, build_id=None):
+    '''
+    attach to every Envoy process of the node which is not traced yet, return the number of new ones
+    Envoys that are gone are dropped first, so a restarted one is attached again even under a reused pid
+    '''
+    prune_node(b, uprobe)
+    attached = 0
+    for pid, process_build_id in find_envoy_processes(type, build_id).items():
+        if pid in pod_names:
+            continue
+        process_ids[pid] = process_identity(pid)
+        # /proc/<pid>/exe reaches the binary inside the container, the symbol cache is shared per build-id
+        attach_process(b, uprobe, f"/proc/{pid}/exe", pid)
+        pod_names[pid] = get_pod_name(pid)
+        print(f"[*] Tracing Envoy {pid} of {pod_names[pid]} (build-id {process_build_id[:12]})")
+        attached += 1
+    return attached
+
+def attach_process(b, uprobe, binary_path, target_pid):
+    start = time.monotonic()
+    addresses, hit = resolve_symbols(binary_path, uprobe.hook_symbol_list)
+    processes[target_pid] = (binary_path, addresses)
+    hooks = uprobe.hook_symbols(active_level)
+    attach_hooks(b, hooks, binary_path, addresses, target_pid)
+    print(f"[*] Attached {len(hooks)} uprobes in {time.monotonic() - start:.2f}s"
+          + (" (symbol cache hit)" if hit else ""))
+
+def attach_hooks(b, hooks, binary_path, addresses, target_pid):
+    for symbol, fn_name in hooks.items():
+        if symbol in addresses:
+            b.attach_uprobe(addr=addresses[symbol], fn_name=fn_name, name=binary_path, pid=target_pid)
+        else:
+            # not in the symbol table walk, let BCC resolve it by name as before
+            b.attach_uprobe(sym=symbol, fn_name=fn_name, name=binary_path, pid=target_pid)
+
+def detach_hooks(b, hooks, binary_path, addresses, target_pid):
+    # bcc names the uprobe event after the path and address, detach the same way it was attached
+    for symbol in hooks:
+        if symbol in addresses:
+            b.detach_uprobe(addr=addresses[symbol], name=binary_path, pid=target_pid)
+        else:
+            b.detach_uprobe(sym=symbol, name=binary_path, pid=target_pid)
+
+def set_level(b, uprobe, level):
+    '''
+    attach the hookpoints `level` adds and detach the ones it drops in every traced Envoy
+    requests in flight while switching miss the stages of the changed hookpoints
+    '''
+    global active_level
+    old_hooks = uprobe.hook_symbols(active_level)
+    new_hooks = uprobe.hook_symbols(level)
+    added = {symbol: fn_name for symbol, fn_name in new_hooks.items() if symbol not in old_hooks}
+    removed = {symbol: fn_name for symbol, fn_name in old_hooks.items() if symbol not in new_hooks}
+    for pid, (binary_path, addresses) in list(processes.items()):
+        try:
+            detach_hooks(b, removed, binary_path, addresses, pid)
+            attach_hooks(b, added, binary_path, addresses, pid)
+        except Exception as e:
+            # the Envoy is gone, node mode attaches its replacement as a new process
+            print(f"[!] Failed to switch Envoy {pid} to level {level}: {e}")
+            del processes[pid]
+    print(f"[*] Trace level {active_level} -> {level}: attached {len(added)}, detached {len(removed)} uprobes per Envoy")
+    active_level = level
+
+def init_level_file(level, level_file=LEVEL_FILE):
+    # overwrite the level a previous run left behind, so it is not applied to this one
+    global active_level, level_request
+    active_level = level_request = level
+    with open(level_file, 'w') as f:
+        f.write(level + "\n")
+
+def check_level_file(b, uprobe, level_file=LEVEL_FILE):
+    '''
+    switch to the level written to level_file (e.g. echo e2e > /tmp/trace_output.level)
+    only levels up to the compiled one can be attached
+    '''
+    global level_request
+    try:
+        with open(level_file, 'r') as f:
+            level = f.read().strip()
+    except FileNotFoundError:
         return
-    
-    target_pid = find_envoy_pid(type)
-    for i, symbol in enumerate(uprobe.hook_symbol_list):
-        b.attach_uprobe(sym=symbol, fn_name=uprobe.hook_function_list[i], name=binary_path, pid=target_pid)
+    if level == level_request:
+        return
+    level_request = level
+    if level not in uprobe.level_list[:uprobe.level_list.index(uprobe.level) + 1]:
+        print(f"[!] Ignoring trace level {level} in {level_file}, the program is compiled for up to {uprobe.level}")
+    elif level != active_level:
+        set_level(b, uprobe, level)
+
+def attach_sched(b, uprobe):
+    # sched_switch / sched_wakeup of every Envoy worker thread on the node, attached once
+    # bcc attaches TRACEPOINT_PROBE functions itself when it compiles, a cached object needs it done here
+    for fn_name, tracepoint in uprobe.sched_tracepoint_map.items():
+        if tracepoint.encode() not in b.tracepoint_fds and tracepoint not in b.tracepoint_fds:
+            b.attach_tracepoint(tp=tracepoint, fn_name=fn_name)
+    print(f"[*] Attached {len(uprobe.sched_tracepoint_map)} sched tracepoints")
+
+def attach_tcp(b, uprobe):
+    # kernel side of the upstream sockets, joined to the connections by the IO hooks
+    for fn_name, event in uprobe.tcp_kprobe_map.items():
+        b.attach_kprobe(event=event, fn_name=fn_name)
+    print(f"[*] Attached {len(uprobe.tcp_kprobe_map)} tcp kprobes")
+
+def read_map_stats(b, uprobe):
+    '''
+    return {map: {entries, size, occupancy, evicted}}, counting the entries walks the whole map
+    evicted is every key ever inserted minus the deleted ones and the ones still there, in-flight requests the LRU dropped
+    '''
+    inserts = b["map_inserts"]
+    deletes = b["map_deletes"]
+    stats = {}
+    for i, name in enumerate(uprobe.map_list):
+        entries = len(b[name])
+        size = uprobe.map_sizes[name]
+        # the counters move while the map is walked, never report that as a negative eviction count
+        evicted = max(inserts[i].value - deletes[i].value - entries, 0)
+        stats[name] = {"entries": entries, "size": size, "occupancy": entries / size, "evicted": evicted}
+    return stats
+
+def export_map_stats(b, uprobe, output_file=STATS_FILE, reported=None):
+    '''
+    append one json line per report, warn about maps over 90% full and about new evictions since the reported ones
+    '''
+    stats = read_map_stats(b, uprobe)
+    with open(output_file, "a") as f:
+        f.write(json.dumps({"time": time.time(), "maps": stats}) + "\n")
+    for name, stat in stats.items():
+        new_evictions = stat["evicted"] - (reported or {}).get(name, {}).get("evicted", 0)
+        if stat["occupancy"] >= 0.9 or new_evictions > 0:
+            print(f"[!] {name}: {stat['entries']}/{stat['size']} entries, {stat['evicted']} in-flight entries evicted")
+    return stats
+
+def report_sampling(b, uprobe):
+    if uprobe.sample_rate <= 1:
+        return
+    stats = b["sample_stats"]
+    kept, dropped = stats[0].value, stats[1].value
+    print(f"[*] Sampled 1/{uprobe.sample_rate}: kept {kept} requests, dropped {dropped}")
+
+def start_trace(type, output_format="text", transport="perf", drain_interval=DRAIN_INTERVAL, sample_rate=1, map_sizes=None,
+                calibrate=None, node=False, build_id=None, writer_options=None, queue_size=QUEUE_SIZE, collector=None,
+                sched=False, tcp=False, level="io", max_level=None):
+    '''
+    calibrate: trace for this many seconds with bpf run-time stats on, then write the tracer's own cost per stage
+    node: trace every Envoy process of the node (optionally only one build-id) into one file per pod
+    writer_options: buffer_size, compress, rotate_bytes, rotate_seconds, keep of RotatingWriter
+    queue_size: batches waiting for the writer thread before new ones are dropped
+    collector: host:port of trace_collector.py, records are streamed there instead of written to /tmp
+    sched: also record the run-queue and sleep time of the worker thread at every stage boundary
+    tcp: also record when the upstream socket sent the request and received the response in the kernel
+    level: hookpoints attached at start, max_level: hookpoints compiled in, LEVEL_FILE switches between them
+    '''
+    global current_buffer, current_dtype
+
+    uprobe = HttpUprobe(transport, sample_rate=sample_rate, map_sizes=map_sizes, sched=sched, tcp=tcp, level=max_level or level)
+    init_level_file(level)
+    current_dtype = record_dtype(sched, tcp)
+    b = compile_program(uprobe)
 
-    # register call backs
-    b["trace_events"].open_perf_buffer(callback, page_cnt=256)
+    # attach first, a failed attach then leaves no writer thread behind to keep the process alive
+    if node:
+        if not attach_node(b, uprobe, type, build_id):
+            print(f"[!] No Envoy process found yet, looking again every {DISCOVER_INTERVAL}s")
+    elif not attach_envoy(b, uprobe, type):
+        return
+    if sched:
+        attach_sched(b, uprobe)
+    if tcp:
+        attach_tcp(b, uprobe)
+
+    # start the writer thread, SIGTERM drains it the same way Ctrl+C does
+    output_file = "/tmp/trace_output.bin" if output_format == "binary" else "/tmp/trace_output.log"
+    if node:
+        output_file = output_file.replace("trace_output.", "trace_output_{pod}.")
+    current_buffer = get_free_buffer()
+    start_writer(output_file, output_format, node, writer_options, queue_size, collector)
+    if collector:
+        output_file = f"collector {collector}"
+    install_shutdown_handlers()
 
-    print("Tracing... Ctrl+C to stop.")
+    # every exit from here on joins the writer thread, otherwise an error leaves the process hanging on it,
+    # and turns bpf run-time stats back off, otherwise every bpf program of the node keeps paying for them
+    old_stats_value = None
+    try:
+        if calibrate:
+            old_stats_value = enable_bpf_stats()
+            trap_ns = measure_trap_cost()
+
+        # register call backs
+        poll, get_lost = open_transport(b, transport, callback, drain_interval)
+
+        if calibrate:
+            start_stats = read_hook_stats(b, uprobe)
+            deadline = time.monotonic() + calibrate
+            print(f"Calibrating for {calibrate}s over {transport} buffer... Ctrl+C to stop early.")
+        else:
+            deadline = float("inf")
+            print(f"Tracing over {transport} buffer... Ctrl+C to stop.")
+        last_flush = time.monotonic()
+        last_stats = last_flush
+        last_discover = last_flush
+        reported_lost = 0
+        reported_dropped = 0
+        map_stats = None
+        try:
+            while time.monotonic() < deadline:
+                poll()
+                # flush partially filled buffers so the log does not lag behind at low RPS
+                if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                    flush_buffer()
+                    last_flush = time.monotonic()
+                    lost = get_lost()
+                    if lost != reported_lost:
+                        print(f"[!] Lost {lost - reported_lost} events ({lost} in total)")
+                        reported_lost = lost
+                    if dropped_records != reported_dropped:
+                        print(f"[!] Writer is behind, dropped {dropped_records - reported_dropped} records ({dropped_records} in total)")
+                        reported_dropped = dropped_records
+                    check_level_file(b, uprobe)
+                if time.monotonic() - last_stats >= STATS_INTERVAL:
+                    map_stats = export_map_stats(b, uprobe, reported=map_stats)
+                    last_stats = time.monotonic()
+                # pick up sidecars of pods started after the tracer
+                if node and time.monotonic() - last_discover >= DISCOVER_INTERVAL:
+                    attach_node(b, uprobe, type, build_id)
+                    last_discover = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        flush_buffer()
+        if calibrate:
+            end_stats = read_hook_stats(b, uprobe)
+    finally:
+        if calibrate and old_stats_value is not None:
+            restore_bpf_stats(old_stats_value)
+        stop_writer()
+
+    unsent = writer.sender.dropped if writer.sender else 0
+    print(f"[*] Wrote {total_records - unsent} records to {output_file}, lost {get_lost()} events, dropped {dropped_records + unsent} records")
+    export_map_stats(b, uprobe, reported=map_stats)
+    report_sampling(b, uprobe)
+
+    if calibrate:
+        overhead = compute_overhead(uprobe, start_stats, end_stats, trap_ns)
+        write_overhead(overhead)
+        print_overhead(overhead)
+        print(f"[*] Tracer overhead written to {OVERHEAD_FILE}")
+
+def read_histograms(b, uprobe):
+    '''
+    return {protocol: {stage: {slot: count}}} from the stage_hist map
+    '''
+    hists = {}
+    for key, value in b["stage_hist"].items():
+        protocol = uprobe.protocol_list[key.protocol]
+        stage = uprobe.stage_list[key.stage]
+        hists.setdefault(protocol, {}).setdefault(stage, {})[key.slot] = value.value
+    return hists
+
+def hist_percentile(uprobe, slots, p):
+    # upper bound of the slot holding the p-th percentile
+    target = sum(slots.values()) * p / 100
+    seen = 0
+    for slot in sorted(slots):
+        seen += slots[slot]
+        if seen >= target:
+            return uprobe.slot_upper_bound(slot)
+    return 0
+
+def dump_histograms(b, uprobe, output_file):
+    # one json line per dump, counts are cumulative since the tracer started
+    hists = read_histograms(b, uprobe)
+    snapshot = {
+        "time": time.time(),
+        "hist": uprobe.hist,
+        "step_ns": uprobe.hist_step_ns if uprobe.hist == "linear" else None,
+        "stages": {protocol: {stage: {str(slot): count for slot, count in slots.items()}
+                              for stage, slots in stages.items()}
+                   for protocol, stages in hists.items()},
+    }
+    with open(output_file, "a") as f:
+        f.write(json.dumps(snapshot) + "\n")
+    return hists
+
+def print_histograms(uprobe, hists):
+    for protocol, stages in sorted(hists.items()):
+        print(f"[*] Protocol: {protocol}")
+        for stage in uprobe.stage_list:
+            slots = stages.get(stage)
+            if not slots:
+                continue
+            line = f"    {stage:<26}{sum(slots.values()):>10}"
+            line += "".join(f"  p{p} <= {hist_percentile(uprobe, slots, p) / 1e6:.3f} ms" for p in HIST_PERCENTILES)
+            print(line)
+
+def start_aggregate(type, hist="log2", hist_step_ns=100000, by_protocol=False, interval=HIST_INTERVAL, sample_rate=1, map_sizes=None,
+                    node=False, build_id=None, level="io", max_level=None):
+    '''
+    keep only per-stage latency histograms in the kernel and dump them every `interval` seconds
+    in node mode the histograms cover every Envoy of the node
+    '''
+    uprobe = HttpUprobe(aggregate=True, hist=hist, hist_step_ns=hist_step_ns, by_protocol=by_protocol,
+                        sample_rate=sample_rate, map_sizes=map_sizes, level=max_level or level)
+    init_level_file(level)
+    b = compile_program(uprobe)
+    if node:
+        attach_node(b, uprobe, type, build_id)
+    elif not attach_envoy(b, uprobe, type):
+        return
+
+    output_file = "/tmp/trace_output.hist"
+    print(f"Aggregating {hist} histograms in the kernel... Ctrl+C to stop.")
+    map_stats = None
     try:
         while True:
-            b.perf_buffer_poll(timeout=5)
+            time.sleep(interval)
+            print_histograms(uprobe, dump_histograms(b, uprobe, output_file))
+            map_stats = export_map_stats(b, uprobe, reported=map_stats)
+            check_level_file(b, uprobe)
+            if node:
+                attach_node(b, uprobe, type, build_id)
     except KeyboardInterrupt:
         pass
 
+    dump_histograms(b, uprobe, output_file)
+    print(f"[*] Histograms written to {output_file}")
+    export_map_stats(b, uprobe, reported=map_stats)
+    report_sampling(b, uprobe)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Envoy HTTP/2 Tracing")
     parser.add_argument("-t", "--type", type=str, choices=["cilium", "istio"], required=True)
+    parser.add_argument("-f", "--format", type=str, choices=["text", "binary"], default="text",
+                        help="text: json lines in /tmp/trace_output.log, binary: raw records in /tmp/trace_output.bin")
+    parser.add_argument("--transport", type=str, choices=["perf", "ringbuf"], default="perf",
+                        help="perf: per-cpu perf buffers, ringbuf: shared BPF ring buffer drained in batches (kernel >= 5.8)")
+    parser.add_argument("--drain-interval", type=float, default=DRAIN_INTERVAL * 1000,
+                        help="Milliseconds between two ring buffer drains")
+    parser.add_argument("-a", "--aggregate", action="store_true",
+                        help="Only keep per-stage latency histograms in the kernel, dumped to /tmp/trace_output.hist")
+    parser.add_argument("--hist", type=str, choices=["log2", "linear"], default="log2", help="Histogram slots of the aggregate mode")
+    parser.add_argument("--hist-step", type=float, default=0.1, help="Slot width of the linear histogram in ms")
+    parser.add_argument("--by-protocol", action="store_true", help="Keep separate histograms for http1 and http2")
+    parser.add_argument("--hist-interval", type=float, default=HIST_INTERVAL, help="Seconds between two histogram dumps")
+    parser.add_argument("-s", "--sample", type=int, default=1,
+                        help="Only trace 1/N requests, chosen by a hash of the x-request-id so every sidecar keeps the same ones")
+    parser.add_argument("--map-size", type=str, action="append", default=[], metavar="MAP=ENTRIES",
+                        help="Number of entries of an LRU map, e.g. request_map=131072 (can be repeated)")
+    parser.add_argument("--calibrate", type=float, metavar="SECONDS",
+                        help="Trace for SECONDS with bpf run-time stats on and write the tracer's own cost to /tmp/trace_output.overhead")
+    parser.add_argument("--compile-only", action="store_true",
+                        help="Only compile the program for these flags into the BPF object cache and exit")
+    parser.add_argument("--node", action="store_true",
+                        help="Run on the node and trace every Envoy process, records go to /tmp/trace_output_<pod>.log/.bin")
+    parser.add_argument("--build-id", type=str, help="In node mode, only trace Envoy binaries whose build-id starts with this")
+    parser.add_argument("--buffer-size", type=float, default=BUFFER_SIZE / (1 << 20), help="Write buffer of each trace file in MB")
+    parser.add_argument("--compress", action="store_true", help="Compress trace files with zstd, written as .zst")
+    parser.add_argument("--rotate-size", type=float, default=0, help="Start a new trace file after this many MB (0: never)")
+    parser.add_argument("--rotate-interval", type=float, default=0, help="Start a new trace file after this many seconds (0: never)")
+    parser.add_argument("--keep", type=int, default=0, help="Only keep the last N rotated trace files (0: all)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="Batches waiting for the writer thread before new ones are dropped")
+    parser.add_argument("--collector", type=str, metavar="HOST:PORT",
+                        help="Stream binary records to trace_collector.py instead of writing /tmp/trace_output.*")
+    parser.add_argument("--sched", action="store_true",
+                        help="Add sched_switch/sched_wakeup tracepoints and record the run-queue and sleep time of every stage")
+    parser.add_argument("--tcp", action="store_true",
+                        help="Add tcp_sendmsg/tcp_rcv_established/tcp_cleanup_rbuf kprobes and record kernel times of the upstream socket")
+    parser.add_argument("--level", type=str, choices=HttpUprobe.level_list, default="io",
+                        help="Hookpoints to attach: e2e (request start/end), filters (+ upstream response), io (+ socket reads/writes)")
+    parser.add_argument("--max-level", type=str, choices=HttpUprobe.level_list,
+                        help=f"Hookpoints to compile in (default: --level), {LEVEL_FILE} switches between the levels up to it at run time")
     args = parser.parse_args()
-    start_trace(args.type)
\ No newline at end of file
+    max_level = args.max_level or args.level
+    if HttpUprobe.level_list.index(max_level) < HttpUprobe.level_list.index(args.level):
+        raise ValueError(f"--max-level {max_level} is below --level {args.level}")
+    if args.tcp and max_level != "io":
+        raise ValueError("--tcp needs the IO hookpoints, use --max-level io")
+    if args.sched and args.aggregate:
+        raise ValueError("--sched records per-request snapshots and does not work with --aggregate")
+    if args.tcp and args.aggregate:
+        raise ValueError("--tcp records per-request timestamps and does not work with --aggregate")
+
+    map_sizes = {}
+    for item in args.map_size:
+        name, entries = item.split("=")
+        if name not in HttpUprobe.map_list:
+            raise ValueError(f"Unknown map {name}, expected one of {HttpUprobe.map_list}")
+        map_sizes[name] = int(entries)
+
+    if args.compile_only:
+        # same flags as start_trace / start_aggregate build, so the cached object matches
+        hist_step_ns = int(args.hist_step * 1e6)
+        transport = "perf" if args.aggregate else args.transport
+        compile_program(HttpUprobe(transport, aggregate=args.aggregate, hist=args.hist, hist_step_ns=hist_step_ns,
+                                   by_protocol=args.by_protocol, sample_rate=args.sample, map_sizes=map_sizes, sched=args.sched,
+                                   tcp=args.tcp, level=max_level))
+    elif args.aggregate:
+        start_aggregate(args.type, args.hist, int(args.hist_step * 1e6), args.by_protocol, args.hist_interval, args.sample, map_sizes,
+                        args.node, args.build_id, args.level, max_level)
+    else:
+        writer_options = {
+            "buffer_size": int(args.buffer_size * (1 << 20)),
+            "compress": args.compress,
+            "rotate_bytes": int(args.rotate_size * (1 << 20)),
+            "rotate_seconds": args.rotate_interval,
+            "keep": args.keep,
+        }
+        start_trace(args.type, args.format, args.transport, args.drain_interval / 1000, args.sample, map_sizes, args.calibrate,
+                    args.node, args.build_id, writer_options, args.queue_size, args.collector, args.sched, args.tcp,
+                    args.level, max_level)
\ No newline at end of file
@@ -1,8 +1,13 @@
 class HttpUprobe:
     program = r"""
     #include <uapi/linux/ptrace.h>
+#ifdef TCP
+    #include <linux/skbuff.h>
+    #include <linux/tcp.h>
+#endif
     struct request_info_t {
         char request_id[37];
+        u8 protocol;        // downstream protocol, 1: http1, 2: http2, fits in the padding before the timestamps
 
         u64 time_http_start;
         u64 time_request_filters_start;
@@ -16,6 +21,27 @@ class HttpUprobe:
         u64 write_end_time;
         u64 read_start_time;
         u64 read_end_time;
+
+        u32 pid;            // tgid of the Envoy process, tells the pods apart in node mode
+
+        // worker thread and cpu at downstream parse start and at request end
+        u32 start_tid;
+        u32 end_tid;
+        u16 start_cpu;
+        u16 end_cpu;
+
+#ifdef TCP
+        // kernel side of the upstream socket: first tcp_sendmsg, first response segment, last tcp_cleanup_rbuf
+        u64 tcp_send_time;
+        u64 tcp_rcv_time;
+        u64 tcp_read_time;
+#endif
+
+#ifdef SCHED
+        // run-queue and sleep time the worker thread accumulated up to each stage boundary, see trace_record.SCHED_BOUNDARIES
+        u64 runq_ns[9];
+        u64 sleep_ns[9];
+#endif
     };
 
     struct IO_info_t {
@@ -25,22 +51,326 @@ class HttpUprobe:
         u64 write_end_time;
         u64 read_start_time;
         u64 read_end_time;
+
+#ifdef TCP
+        u64 tcp_send_time;
+        u64 tcp_rcv_time;
+        u64 tcp_read_time;
+#endif
+
+#ifdef SCHED
+        // at write start, write end and read start
+        u64 runq_ns[3];
+        u64 sleep_ns[3];
+#endif
+    };
+
+    // connection and stream ids are only unique inside one Envoy, every map key also carries the process
+    struct map_key_t {
+        u64 id;
+        u32 tgid;
+        u32 pad;
     };
 
-    BPF_HASH(request_map, u64, struct request_info_t);
-    BPF_HASH(unique_stream_id_map, u64, u64);  // used for http2 to find upstream
-    BPF_HASH(conn_map, u64, struct IO_info_t);   // used for IO conenction id to find stream id
+    static inline struct map_key_t make_key(u64 id) {
+        struct map_key_t key = {};
+        key.id = id;
+        key.tgid = bpf_get_current_pid_tgid() >> 32;
+        key.pad = 0;
+        return key;
+    }
+
+    static inline void record_start_thread(struct request_info_t *info) {
+        info->start_tid = (u32) bpf_get_current_pid_tgid();
+        info->start_cpu = bpf_get_smp_processor_id();
+    }
+
+    // LRU maps: entries of reset streams or idle keep-alive connections are evicted instead of filling the map
+    BPF_TABLE("lru_hash", struct map_key_t, struct request_info_t, request_map, REQUEST_MAP_SIZE);
+    BPF_TABLE("lru_hash", struct map_key_t, struct map_key_t, unique_stream_id_map, STREAM_MAP_SIZE);  // used for http2 to find upstream
+    BPF_TABLE("lru_hash", struct map_key_t, struct IO_info_t, conn_map, CONN_MAP_SIZE);   // used for IO conenction id to find stream id
+    // new keys put into and keys deleted from each map, indexed like HttpUprobe.map_list
+    // an LRU update evicts instead of failing, the entries neither deleted nor still in the map were evicted
+    BPF_ARRAY(map_inserts, u64, 3);
+    BPF_ARRAY(map_deletes, u64, 3);
+    BPF_ARRAY(transport_drops, u64, 1);     // records the ring buffer had no room for
+
+#ifdef RINGBUF_OUTPUT
+    BPF_RINGBUF_OUTPUT(trace_events, RINGBUF_PAGES);
+#else
     BPF_PERF_OUTPUT(trace_events);
+#endif
+
+    static inline void count_insert(u32 map_index) {
+        u64 *count = map_inserts.lookup(&map_index);
+        if (count) {
+            __sync_fetch_and_add(count, 1);
+        }
+    }
+
+    static inline void count_delete(u32 map_index) {
+        u64 *count = map_deletes.lookup(&map_index);
+        if (count) {
+            __sync_fetch_and_add(count, 1);
+        }
+    }
+
+    #define MAP_INSERT(map, map_index, key, value) \
+        do { if (!map.lookup(key)) { count_insert(map_index); } map.update(key, value); } while (0)
+    #define MAP_DELETE(map, map_index, key) \
+        do { if (map.delete(key) == 0) { count_delete(map_index); } } while (0)
+
+#ifdef SCHED
+    #define TASK_REPORT 0x7f
+    #define THREAD_RUNNING 0
+    #define THREAD_RUNNABLE 1
+    #define THREAD_SLEEPING 2
+
+    struct thread_sched_t {
+        u64 runq_ns;
+        u64 sleep_ns;
+        u64 ts;             // when the thread entered its current state
+        u32 state;
+        u32 pad;
+    };
+    BPF_TABLE("lru_hash", u32, struct thread_sched_t, thread_sched, THREAD_MAP_SIZE);
+
+    // Envoy names its worker threads wrk:worker_<n>, works the same in every pid namespace
+    static inline int is_worker(const char *comm) {
+        return comm[0] == 'w' && comm[1] == 'r' && comm[2] == 'k' && comm[3] == ':';
+    }
+
+    // args is generated by bcc from events/sched/sched_{switch,wakeup}/format of this kernel
+    TRACEPOINT_PROBE(sched, sched_switch) {
+        u64 ts = bpf_ktime_get_tai_ns();
+        if (is_worker(args->prev_comm)) {
+            u32 tid = args->prev_pid;
+            struct thread_sched_t zero = {};
+            struct thread_sched_t *thread = thread_sched.lookup_or_try_init(&tid, &zero);
+            if (thread) {
+                // preempted or throttled threads stay runnable, any other state sleeps until its wakeup
+                thread->state = (args->prev_state & TASK_REPORT) == 0 ? THREAD_RUNNABLE : THREAD_SLEEPING;
+                thread->ts = ts;
+            }
+        }
+        if (is_worker(args->next_comm)) {
+            u32 tid = args->next_pid;
+            struct thread_sched_t *thread = thread_sched.lookup(&tid);
+            if (thread) {
+                if (thread->state == THREAD_RUNNABLE) {
+                    thread->runq_ns += ts - thread->ts;
+                } else if (thread->state == THREAD_SLEEPING) {
+                    thread->sleep_ns += ts - thread->ts;
+                }
+                thread->state = THREAD_RUNNING;
+                thread->ts = ts;
+            }
+        }
+        return 0;
+    }
+
+    TRACEPOINT_PROBE(sched, sched_wakeup) {
+        if (!is_worker(args->comm)) {
+            return 0;
+        }
+        u32 tid = args->pid;
+        struct thread_sched_t *thread = thread_sched.lookup(&tid);
+        if (thread && thread->state == THREAD_SLEEPING) {
+            u64 ts = bpf_ktime_get_tai_ns();
+            thread->sleep_ns += ts - thread->ts;
+            thread->state = THREAD_RUNNABLE;
+            thread->ts = ts;
+        }
+        return 0;
+    }
+
+    // hooks run on the worker thread itself, so its counters are settled up to now
+    static inline void sched_snapshot(u64 *runq_ns, u64 *sleep_ns) {
+        u32 tid = (u32) bpf_get_current_pid_tgid();
+        struct thread_sched_t *thread = thread_sched.lookup(&tid);
+        *runq_ns = thread ? thread->runq_ns : 0;
+        *sleep_ns = thread ? thread->sleep_ns : 0;
+    }
+
+    // the upstream parse start comes from the upstream request, the IO boundaries from the connection
+    static inline void copy_upstream_sched(struct request_info_t *info, struct request_info_t *upstream_info, struct IO_info_t *io_info) {
+        info->runq_ns[6] = upstream_info->runq_ns[0];
+        info->sleep_ns[6] = upstream_info->sleep_ns[0];
+        if (io_info) {
+#pragma unroll
+            for (int i = 0; i < 3; i++) {
+                info->runq_ns[3 + i] = io_info->runq_ns[i];
+                info->sleep_ns[3 + i] = io_info->sleep_ns[i];
+            }
+        }
+    }
+
+    #define SCHED_SNAPSHOT(info, i) sched_snapshot(&(info)->runq_ns[i], &(info)->sleep_ns[i])
+    #define COPY_UPSTREAM_SCHED(info, upstream_info, io_info) copy_upstream_sched(info, upstream_info, io_info)
+#else
+    #define SCHED_SNAPSHOT(info, i)
+    #define COPY_UPSTREAM_SCHED(info, upstream_info, io_info)
+#endif
+
+#ifdef TCP
+    // conn_map key of the IO hook the worker thread is in, the tcp probes inside its syscalls find the connection here
+    BPF_TABLE("lru_hash", u32, struct map_key_t, current_io, THREAD_MAP_SIZE);
+    // upstream socket -> conn_map key, for segments which arrive in softirq context
+    BPF_TABLE("lru_hash", u64, struct map_key_t, sock_io, CONN_MAP_SIZE);
+
+    static inline struct IO_info_t *thread_io(u64 sk) {
+        u32 tid = (u32) bpf_get_current_pid_tgid();
+        struct map_key_t *key = current_io.lookup(&tid);
+        if (!key) {
+            return 0;
+        }
+        struct map_key_t io_key = *key;
+        sock_io.update(&sk, &io_key);
+        return conn_map.lookup(&io_key);
+    }
+
+    // tcp_sendmsg(struct sock *sk, struct msghdr *msg, size_t size)
+    int tcp_send(struct pt_regs *ctx) {
+        struct IO_info_t *io_info = thread_io(PT_REGS_PARM1(ctx));
+        if (io_info && io_info->tcp_send_time == 0) {
+            io_info->tcp_send_time = bpf_ktime_get_tai_ns();
+        }
+        return 0;
+    }
+
+    // tcp_rcv_established(struct sock *sk, struct sk_buff *skb), softirq, skb->data is the tcp header
+    int tcp_rcv(struct pt_regs *ctx) {
+        u64 sk = PT_REGS_PARM1(ctx);
+        struct map_key_t *key = sock_io.lookup(&sk);
+        if (!key) {
+            return 0;
+        }
+        struct map_key_t io_key = *key;
+        struct IO_info_t *io_info = conn_map.lookup(&io_key);
+        // the first segment carrying data after the request went out, pure acks do not count
+        if (!io_info || io_info->tcp_send_time == 0 || io_info->tcp_rcv_time != 0) {
+            return 0;
+        }
+        struct sk_buff *skb = (struct sk_buff *) PT_REGS_PARM2(ctx);
+        unsigned int len = 0;
+        unsigned char *data = 0;
+        struct tcphdr th = {};
+        bpf_probe_read_kernel(&len, sizeof(len), &skb->len);
+        bpf_probe_read_kernel(&data, sizeof(data), &skb->data);
+        bpf_probe_read_kernel(&th, sizeof(th), data);
+        if (len > th.doff * 4) {
+            io_info->tcp_rcv_time = bpf_ktime_get_tai_ns();
+        }
+        return 0;
+    }
+
+    // tcp_cleanup_rbuf(struct sock *sk, int copied), after recvmsg copied data to Envoy
+    int tcp_read(struct pt_regs *ctx) {
+        int copied = PT_REGS_PARM2(ctx);
+        if (copied <= 0) {
+            return 0;
+        }
+        struct IO_info_t *io_info = thread_io(PT_REGS_PARM1(ctx));
+        if (io_info) {
+            io_info->tcp_read_time = bpf_ktime_get_tai_ns();
+        }
+        return 0;
+    }
+
+    static inline void set_current_io(struct map_key_t *key) {
+        u32 tid = (u32) bpf_get_current_pid_tgid();
+        current_io.update(&tid, key);
+    }
+
+    static inline void clear_current_io() {
+        u32 tid = (u32) bpf_get_current_pid_tgid();
+        current_io.delete(&tid);
+    }
+
+    static inline void copy_io_tcp(struct request_info_t *info, struct IO_info_t *io_info) {
+        info->tcp_send_time = io_info->tcp_send_time;
+        info->tcp_rcv_time = io_info->tcp_rcv_time;
+        info->tcp_read_time = io_info->tcp_read_time;
+    }
+
+    #define SET_CURRENT_IO(key) set_current_io(key)
+    #define CLEAR_CURRENT_IO() clear_current_io()
+    #define COPY_IO_TCP(info, io_info) copy_io_tcp(info, io_info)
+#else
+    #define SET_CURRENT_IO(key)
+    #define CLEAR_CURRENT_IO()
+    #define COPY_IO_TCP(info, io_info)
+#endif
+
+#ifdef SAMPLE_RATE
+    BPF_ARRAY(sample_stats, u64, 2);        // 0: kept, 1: dropped
+
+    // FNV-1a over the request-id prefix every hop shares, so all sidecars make the same decision
+    static inline int is_sampled(const char *request_id) {
+        u32 hash = 2166136261;
+#pragma unroll
+        for (int i = 0; i < SAMPLE_PREFIX_LEN; i++) {
+            hash ^= (u8) request_id[i];
+            hash *= 16777619;
+        }
+        return hash % SAMPLE_RATE == 0;
+    }
+#endif
+
+#ifdef AGGREGATE
+    struct hist_key_t {
+        u32 protocol;       // 0 unless HIST_BY_PROTOCOL is set
+        u32 stage;          // index into HttpUprobe.stage_list
+        u64 slot;
+    };
+    BPF_HISTOGRAM(stage_hist, struct hist_key_t, HIST_SLOTS * 64);
+
+    static inline void record_stage(u32 protocol, u32 stage, u64 start, u64 end) {
+        if (start == 0 || end == 0 || end < start) {
+            return;
+        }
+        struct hist_key_t key = {};
+#ifdef HIST_BY_PROTOCOL
+        key.protocol = protocol;
+#endif
+        key.stage = stage;
+#ifdef HIST_LINEAR
+        u64 slot = (end - start) / HIST_STEP_NS;
+        key.slot = slot < HIST_SLOTS ? slot : HIST_SLOTS - 1;
+#else
+        key.slot = bpf_log2l(end - start);
+#endif
+        stage_hist.increment(key);
+    }
+
+    // same stage boundaries as graph_gen/stage_breakdown.py
+    static inline void aggregate_request(struct request_info_t *info) {
+        u32 protocol = info->protocol;
+        record_stage(protocol, 0, info->time_http_start, info->time_request_filters_start);
+        record_stage(protocol, 1, info->time_request_filters_start, info->time_process_start);
+        record_stage(protocol, 2, info->time_process_start, info->write_start_time);
+        record_stage(protocol, 3, info->write_start_time, info->write_end_time);
+        record_stage(protocol, 4, info->write_end_time, info->read_start_time);
+        record_stage(protocol, 5, info->read_start_time, info->upstream_time_http_start);
+        record_stage(protocol, 6, info->upstream_time_http_start, info->time_response_filters_start);
+        record_stage(protocol, 7, info->time_response_filters_start, info->time_end);
+        record_stage(protocol, 8, info->time_http_start, info->time_end);
+    }
+#endif
 
     // ConnectionImpl::dispatch <connection_id>
     int http1_parse_start(struct pt_regs *ctx) {
         u32 connection_id = PT_REGS_PARM2(ctx);
-        u64 key = (u64) connection_id;
+        struct map_key_t key = make_key((u64) connection_id);
         u64 ts = bpf_ktime_get_tai_ns();
 
         struct request_info_t info = {};
+        info.protocol = 1;
+        info.pid = key.tgid;
+        record_start_thread(&info);
         info.time_http_start = ts;
-        request_map.update(&key, &info);
+        SCHED_SNAPSHOT(&info, 0);
+        MAP_INSERT(request_map, 0, &key, &info);
 
         return 0;
     }
@@ -51,10 +381,14 @@ class HttpUprobe:
         u32 plain_stream_id = PT_REGS_PARM3(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
 
-        u64 key = ((u64)plain_stream_id << 32) | ((u64)connection_id);
+        struct map_key_t key = make_key(((u64)plain_stream_id << 32) | ((u64)connection_id));
         struct request_info_t info = {};
+        info.protocol = 2;
+        info.pid = key.tgid;
+        record_start_thread(&info);
         info.time_http_start = ts;
-        request_map.update(&key, &info);
+        SCHED_SNAPSHOT(&info, 0);
+        MAP_INSERT(request_map, 0, &key, &info);
 
         return 0;
     }
@@ -66,13 +400,15 @@ class HttpUprobe:
         u64 stream_id = PT_REGS_PARM4(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
 
-        u64 key = ((u64)plain_stream_id << 32) | ((u64)connection_id);
+        struct map_key_t key = make_key(((u64)plain_stream_id << 32) | ((u64)connection_id));
+        struct map_key_t stream_key = make_key(stream_id);
         struct request_info_t *info = request_map.lookup(&key);
         if (info) {
             info->time_request_filters_start = ts;
+            SCHED_SNAPSHOT(info, 1);
             // for http2, we need to map stream_id to request_info_t
-            request_map.update(&stream_id, info);
-            request_map.delete(&key);
+            MAP_INSERT(request_map, 0, &stream_key, info);
+            MAP_DELETE(request_map, 0, &key);
         } else {
             // bpf_trace_printk("Request info not found in map for key: %llu\\n", key);
         }
@@ -80,6 +416,7 @@ class HttpUprobe:
         return 0;
     }
 
+#ifdef TRACE_IO
     // UpstreamRequest::onPoolReady <protocol, upstream_conn_id, unique_stream_id>
     int bind_downstream_upstream(struct pt_regs *ctx) {
         u32 protocol = PT_REGS_PARM2(ctx);
@@ -89,25 +426,40 @@ class HttpUprobe:
         struct IO_info_t io_info = {};
 
         if(protocol == 1) {     // Http 1
-            u64 key = (u64) upstream_conn_id;
-            conn_map.update(&key, &io_info);
+            struct map_key_t key = make_key((u64) upstream_conn_id);
+            MAP_INSERT(conn_map, 2, &key, &io_info);
         } else if(protocol == 2) {  // Http 2
-            conn_map.update(&unique_stream_id, &io_info);
+            struct map_key_t unique_key = make_key(unique_stream_id);
+            MAP_INSERT(conn_map, 2, &unique_key, &io_info);
         }
         return 0;
     }
+#endif
 
     // Http::ConnectionManagerImpl::ActiveStream::decodeHeaders <x_request_id, stream_id>
     int process_start(struct pt_regs *ctx) {
         u64 stream_id = PT_REGS_PARM4(ctx);
         const char* str = (const char *)PT_REGS_PARM2(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
-        struct request_info_t *info = request_map.lookup(&stream_id);
+        struct map_key_t stream_key = make_key(stream_id);
+        struct request_info_t *info = request_map.lookup(&stream_key);
         if (info) {
             u64 size = 36;
             bpf_probe_read_str(info->request_id, size, str);
             info->request_id[size] = '\0';
             info->time_process_start = ts;
+            SCHED_SNAPSHOT(info, 2);
+#ifdef SAMPLE_RATE
+            u32 index = is_sampled(info->request_id) ? 0 : 1;
+            u64 *count = sample_stats.lookup(&index);
+            if (count) {
+                __sync_fetch_and_add(count, 1);
+            }
+            if (index == 1) {
+                // drop the request right away so it never reaches request_end
+                MAP_DELETE(request_map, 0, &stream_key);
+            }
+#endif
         } else {
             // bpf_trace_printk("Request info not found in map for stream_id: %llu\\n", stream_id);
         }
@@ -115,17 +467,21 @@ class HttpUprobe:
         return 0;
     }
 
+#ifdef TRACE_FILTERS
     // ConnectionImpl::ClientStreamImpl::decodeHeaders() <conenction_id, plain_stream_id, unique_stream_id>
     int record_unique_stream_id(struct pt_regs *ctx) {
         u32 connection_id = PT_REGS_PARM2(ctx);
         u32 plain_stream_id = PT_REGS_PARM3(ctx);
         u64 unique_stream_id = PT_REGS_PARM4(ctx);
 
-        u64 key = ((u64)plain_stream_id << 32) | ((u64)connection_id);
-        unique_stream_id_map.update(&unique_stream_id, &key);
+        struct map_key_t key = make_key(((u64)plain_stream_id << 32) | ((u64)connection_id));
+        struct map_key_t unique_key = make_key(unique_stream_id);
+        MAP_INSERT(unique_stream_id_map, 1, &unique_key, &key);
         return 0;
     }
+#endif
 
+#ifdef TRACE_IO
     // IoResult RawBufferSocket::doRead() / IoResult RawBufferSocket::doWrite() <type, upstream_connection_id>
     int IO_start(struct pt_regs *ctx) {
         u32 type = PT_REGS_PARM2(ctx);  // 1: read, 2: write
@@ -133,25 +489,32 @@ class HttpUprobe:
         u64 unique_stream_id = PT_REGS_PARM4(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
         if(unique_stream_id == 0) {
-            u64 key = (u64) upstream_connection_id;
+            struct map_key_t key = make_key((u64) upstream_connection_id);
             struct IO_info_t *io_info = conn_map.lookup(&key);
             if (io_info) {
+                SET_CURRENT_IO(&key);
                 if (type == 1) {
                     io_info->read_start_time = ts;      // only record the last read start time
+                    SCHED_SNAPSHOT(io_info, 2);
                 } else if (type == 2) {
                     if(io_info->write_end_time == 0) {
                         io_info->write_start_time = ts;     // only record the first write start time
+                        SCHED_SNAPSHOT(io_info, 0);
                     }
                 }
             }
         }else{
-            struct IO_info_t *io_info = conn_map.lookup(&unique_stream_id);
+            struct map_key_t unique_key = make_key(unique_stream_id);
+            struct IO_info_t *io_info = conn_map.lookup(&unique_key);
             if (io_info) {
+                SET_CURRENT_IO(&unique_key);
                 if (type == 1) {
                     io_info->read_start_time = ts;     // only record the last read start time
+                    SCHED_SNAPSHOT(io_info, 2);
                 } else if (type == 2) {
                     if(io_info->write_end_time == 0) {
                         io_info->write_start_time = ts;     // only record the first write start time
+                        SCHED_SNAPSHOT(io_info, 0);
                     }
                 }
             }
@@ -166,8 +529,9 @@ class HttpUprobe:
         u32 upstream_connection_id = PT_REGS_PARM3(ctx);
         u64 unique_stream_id = PT_REGS_PARM4(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
+        CLEAR_CURRENT_IO();
         if(unique_stream_id == 0) {
-            u64 key = (u64) upstream_connection_id;
+            struct map_key_t key = make_key((u64) upstream_connection_id);
             struct IO_info_t *io_info = conn_map.lookup(&key);
             if (io_info) {
                 if (type == 1) {
@@ -175,18 +539,21 @@ class HttpUprobe:
                 } else if (type == 2) {
                     if(io_info->write_end_time == 0) {      // record the first write end time
                         io_info->write_end_time = ts;
+                        SCHED_SNAPSHOT(io_info, 1);
                     }
                 }
             }
             return 0;
         }else{
-            struct IO_info_t *io_info = conn_map.lookup(&unique_stream_id);
+            struct map_key_t unique_key = make_key(unique_stream_id);
+            struct IO_info_t *io_info = conn_map.lookup(&unique_key);
             if (io_info) {
                 if (type == 1) {
                     io_info->read_end_time = ts;
                 } else if (type == 2) {
                     if(io_info->write_end_time == 0) {      // record the first write end time
                         io_info->write_end_time = ts;
+                        SCHED_SNAPSHOT(io_info, 1);
                     }
                 }
             }
@@ -194,21 +561,24 @@ class HttpUprobe:
         
         return 0;
     }
+#endif
 
+#ifdef TRACE_FILTERS
     // UpstreamRequest::decodeHeaders <stream_id, upstream_connection_id>
     int http1_response_filter_start(struct pt_regs *ctx) {
         u32 upstream_connection_id = PT_REGS_PARM3(ctx);
-        u64 key = (u64) upstream_connection_id;
-        u64 stream_id = (u64) PT_REGS_PARM2(ctx);
+        struct map_key_t key = make_key((u64) upstream_connection_id);
+        struct map_key_t stream_key = make_key((u64) PT_REGS_PARM2(ctx));
         u64 ts = bpf_ktime_get_tai_ns();
 
         struct request_info_t *upstream_info = request_map.lookup(&key);
-        u64 upstream_id = (u64) upstream_connection_id;
+        struct map_key_t upstream_id = key;
         if (upstream_info) {
-            struct request_info_t *info = request_map.lookup(&stream_id);
+            struct request_info_t *info = request_map.lookup(&stream_key);
             if (info) {
                 info->time_response_filters_start = ts;
                 info->upstream_time_http_start = upstream_info->time_http_start;
+                SCHED_SNAPSHOT(info, 7);
 
                 // get IO info
                 struct IO_info_t *io_info = conn_map.lookup(&upstream_id);
@@ -217,13 +587,15 @@ class HttpUprobe:
                     info->write_end_time = io_info->write_end_time;
                     info->read_start_time = io_info->read_start_time;
                     info->read_end_time = io_info->read_end_time;
+                    COPY_IO_TCP(info, io_info);
                 }
+                COPY_UPSTREAM_SCHED(info, upstream_info, io_info);
             }
-            request_map.delete(&key);
+            MAP_DELETE(request_map, 0, &key);
         } else {
-            // bpf_trace_printk("Request info not found in map for connection_id: %llu\\n", stream_id);
+            // bpf_trace_printk("Request info not found in map for connection_id: %llu\\n", stream_key.id);
         }
-        conn_map.delete(&upstream_id);
+        MAP_DELETE(conn_map, 2, &upstream_id);
         return 0;
     }
 
@@ -235,46 +607,70 @@ class HttpUprobe:
         u32 upstream_connection_id = (u32) PT_REGS_PARM4(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
 
-        u64* key = unique_stream_id_map.lookup(&unique_stream_id);
+        struct map_key_t stream_key = make_key(stream_id);
+        struct map_key_t unique_key = make_key(unique_stream_id);
+        struct map_key_t *key = unique_stream_id_map.lookup(&unique_key);
         if (key) {
             struct request_info_t *upstream_info = request_map.lookup(key);
             if (upstream_info) {
-                struct request_info_t *info = request_map.lookup(&stream_id);
+                struct request_info_t *info = request_map.lookup(&stream_key);
                 if (info) {
                     info->time_response_filters_start = ts;
                     info->upstream_time_http_start = upstream_info->time_http_start;
+                    SCHED_SNAPSHOT(info, 7);
 
                     // get IO info
-                    struct IO_info_t *io_info = conn_map.lookup(&unique_stream_id);
+                    struct IO_info_t *io_info = conn_map.lookup(&unique_key);
                     if (io_info) {
                         info->write_start_time = io_info->write_start_time;
                         info->write_end_time = io_info->write_end_time;
                         info->read_start_time = io_info->read_start_time;
                         info->read_end_time = io_info->read_end_time;
+                        COPY_IO_TCP(info, io_info);
                     } else {
                         // bpf_trace_printk("IO info not found in map for unique_stream_id: %llu\\n", unique_stream_id);
                     }
+                    COPY_UPSTREAM_SCHED(info, upstream_info, io_info);
                 }
-                request_map.delete(key);
+                MAP_DELETE(request_map, 0, key);
             } else {
-                // bpf_trace_printk("Upstream request info not found in map for key: %llu\\n", *key);
+                // bpf_trace_printk("Upstream request info not found in map for key: %llu\\n", key->id);
             }
-            unique_stream_id_map.delete(&unique_stream_id);
-            conn_map.delete(&unique_stream_id);
+            MAP_DELETE(unique_stream_id_map, 1, &unique_key);
+            MAP_DELETE(conn_map, 2, &unique_key);
         }
         return 0;
     }
+#endif
 
     // ConnectionManagerImpl::ActiveStream::onCodecEncodeComplete() <stream_id>
     int request_end(struct pt_regs *ctx) {
         u64 stream_id = (u64) PT_REGS_PARM2(ctx);
         u64 ts = bpf_ktime_get_tai_ns();
 
-        struct request_info_t *info = request_map.lookup(&stream_id);
+        struct map_key_t stream_key = make_key(stream_id);
+        struct request_info_t *info = request_map.lookup(&stream_key);
         if (info) {
             info->time_end = ts;
+            info->end_tid = (u32) bpf_get_current_pid_tgid();
+            info->end_cpu = bpf_get_smp_processor_id();
+            SCHED_SNAPSHOT(info, 8);
+#ifdef AGGREGATE
+            // only the histograms are updated, nothing is sent to userspace
+            aggregate_request(info);
+#elif defined(RINGBUF_OUTPUT)
+            // no wakeup per event, userspace drains the ring buffer in batches
+            if (trace_events.ringbuf_output(info, sizeof(*info), BPF_RB_NO_WAKEUP) != 0) {
+                u32 zero = 0;
+                u64 *drops = transport_drops.lookup(&zero);
+                if (drops) {
+                    __sync_fetch_and_add(drops, 1);
+                }
+            }
+#else
             trace_events.perf_submit(ctx, info, sizeof(*info));
-            request_map.delete(&stream_id);
+#endif
+            MAP_DELETE(request_map, 0, &stream_key);
         } else {
             // bpf_trace_printk("Request info not found in map for stream_id: %llu\\n", stream_id);
         }
@@ -303,5 +699,146 @@ class HttpUprobe:
         "bind_downstream_upstream", "IO_start", "IO_end"
     ]
 
-    def __init__(self):
-        pass
\ No newline at end of file
+    # every level traces the hookpoints of the levels before it
+    # e2e: request start and end, the request id and the request filter start, which moves the entry to its stream id
+    # filters: the upstream response and with it the upstream parsing and response filter stages
+    # io: socket reads and writes of the upstream connection, the hottest hookpoints
+    level_list = ["e2e", "filters", "io"]
+    hook_level_map = {
+        "http1_parse_start": "e2e",
+        "http2_parse_start": "e2e",
+        "request_filter_start": "e2e",
+        "process_start": "e2e",
+        "request_end": "e2e",
+        "record_unique_stream_id": "filters",
+        "http1_response_filter_start": "filters",
+        "http2_response_filter_start": "filters",
+        "bind_downstream_upstream": "io",
+        "IO_start": "io",
+        "IO_end": "io",
+    }
+
+    # stage index of hist_key_t, in the order of aggregate_request()
+    stage_list = [
+        "DownStream Http Parsing", "Request Filters", "Socket Waiting", "Write", "Process Time",
+        "Read", "Upstream Http Parsing", "Response Filters", "Total"
+    ]
+
+    protocol_list = ["all", "http1", "http2"]
+
+    # tracepoint programs of the sched module, only loaded with sched=True
+    # function names TRACEPOINT_PROBE gives the sched hooks
+    sched_tracepoint_map = {"tracepoint__sched__sched_switch": "sched:sched_switch",
+                            "tracepoint__sched__sched_wakeup": "sched:sched_wakeup"}
+    thread_map_size = 16384
+
+    # kprobes of the tcp module, only loaded with tcp=True
+    tcp_kprobe_map = {"tcp_send": "tcp_sendmsg", "tcp_rcv": "tcp_rcv_established", "tcp_read": "tcp_cleanup_rbuf"}
+
+    # stage whose measured duration includes the cost of a hookpoint
+    # a boundary hookpoint takes its timestamp first, so its cost lands in the stage it starts
+    # IO hooks fire around both writes and reads, their cost is split evenly
+    hook_stage_map = {
+        "http1_parse_start": ["DownStream Http Parsing"],
+        "http2_parse_start": ["DownStream Http Parsing"],
+        "request_filter_start": ["Request Filters"],
+        "process_start": ["Socket Waiting"],
+        "bind_downstream_upstream": ["Socket Waiting"],
+        "IO_start": ["Write", "Read"],
+        "IO_end": ["Write", "Read"],
+        "record_unique_stream_id": ["Upstream Http Parsing"],
+        "http1_response_filter_start": ["Response Filters"],
+        "http2_response_filter_start": ["Response Filters"],
+        "request_end": [],      # after time_end, not part of any stage
+    }
+
+    # index of map_inserts and map_deletes, with the default number of entries of each map
+    map_list = ["request_map", "unique_stream_id_map", "conn_map"]
+    default_map_sizes = {"request_map": 65536, "unique_stream_id_map": 16384, "conn_map": 16384}
+
+    # length of the request-id prefix shared by all hops of a request, same as the analysis scripts
+    sample_prefix_len = 16
+
+    def __init__(self, transport="perf", ringbuf_pages=1024, aggregate=False, hist="log2",
+                 hist_step_ns=100000, hist_slots=100, by_protocol=False, sample_rate=1, map_sizes=None, sched=False,
+                 tcp=False, level="io"):
+        if level not in self.level_list:
+            raise ValueError(f"Unknown trace level {level}, expected one of {self.level_list}")
+        if tcp and level != "io":
+            raise ValueError("The tcp probes find their request through the IO hookpoints and need level io")
+        self.transport = transport
+        self.ringbuf_pages = ringbuf_pages
+        self.aggregate = aggregate
+        self.hist = hist
+        self.hist_step_ns = hist_step_ns
+        self.hist_slots = hist_slots if hist == "linear" else 64
+        self.by_protocol = by_protocol
+        self.sample_rate = sample_rate
+        self.map_sizes = dict(self.default_map_sizes, **(map_sizes or {}))
+        self.sched = sched
+        self.tcp = tcp
+        self.level = level      # highest level compiled in, the tracer can switch between the levels up to it
+
+    def get_cflags(self):
+        cflags = self.transport_cflags(self.transport, self.ringbuf_pages)
+        cflags += [
+            f"-DREQUEST_MAP_SIZE={self.map_sizes['request_map']}",
+            f"-DSTREAM_MAP_SIZE={self.map_sizes['unique_stream_id_map']}",
+            f"-DCONN_MAP_SIZE={self.map_sizes['conn_map']}",
+        ]
+        if self.sample_rate > 1:
+            cflags += [f"-DSAMPLE_RATE={self.sample_rate}", f"-DSAMPLE_PREFIX_LEN={self.sample_prefix_len}"]
+        if self.level_list.index(self.level) >= self.level_list.index("filters"):
+            cflags.append("-DTRACE_FILTERS")
+        if self.level == "io":
+            cflags.append("-DTRACE_IO")
+        if self.sched or self.tcp:
+            cflags.append(f"-DTHREAD_MAP_SIZE={self.thread_map_size}")
+        if self.sched:
+            cflags.append("-DSCHED")
+        if self.tcp:
+            cflags.append("-DTCP")
+        if self.aggregate:
+            cflags += ["-DAGGREGATE", f"-DHIST_SLOTS={self.hist_slots}"]
+            if self.hist == "linear":
+                cflags += ["-DHIST_LINEAR", f"-DHIST_STEP_NS={self.hist_step_ns}"]
+            if self.by_protocol:
+                cflags.append("-DHIST_BY_PROTOCOL")
+        return cflags
+
+    def function_list(self):
+        # every program function to load, the sched tracepoints and tcp kprobes only when they are compiled in
+        return (self.hook_functions() + (list(self.sched_tracepoint_map) if self.sched else [])
+                + (list(self.tcp_kprobe_map) if self.tcp else []))
+
+    def hook_functions(self, level=None):
+        # hookpoint functions of a level (default: the compiled one), in the order of hook_function_list
+        level_index = self.level_list.index(level or self.level)
+        return [fn_name for fn_name in self.hook_function_list
+                if self.level_list.index(self.hook_level_map[fn_name]) <= level_index]
+
+    def hook_symbols(self, level=None):
+        # {symbol: function} of the hookpoints of a level
+        fn_names = self.hook_functions(level)
+        return {symbol: fn_name for symbol, fn_name in zip(self.hook_symbol_list, self.hook_function_list) if fn_name in fn_names}
+
+    @classmethod
+    def is_sampled(cls, request_id, sample_rate):
+        # same FNV-1a hash as is_sampled() in the BPF program
+        hash = 2166136261
+        for c in request_id.encode()[:cls.sample_prefix_len].ljust(cls.sample_prefix_len, b"\0"):
+            hash = ((hash ^ c) * 16777619) & 0xffffffff
+        return hash % sample_rate == 0
+
+    def slot_upper_bound(self, slot):
+        # largest duration in ns that falls into a histogram slot
+        if self.hist == "linear":
+            return (slot + 1) * self.hist_step_ns
+        return (1 << slot) - 1
+
+    @staticmethod
+    def transport_cflags(transport, ringbuf_pages=1024):
+        # perf: per-cpu perf buffers, ringbuf: one shared BPF ring buffer (kernel >= 5.8)
+        if transport == "ringbuf":
+            return ["-DRINGBUF_OUTPUT", f"-DRINGBUF_PAGES={ringbuf_pages}"]
+        return []
\ No newline at end of file
@@ -0,0 +1,121 @@
+# symbol addresses of an Envoy binary, cached by its ELF build-id so the symbol table is parsed only once
+
+from bcc import BPF
+
+import argparse
+import json
+import os
+import re
+import struct
+
+SYMBOL_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "symbol_cache.json")
+
+SHT_NOTE = 7
+NT_GNU_BUILD_ID = 3
+
+def parse_notes(data, endian):
+    # every note is namesz, descsz, type, then name and desc each padded to 4 bytes
+    offset = 0
+    while offset + 12 <= len(data):
+        namesz, descsz, note_type = struct.unpack_from(endian + "III", data, offset)
+        offset += 12
+        name = data[offset:offset + namesz]
+        offset += (namesz + 3) & ~3
+        desc = data[offset:offset + descsz]
+        offset += (descsz + 3) & ~3
+        if note_type == NT_GNU_BUILD_ID and name.rstrip(b"\x00") == b"GNU":
+            return desc.hex()
+    return None
+
+def read_build_id(path):
+    '''
+    return the GNU build-id of an ELF file, only the section headers and notes are read
+    '''
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if ident[:4] != b"\x7fELF":
+            raise ValueError(f"{path} is not an ELF file")
+        is64 = ident[4] == 2
+        endian = "<" if ident[5] == 1 else ">"
+
+        if is64:
+            f.seek(0x28)
+            e_shoff, = struct.unpack(endian + "Q", f.read(8))
+            f.seek(0x3A)
+        else:
+            f.seek(0x20)
+            e_shoff, = struct.unpack(endian + "I", f.read(4))
+            f.seek(0x2E)
+        e_shentsize, e_shnum = struct.unpack(endian + "HH", f.read(4))
+
+        for i in range(e_shnum):
+            f.seek(e_shoff + i * e_shentsize)
+            if is64:
+                _, sh_type, _, _, sh_offset, sh_size = struct.unpack(endian + "IIQQQQ", f.read(40))
+            else:
+                _, sh_type, _, _, sh_offset, sh_size = struct.unpack(endian + "IIIIII", f.read(24))
+            if sh_type != SHT_NOTE:
+                continue
+            f.seek(sh_offset)
+            build_id = parse_notes(f.read(sh_size), endian)
+            if build_id:
+                return build_id
+
+    # stripped of its build-id, fall back to something which changes with the binary
+    stat = os.stat(path)
+    return f"nobuildid-{stat.st_size}-{int(stat.st_mtime)}"
+
+def load_cache(cache_file=SYMBOL_CACHE):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+def save_cache(cache, cache_file=SYMBOL_CACHE):
+    # write then rename, several tracers may share the file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_file, cache_file)
+
+def find_symbols(binary_path, symbols):
+    '''
+    resolve all symbols in a single pass over the symbol table, return {symbol: address}
+    '''
+    pattern = b"^(" + b"|".join(re.escape(symbol.encode()) for symbol in symbols) + b")$"
+    addresses = {}
+    for name, address in BPF.get_user_functions_and_addresses(binary_path, pattern):
+        addresses.setdefault(name.decode(), address)
+    return addresses
+
+def resolve_symbols(binary_path, symbols, cache_file=SYMBOL_CACHE):
+    '''
+    return ({symbol: address}, cache hit), the symbol table is only parsed for symbols missing from the cache
+    '''
+    build_id = read_build_id(binary_path)
+    cache = load_cache(cache_file)
+    addresses = cache.get(build_id, {})
+
+    missing = [symbol for symbol in symbols if symbol not in addresses]
+    if not missing:
+        return {symbol: addresses[symbol] for symbol in symbols}, True
+
+    print(f"[*] Resolving {len(missing)} symbols of {binary_path} (build-id {build_id})")
+    addresses.update(find_symbols(binary_path, missing))
+    # re-read so entries written by another tracer meanwhile are kept
+    cache = load_cache(cache_file)
+    cache[build_id] = dict(cache.get(build_id, {}), **addresses)
+    save_cache(cache, cache_file)
+    return {symbol: addresses[symbol] for symbol in symbols if symbol in addresses}, False
+
+if __name__ == "__main__":
+    from http_uprobe import HttpUprobe
+
+    parser = argparse.ArgumentParser(description="Fill the symbol cache for an Envoy binary")
+    parser.add_argument("-b", "--binary", type=str, required=True, help="Path of the envoy binary, e.g. /usr/local/bin/envoy")
+    parser.add_argument("-o", "--output", type=str, default=SYMBOL_CACHE, help="Cache file to update")
+    args = parser.parse_args()
+
+    addresses, hit = resolve_symbols(args.binary, HttpUprobe.hook_symbol_list, args.output)
+    print(f"[*] {len(addresses)}/{len(HttpUprobe.hook_symbol_list)} symbols of build-id {read_build_id(args.binary)} in {args.output}"
+          + (" (already cached)" if hit else ""))
@@ -0,0 +1,172 @@
+# layout of request_info_t, shared by envoy_trace.py and the analysis scripts
+
+import ctypes
+import json
+import struct
+import numpy as np
+
+# must match struct request_info_t in http_uprobe.py, align=True reproduces the C padding
+RECORD_FIELDS = [
+    ("request_id", "S37"),
+    ("protocol", "u1"),
+    ("time_http_start", "<u8"),
+    ("time_request_filters_start", "<u8"),
+    ("time_process_start", "<u8"),
+    ("time_response_filters_start", "<u8"),
+    ("time_end", "<u8"),
+    ("upstream_time_http_start", "<u8"),
+    ("write_start_time", "<u8"),
+    ("write_end_time", "<u8"),
+    ("read_start_time", "<u8"),
+    ("read_end_time", "<u8"),
+    ("pid", "<u4"),
+    ("start_tid", "<u4"),
+    ("end_tid", "<u4"),
+    ("start_cpu", "<u2"),
+    ("end_cpu", "<u2"),
+]
+RECORD_DTYPE = np.dtype(RECORD_FIELDS, align=True)
+
+# appended by http_uprobe.py -DTCP: kernel timestamps of the upstream socket, first send, first response segment, last read
+TCP_FIELDS = [
+    ("tcp_send_time", "<u8"),
+    ("tcp_rcv_time", "<u8"),
+    ("tcp_read_time", "<u8"),
+]
+
+# appended by http_uprobe.py -DSCHED, after the TCP fields: cumulative run-queue / sleep ns of the worker thread at each stage boundary
+SCHED_FIELDS = [
+    ("runq_ns", "<u8", (9,)),
+    ("sleep_ns", "<u8", (9,)),
+]
+# record field whose timestamp each snapshot belongs to, in index order
+SCHED_BOUNDARIES = [
+    "time_http_start", "time_request_filters_start", "time_process_start",
+    "write_start_time", "write_end_time", "read_start_time",
+    "upstream_time_http_start", "time_response_filters_start", "time_end",
+]
+
+def record_dtype(sched=False, tcp=False):
+    if not sched and not tcp:
+        return RECORD_DTYPE
+    return np.dtype(RECORD_FIELDS + (TCP_FIELDS if tcp else []) + (SCHED_FIELDS if sched else []), align=True)
+
+# text log key -> record field, in the order the text log has always been written
+LOG_KEYS = [
+    ("X-Request-ID", "request_id"),
+    ("Time HTTP Start", "time_http_start"),
+    ("Time Request Filter Start", "time_request_filters_start"),
+    ("Write Start Time", "write_start_time"),
+    ("Write End Time", "write_end_time"),
+    ("Read Start Time", "read_start_time"),
+    ("Read End Time", "read_end_time"),
+    ("Time Process Start", "time_process_start"),
+    ("Time Response Filter Start", "time_response_filters_start"),
+    ("Time End", "time_end"),
+    ("Response Parse Start", "upstream_time_http_start"),
+    ("Start TID", "start_tid"),
+    ("End TID", "end_tid"),
+    ("Start CPU", "start_cpu"),
+    ("End CPU", "end_cpu"),
+]
+TCP_LOG_KEYS = [
+    ("TCP Send Time", "tcp_send_time"),
+    ("TCP Receive Time", "tcp_rcv_time"),
+    ("TCP Read Time", "tcp_read_time"),
+]
+SCHED_LOG_KEYS = [
+    ("RunQ", "runq_ns"),
+    ("Sleep", "sleep_ns"),
+]
+
+MAGIC = b"MTTRACE1"
+
+def decode_request_id(raw):
+    return raw.split(b'\x00', 1)[0].decode(errors="replace")
+
+class RecordBuffer:
+    '''
+    preallocated array of records, raw perf events are copied straight into it
+    '''
+    def __init__(self, capacity, dtype=RECORD_DTYPE):
+        self.records = np.zeros(capacity, dtype=dtype)
+        self.base = self.records.ctypes.data
+        self.itemsize = dtype.itemsize
+        self.capacity = capacity
+        self.count = 0
+
+    def append(self, data, size):
+        # copy at most one record, a shorter event leaves the tail of the slot zeroed
+        ctypes.memmove(self.base + self.count * self.itemsize, data, min(size, self.itemsize))
+        self.count += 1
+        return self.count >= self.capacity
+
+    def filled(self):
+        return self.records[:self.count]
+
+    def reset(self):
+        # bytewise, assigning 0 to the records would write b"0" into request_id
+        ctypes.memset(self.base, 0, self.count * self.itemsize)
+        self.count = 0
+
+def records_to_lines(records):
+    '''
+    format records exactly like the json lines envoy_trace.py used to write
+    '''
+    lines = []
+    optional_keys = [(key, field) for key, field in TCP_LOG_KEYS + SCHED_LOG_KEYS if field in records.dtype.names]
+    for record in records:
+        log_data = {}
+        for key, field in LOG_KEYS:
+            value = record[field]
+            log_data[key] = decode_request_id(value) if field == "request_id" else int(value)
+        for key, field in optional_keys:
+            log_data[key] = record[field].tolist()
+        lines.append(json.dumps(log_data))
+    return lines
+
+def write_header(f, dtype=RECORD_DTYPE):
+    # magic, header length, then the dtype description so readers do not depend on this file's version
+    header = json.dumps({"descr": [list(field) for field in dtype_descr(dtype)], "itemsize": dtype.itemsize}).encode()
+    f.write(MAGIC)
+    f.write(struct.pack("<I", len(header)))
+    f.write(header)
+
+def dtype_descr(dtype):
+    # array fields keep their shape as a fourth element
+    descr = []
+    for name in dtype.names:
+        field, offset = dtype.fields[name][:2]
+        if field.subdtype:
+            descr.append((name, field.subdtype[0].str, offset, list(field.subdtype[1])))
+        else:
+            descr.append((name, field.str, offset))
+    return descr
+
+def dtype_from_header(header):
+    names, formats, offsets = [], [], []
+    for name, format, offset, *shape in header["descr"]:
+        names.append(name)
+        formats.append((format, tuple(shape[0])) if shape else format)
+        offsets.append(offset)
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": header["itemsize"]})
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary trace file")
+    header_len, = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(header_len))
+    return dtype_from_header(header), len(MAGIC) + 4 + header_len
+
+def read_records(path):
+    '''
+    memory-map a binary trace file written by envoy_trace.py, no record is copied
+    '''
+    with open(path, 'rb') as f:
+        dtype, offset = read_header(f)
+        f.seek(0, 2)
+        size = f.tell()
+    count = (size - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
@@ -0,0 +1,85 @@
+# push batches of binary records to trace_collector.py over TCP instead of writing them inside the pod
+
+import socket
+import struct
+import time
+
+# every frame is type, pod name length, payload length, then the pod name and the payload
+FRAME = struct.Struct("<BHI")
+FRAME_HELLO = 1      # payload: trace_record.write_header() of the sender's record layout
+FRAME_RECORDS = 2    # payload: raw records of that layout
+
+DEFAULT_PORT = 9411
+RECONNECT_INTERVAL = 1.0
+
+def parse_address(address):
+    # "host:port" or "host", the default port is used when it is missing
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+def pack_frame(frame_type, pod, payload):
+    pod = pod.encode()
+    return FRAME.pack(frame_type, len(pod), len(payload)) + pod + payload
+
+def read_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+def read_frame(sock):
+    '''
+    return (type, pod, payload) of the next frame, ConnectionError once the peer is gone
+    '''
+    frame_type, pod_len, payload_len = FRAME.unpack(read_exact(sock, FRAME.size))
+    pod = read_exact(sock, pod_len).decode()
+    return frame_type, pod, read_exact(sock, payload_len)
+
+class TraceSender:
+    '''
+    one connection to the collector, reconnected on failure
+    batches sent while the collector is unreachable are dropped and counted
+    '''
+    def __init__(self, address, header):
+        self.address = parse_address(address)
+        self.header = header
+        self.sock = None
+        self.last_attempt = 0
+        self.dropped = 0
+        self.connect()
+
+    def connect(self):
+        self.last_attempt = time.monotonic()
+        try:
+            self.sock = socket.create_connection(self.address, timeout=5)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.sendall(pack_frame(FRAME_HELLO, "", self.header))
+        except OSError as e:
+            print(f"[!] Failed to connect to collector {self.address[0]}:{self.address[1]}: {e}")
+            self.sock = None
+        return self.sock is not None
+
+    def send(self, pod, records):
+        if self.sock is None:
+            if time.monotonic() - self.last_attempt < RECONNECT_INTERVAL or not self.connect():
+                self.dropped += len(records)
+                return False
+        try:
+            self.sock.sendall(pack_frame(FRAME_RECORDS, pod, records.tobytes()))
+            return True
+        except OSError as e:
+            print(f"[!] Lost connection to collector: {e}")
+            self.sock.close()
+            self.sock = None
+            self.dropped += len(records)
+            return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
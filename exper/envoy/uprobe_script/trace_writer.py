@@ -0,0 +1,153 @@
+# buffered, rotating trace files written from a background thread with a bounded queue
+
+import os
+import queue
+import signal
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 8 << 20
+QUEUE_SIZE = 64
+
+class RotatingWriter:
+    '''
+    append-only trace file with a large write buffer, optional zstd compression and rotation
+    a rotated segment is renamed to <name>.<n><ext> and starts again with `header`
+    '''
+    def __init__(self, path, header=b"", buffer_size=BUFFER_SIZE, compress=False,
+                 rotate_bytes=0, rotate_seconds=0, keep=0):
+        if compress and zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package (pip install zstandard)")
+        self.path = path + ".zst" if compress else path
+        self.header = header
+        self.buffer_size = buffer_size
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.keep = keep
+        # continue the numbering of segments an earlier run left next to path instead of overwriting them
+        self.segments = self.last_segment()
+        self.file = None
+        self.stream = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "ab", buffering=self.buffer_size)
+        # a new zstd frame is appended to an existing file, concatenated frames decompress as one
+        self.stream = zstandard.ZstdCompressor(level=3).stream_writer(self.file) if self.compress else self.file
+        self.written = 0
+        self.opened_at = time.monotonic()
+        if self.file.tell() == 0 and self.header:
+            self.stream.write(self.header)
+
+    def write(self, data):
+        if self.should_rotate():
+            self.rotate()
+        self.stream.write(data)
+        self.written += len(data)
+
+    def should_rotate(self):
+        if self.rotate_bytes and self.written >= self.rotate_bytes:
+            return True
+        return bool(self.rotate_seconds) and time.monotonic() - self.opened_at >= self.rotate_seconds
+
+    def segment_path(self, n):
+        # trace_output.log -> trace_output.1.log, so the analysis scripts still see a .log file
+        directory, base = os.path.split(self.path)
+        name, _, ext = base.partition(".")
+        return os.path.join(directory, f"{name}.{n}.{ext}" if ext else f"{name}.{n}")
+
+    def last_segment(self):
+        directory, base = os.path.split(self.path)
+        name, _, ext = base.partition(".")
+        last = 0
+        for entry in os.listdir(directory or "."):
+            prefix, _, rest = entry.partition(".")
+            n, _, entry_ext = rest.partition(".")
+            if prefix == name and entry_ext == ext and n.isdigit():
+                last = max(last, int(n))
+        return last
+
+    def rotate(self):
+        self.close()
+        self.segments += 1
+        os.replace(self.path, self.segment_path(self.segments))
+        if self.keep and self.segments > self.keep:
+            old_segment = self.segment_path(self.segments - self.keep)
+            if os.path.exists(old_segment):
+                os.remove(old_segment)
+        self.open()
+
+    def flush(self):
+        # make everything written so far visible to readers of the file
+        self.stream.flush()
+        self.file.flush()
+
+    def close(self):
+        if self.compress:
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        self.file.close()
+
+class AsyncWriter:
+    '''
+    hand batches to a single writer thread through a bounded queue
+    a batch which does not fit into the queue is dropped and counted instead of blocking the caller,
+    so is a batch write_batch raised on, the thread keeps draining the queue either way
+    '''
+    def __init__(self, write_batch, on_done=None, queue_size=QUEUE_SIZE):
+        self.write_batch = write_batch
+        self.on_done = on_done
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.failed = 0                 # batches write_batch raised on, also counted in dropped
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def submit(self, batch):
+        try:
+            self.pending.put_nowait(batch)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                break
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                # disk full, a closed socket, a zstd error: a dead thread would leave close() blocked on a full queue
+                if not self.failed:
+                    print(f"[!] Writing a batch failed, dropping it and the ones that fail after it: {e!r}")
+                self.failed += 1
+                self.dropped += 1
+            if self.on_done:
+                self.on_done(batch)
+
+    def close(self):
+        # everything queued before the sentinel is still written, unless the thread is gone and nothing drains the queue
+        while self.thread.is_alive():
+            try:
+                self.pending.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        if self.failed:
+            print(f"[!] {self.failed} batches could not be written")
+
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def install_shutdown_handlers():
+    # SIGTERM (kubectl delete, timeout, kill) takes the same draining path as Ctrl+C
+    signal.signal(signal.SIGTERM, raise_interrupt)
+    signal.signal(signal.SIGINT, raise_interrupt)
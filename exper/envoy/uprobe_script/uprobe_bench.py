@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+# compare the perf buffer and ring buffer transports under a synthetic uprobe load
+
+from bcc import BPF
+
+import argparse
+import multiprocessing
+import os
+import time
+
+from http_uprobe import HttpUprobe
+from envoy_trace import open_transport
+from trace_record import RecordBuffer, RECORD_DTYPE
+
+LIBC = "c"
+SYMBOL = "getpid"
+
+# one event of the same size as request_info_t per getpid() call of the load process
+program = r"""
+    #include <uapi/linux/ptrace.h>
+
+    struct bench_event_t {
+        u64 ts;
+        char payload[EVENT_SIZE - sizeof(u64)];
+    };
+
+    BPF_ARRAY(transport_drops, u64, 1);
+
+#ifdef RINGBUF_OUTPUT
+    BPF_RINGBUF_OUTPUT(trace_events, RINGBUF_PAGES);
+#else
+    BPF_PERF_OUTPUT(trace_events);
+#endif
+
+    int synthetic_event(struct pt_regs *ctx) {
+        struct bench_event_t event = {};
+        event.ts = bpf_ktime_get_ns();
+#ifdef RINGBUF_OUTPUT
+        if (trace_events.ringbuf_output(&event, sizeof(event), BPF_RB_NO_WAKEUP) != 0) {
+            u32 zero = 0;
+            u64 *drops = transport_drops.lookup(&zero);
+            if (drops) {
+                __sync_fetch_and_add(drops, 1);
+            }
+        }
+#else
+        trace_events.perf_submit(ctx, &event, sizeof(event));
+#endif
+        return 0;
+    }
+"""
+
+def generate_load(start, duration, calls):
+    # every os.getpid() goes through libc and hits the uprobe
+    start.wait()
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for _ in range(1000):
+            os.getpid()
+        count += 1000
+    calls.value = count
+
+def run_transport(transport, duration, ringbuf_pages, drain_interval):
+    '''
+    trace the load process over one transport and return its throughput and cost
+    '''
+    cflags = HttpUprobe.transport_cflags(transport, ringbuf_pages) + [f"-DEVENT_SIZE={RECORD_DTYPE.itemsize}"]
+    b = BPF(text=program, cflags=cflags)
+
+    start = multiprocessing.Event()
+    calls = multiprocessing.Value('q', 0)
+    load = multiprocessing.Process(target=generate_load, args=(start, duration, calls))
+    load.start()
+    b.attach_uprobe(name=LIBC, sym=SYMBOL, fn_name="synthetic_event", pid=load.pid)
+
+    # same consumer path as envoy_trace.py, records are copied into a preallocated buffer
+    buffer = RecordBuffer(4096)
+    received = 0
+
+    def event_callback(cpu, data, size):
+        nonlocal received
+        received += 1
+        if buffer.append(data, size):
+            buffer.reset()
+
+    poll, get_lost = open_transport(b, transport, event_callback, drain_interval)
+
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    start.set()
+    while load.is_alive():
+        poll()
+    # drain what is still buffered after the load stopped
+    for _ in range(10):
+        poll()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    result = {
+        "transport": transport,
+        "calls": calls.value,
+        "received": received,
+        "lost": get_lost(),
+        "events_per_sec": received / wall,
+        "tracer_cpu": cpu / wall * 100,
+    }
+    b.cleanup()
+    return result
+
+def print_results(results):
+    header = f"{'Transport':<12}{'Calls':>12}{'Received':>12}{'Lost':>10}{'Events/s':>14}{'Tracer CPU':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['transport']:<12}{r['calls']:>12}{r['received']:>12}{r['lost']:>10}"
+              f"{r['events_per_sec']:>14.0f}{r['tracer_cpu']:>11.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare perf buffer and ring buffer under a synthetic uprobe load")
+    parser.add_argument("--transport", type=str, choices=["perf", "ringbuf", "both"], default="both")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds of load per transport")
+    parser.add_argument("--ringbuf-pages", type=int, default=1024, help="Size of the ring buffer in pages")
+    parser.add_argument("--drain-interval", type=float, default=10, help="Milliseconds between two ring buffer drains")
+    args = parser.parse_args()
+
+    transports = ["perf", "ringbuf"] if args.transport == "both" else [args.transport]
+    results = []
+    for transport in transports:
+        print(f"[*] Running {args.duration}s of synthetic load over {transport}")
+        results.append(run_transport(transport, args.duration, args.ringbuf_pages, args.drain_interval / 1000))
+    print_results(results)
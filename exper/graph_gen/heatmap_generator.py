@@ -1,18 +1,21 @@
 import os
+import json
 import argparse
-import matplotlib.pyplot as plt
 # import seaborn as sns
 import numpy as np
-from collections import defaultdict
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 # from scipy.stats import gaussian_kde
 
+from exper.graph_gen.trace_index import list_trace_files
+from exper.graph_gen.trace_loader import get_workers, iter_file_chunks
+
 result_file = "heatmap_results.txt"
 target_entry_size = [11]
 
 def get_entry(line):
-    parts = line.strip().split(", ")
-    data = {p.split(": ")[0]: p.split(": ")[1] for p in parts}
-    data = {k.strip('"{}'): v.strip('"{}') for k, v in data.items()}
+    data = json.loads(line)
     # print(data)
 
     x_request_id = data['X-Request-ID']
@@ -49,37 +52,6 @@ def get_entry(line):
 
     return x_request_id, entry
 
-def find_all_entries_with_x_request_id(target_x_request_id, directory, entry_lines, entry_file):
-    if entry_lines is None:
-        entry_file = os.path.join(directory, entry_file)
-        with open(entry_file, 'r') as ef:
-            entry_lines = ef.readlines()
-
-    request_entries = []
-    for line in entry_lines[:]:
-        if target_x_request_id in line:
-            _, entry = get_entry(line)
-            request_entries.append(entry)
-    
-    # then find in other files in the directory
-    for root, dirs, files in os.walk(directory):
-        for i, file in enumerate(files):
-            # do not read the entry file again
-            if entry_file and file == os.path.basename(entry_file):
-                continue
-            if file.endswith(".log"):
-                data_file = os.path.join(root, file)
-                with open(data_file) as f:
-                    lines = f.readlines()
-                    for line in lines:
-                        if target_x_request_id in line:
-                            _, entry = get_entry(line)
-                            request_entries.append(entry)
-
-    request_entries.sort(key=lambda x: x["start"])
-
-    return request_entries
-
 def merge_requests(request_entries):
     if len(request_entries) == 0 or len(request_entries) == 1:
         return request_entries
@@ -106,36 +78,66 @@ def merge_requests(request_entries):
     merged_requests.append(current_request)
     return merged_requests     
 
-def generator_dot_file(directory, entry_file):
-    # read entry file
-    entry_file = os.path.join(directory, entry_file)
-    with open(entry_file, 'r') as ef:
-        entry_lines = ef.readlines()
-
-    # discard the first 10% lines and last 10% lines
-    discard_num = int(len(entry_lines) * 0.1)
-    entry_lines = entry_lines[discard_num: -discard_num]
-
-    # already processed x_request_id
-    processed_x_request_ids = set()
-
-    while entry_lines:
-        request_entries = []
-
-        line = entry_lines.pop(0)  # Use current first line
-        x_request_id, entry = get_entry(line)
-        if x_request_id is None:
+def parse_entry_line(line):
+    x_request_id, entry = get_entry(line)
+    if x_request_id is None:
+        return None
+    return entry
+
+def read_pod_logs(directory, trace_files, executor):
+    '''
+    stage 1: read every pod log exactly once, merged across files by request end time
+    the lines are parsed in the process pool, a few chunks per file at a time
+    '''
+    def read_file(file_id, data_file):
+        for entry in iter_file_chunks(executor, data_file, parse_entry_line):
+            yield file_id, entry
+
+    # records are emitted at request end, so every file is already (almost) ordered by end time
+    streams = [read_file(file_id, os.path.join(directory, file)) for file_id, file in enumerate(trace_files)]
+    yield from heapq.merge(*streams, key=lambda record: record[1]["end"])
+
+def group_by_request(records, entry_file_id, horizon):
+    '''
+    stage 2: bucket records by request-id prefix, a request is finalized once none of its hops
+    has been seen for `horizon` ns, so memory only holds the in-flight requests
+    '''
+    in_flight = OrderedDict()
+    for file_id, entry in records:
+        target_x_request_id = entry["x_request_id"][0:16]
+        group = in_flight.pop(target_x_request_id, None)
+        if group is None:
+            group = {"entry": None, "others": []}
+        if file_id == entry_file_id and group["entry"] is None:
+            group["entry"] = entry
+        else:
+            group["others"].append(entry)
+        group["last_seen"] = entry["end"]
+        # re-insert so the dict stays ordered by last seen time
+        in_flight[target_x_request_id] = group
+
+        while in_flight:
+            oldest_x_request_id, oldest = next(iter(in_flight.items()))
+            if entry["end"] - oldest["last_seen"] <= horizon:
+                break
+            in_flight.popitem(last=False)
+            yield oldest_x_request_id, oldest
+
+    for target_x_request_id, group in in_flight.items():
+        yield target_x_request_id, group
+
+def summarize_requests(groups, window):
+    '''
+    stage 3: turn every finalized request seen by the entry pod into a [total_time, overhead] row
+    '''
+    for target_x_request_id, group in groups:
+        entry = group["entry"]
+        if entry is None:
             continue
-        if x_request_id in processed_x_request_ids:
+        if entry["end"] < window[0] or entry["end"] > window[1]:
             continue
 
-        processed_x_request_ids.add(x_request_id)
-
-        request_entries.append(entry)
-        target_x_request_id = x_request_id[0:16]
-
-        # find all entries with the same x_request_id
-        request_entries.extend(find_all_entries_with_x_request_id(target_x_request_id, directory, entry_lines, entry_file))
+        request_entries = [entry] + sorted(group["others"], key=lambda x: x["start"])
         # if len(request_entries) not in target_entry_size:       # discard requests which may not be complete
         #     continue
 
@@ -148,13 +150,65 @@ def generator_dot_file(directory, entry_file):
         # for req in merged_requests:
         #     overhead += (req["process_start"] - req["start"])
         #     overhead += (req["end"] - req["process_end"])
-        
-        result_file_path = os.path.join(os.getcwd(), result_file)
-        with open(result_file_path, 'a') as rf:
-            # print(f"Writing result for X-Request-ID: {target_x_request_id}, Total Time: {total_time}, Overhead: {overhead}")
+        yield target_x_request_id, total_time, overhead
+
+def write_results(rows, result_file_path, buffer_size=1 << 20):
+    '''
+    stage 4: write all rows through one buffered file handle
+    '''
+    count = 0
+    with open(result_file_path, 'a', buffering=buffer_size) as rf:
+        for target_x_request_id, total_time, overhead in rows:
             rf.write(f"{target_x_request_id}, {total_time}, {overhead}\n")
+            count += 1
+    return count
+
+def get_time_window(entry_file, discard_ratio):
+    '''
+    end time range of the entry file without the first and last `discard_ratio` of the run
+    '''
+    with open(entry_file, 'rb') as ef:
+        first_line = ef.readline().decode(errors="replace")
+        # a trace line is a few hundred bytes, the tail of the file is enough to find the last one
+        ef.seek(0, os.SEEK_END)
+        size = ef.tell()
+        ef.seek(max(0, size - (1 << 16)))
+        tail_lines = ef.read().splitlines()
+        last_line = next((line for line in reversed(tail_lines) if line.strip()), b"")
+        last_line = last_line.decode(errors="replace")
+
+    if not first_line.strip() or not last_line.strip():
+        return 0, float("inf")
+    _, first_entry = get_entry(first_line)
+    _, last_entry = get_entry(last_line)
+    if first_entry is None or last_entry is None:
+        return 0, float("inf")
+    discard = (last_entry["end"] - first_entry["end"]) * discard_ratio
+    return first_entry["end"] + discard, last_entry["end"] - discard
+
+def generator_dot_file(directory, entry_file, horizon=5000, discard_ratio=0.1, workers=None):
+    trace_files = list_trace_files(directory)
+    entry_file = os.path.relpath(os.path.join(directory, entry_file), directory)
+    if entry_file not in trace_files:
+        print(f"[!] Entry file {entry_file} not found in {directory}")
+        exit(1)
+
+    # discard the first 10% and last 10% of the run, measured on the entry file
+    window = get_time_window(os.path.join(directory, entry_file), discard_ratio)
+
+    # the whole pipeline is lazy, records flow through it in a single pass
+    result_file_path = os.path.join(os.getcwd(), result_file)
+    with ProcessPoolExecutor(max_workers=get_workers(workers)) as executor:
+        records = read_pod_logs(directory, trace_files, executor)
+        groups = group_by_request(records, trace_files.index(entry_file), horizon * 1e6)
+        rows = summarize_requests(groups, window)
+        count = write_results(rows, result_file_path)
+    print(f"[*] Wrote {count} requests to {result_file_path}")
 
 def generate_heatmap_graph():
+    # only the plot needs matplotlib, the grouping above runs without it
+    import matplotlib.pyplot as plt
+
     result_file_path = os.path.join(os.getcwd(), result_file)
     if not os.path.exists(result_file_path):
         print(f"Result file {result_file_path} does not exist.")
@@ -195,7 +249,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Heatmap Generator")
     parser.add_argument("-d", type=str, dest="dir", required=True, help="Directory containing log files")
     parser.add_argument("-e", type=str, dest="entry_file", help="Entry log file name (default: entry.log)")
+    parser.add_argument("--horizon", type=float, default=5000, help="Finalize a request once no hop is seen for this many ms")
+    parser.add_argument("-j", type=int, dest="workers", help="Number of worker processes (default: one per core)")
     args = parser.parse_args()
 
-    generator_dot_file(args.dir, args.entry_file)
+    generator_dot_file(args.dir, args.entry_file, args.horizon, workers=args.workers)
     # generate_heatmap_graph()
\ No newline at end of file
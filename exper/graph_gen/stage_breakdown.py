@@ -0,0 +1,223 @@
+# vectorized per-stage latency breakdown for every record of a run
+
+import os
+import json
+import argparse
+import numpy as np
+
+from exper.graph_gen.trace_index import list_trace_files
+from exper.graph_gen.trace_store import convert_logs, load_store, source_signature, META_FILE, STORE_VERSION, TRACE_EXTENSIONS
+
+STORE_DIR = ".trace_store"
+
+# (stage, start column, end column), same boundaries as timeline_generator.generate_timeline_graph
+STAGES = [
+    ("DownStream Http Parsing", "time_http_start", "time_request_filter_start"),
+    ("Request Filters", "time_request_filter_start", "time_process_start"),
+    ("Socket Waiting", "time_process_start", "write_start_time"),
+    ("Write", "write_start_time", "write_end_time"),
+    ("Process Time", "write_end_time", "read_start_time"),
+    ("Read", "read_start_time", "response_parse_start"),
+    ("Upstream Http Parsing", "response_parse_start", "time_response_filter_start"),
+    ("Response Filters", "time_response_filter_start", "time_end"),
+]
+
+# envoy_trace.py --tcp: the kernel timestamps split Process Time into the time until the response reached
+# the upstream socket and the time it waited there until the worker read it
+TCP_STAGES = [
+    ("Upstream Round Trip", "write_end_time", "tcp_rcv_time"),
+    ("Socket Queue", "tcp_rcv_time", "read_start_time"),
+]
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+OVERHEAD_EXTENSION = ".overhead"
+
+def compute_stage_durations(store, stages=STAGES):
+    '''
+    return {stage: (durations in ns, valid mask)} for all records at once
+    a stage is valid only if both boundaries were recorded and the interval is not negative
+    '''
+    durations = {}
+    for stage, start_column, end_column in stages:
+        start = store[start_column]
+        end = store[end_column]
+        elapsed = end.astype(np.int64) - start.astype(np.int64)
+        valid = (start != 0) & (end != 0) & (elapsed >= 0)
+        durations[stage] = (elapsed, valid)
+    return durations
+
+def compute_sched_split(store, durations=None):
+    '''
+    return {stage: (run-queue ns, sleep ns, on-cpu ns, valid mask)} from the worker snapshots of envoy_trace.py --sched
+    on-cpu is what is left of the stage, it includes work the worker did for other requests meanwhile
+    a split is valid only if the hooks took a snapshot at both boundaries, records traced without --sched
+    and threads the tracer never saw switch have all-zero snapshots
+    '''
+    if durations is None:
+        durations = compute_stage_durations(store)
+    split = {}
+    for stage, start_column, end_column in STAGES:
+        elapsed, _ = durations[stage]
+        runq_start, runq_end = store[f"runq_{start_column}"], store[f"runq_{end_column}"]
+        sleep_start, sleep_end = store[f"sleep_{start_column}"], store[f"sleep_{end_column}"]
+        runq = np.maximum(runq_end.astype(np.int64) - runq_start.astype(np.int64), 0)
+        sleep = np.maximum(sleep_end.astype(np.int64) - sleep_start.astype(np.int64), 0)
+        valid = ((runq_start != 0) | (sleep_start != 0)) & ((runq_end != 0) | (sleep_end != 0))
+        split[stage] = (runq, sleep, np.maximum(elapsed - runq - sleep, 0), valid)
+    return split
+
+def load_overhead(directory, pods):
+    '''
+    return a (pod, stage) array of the tracer's own cost in ns per request
+    read from the trace_output_<pod>.overhead files of envoy_trace.py --calibrate, pods without one get no correction
+    '''
+    overhead = np.zeros((len(pods), len(STAGES)))
+    found = 0
+    for pod_code, pod in enumerate(pods):
+        path = os.path.join(directory, f"trace_output_{pod}{OVERHEAD_EXTENSION}")
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            stages = json.load(f)["stages"]
+        overhead[pod_code] = [stages.get(stage, 0) for stage, _, _ in STAGES]
+        found += 1
+    print(f"[*] Loaded tracer overhead of {found}/{len(pods)} pods")
+    return overhead
+
+def subtract_overhead(store, durations, overhead):
+    '''
+    remove the tracer's own cost of the record's pod from every stage, a stage never goes below zero
+    '''
+    corrected = dict(durations)
+    for i, (stage, _, _) in enumerate(STAGES):
+        elapsed, valid = durations[stage]
+        cost = np.rint(overhead[:, i]).astype(np.int64)[store.pod]
+        corrected[stage] = (np.maximum(elapsed - cost, 0), valid)
+    return corrected
+
+def stage_percentiles(store, durations=None, percentiles=PERCENTILES, overhead=None, sched=False, tcp=False):
+    '''
+    return one row per (service, stage) with the record count and the requested percentiles in ns
+    with overhead, the percentiles are of the corrected durations and each row also has the mean tracer cost
+    with sched, each row also has the mean run-queue, sleep and on-cpu ns of the stage over the sched_count
+    records with a valid split, NaN if there are none
+    with tcp, the TCP_STAGES follow as extra rows, they have no tracer cost or sched split of their own
+    '''
+    if durations is None:
+        durations = compute_stage_durations(store)
+    split = compute_sched_split(store, durations) if sched else None
+    stages = STAGES
+    if tcp:
+        stages = STAGES + TCP_STAGES
+        durations = dict(durations, **compute_stage_durations(store, TCP_STAGES))
+    if overhead is not None:
+        durations = subtract_overhead(store, durations, overhead)
+
+    service = store.service()
+    groups = [("all", None)] + [(name, service == code) for code, name in enumerate(store.services)]
+
+    rows = []
+    for service_name, in_service in groups:
+        for i, (stage, _, _) in enumerate(stages):
+            elapsed, valid = durations[stage]
+            mask = valid if in_service is None else (valid & in_service)
+            values = elapsed[mask]
+            row = {"service": service_name, "stage": stage, "count": int(values.size)}
+            if overhead is not None:
+                has_cost = values.size and i < len(STAGES)
+                row["tracer"] = float(overhead[:, i][store.pod[mask]].mean()) if has_cost else float("nan")
+            if split is not None:
+                sched_mask = mask & split[stage][3] if stage in split else np.zeros_like(mask)
+                row["sched_count"] = int(sched_mask.sum())
+                for name, j in [("runq", 0), ("sleep", 1), ("oncpu", 2)]:
+                    row[name] = float(split[stage][j][sched_mask].mean()) if row["sched_count"] else float("nan")
+            if values.size:
+                for p, v in zip(percentiles, np.percentile(values, percentiles)):
+                    row[f"p{p}"] = float(v)
+            else:
+                for p in percentiles:
+                    row[f"p{p}"] = float("nan")
+            rows.append(row)
+    return rows
+
+def get_store(directory, rebuild=False):
+    '''
+    load the store of a trace directory, converting the trace files on first use and again whenever one of them changed
+    '''
+    store_dir = os.path.join(directory, STORE_DIR)
+    meta_path = os.path.join(store_dir, META_FILE)
+    trace_files = [os.path.join(directory, file) for file in list_trace_files(directory, TRACE_EXTENSIONS)]
+    if not rebuild and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") == STORE_VERSION and meta.get("files") == source_signature(trace_files):
+            return load_store(store_dir)
+        print("[*] Trace files changed, converting them again...")
+    convert_logs(trace_files, store_dir)
+    return load_store(store_dir)
+
+def print_rows(rows, percentiles=PERCENTILES):
+    with_tracer = bool(rows) and "tracer" in rows[0]
+    with_sched = bool(rows) and "runq" in rows[0]
+    header = f"{'Service':<20}{'Stage':<26}{'Count':>10}" + "".join(f"{'p' + str(p):>12}" for p in percentiles)
+    if with_tracer:
+        header += f"{'Tracer':>12}"
+    if with_sched:
+        header += f"{'Sched':>10}{'On-CPU':>12}{'RunQ':>12}{'Sleep':>12}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        line = f"{row['service']:<20}{row['stage']:<26}{row['count']:>10}"
+        line += "".join(f"{row[f'p{p}'] / 1e6:>9.3f} ms" for p in percentiles)
+        if with_tracer:
+            line += f"{row['tracer'] / 1e3:>9.2f} us"
+        if with_sched:
+            line += f"{row['sched_count']:>10}" + "".join(f"{row[name] / 1e6:>9.3f} ms" for name in ["oncpu", "runq", "sleep"])
+        print(line)
+
+def write_csv(rows, output_file, percentiles=PERCENTILES):
+    with_tracer = bool(rows) and "tracer" in rows[0]
+    with_sched = bool(rows) and "runq" in rows[0]
+    with open(output_file, 'w') as f:
+        f.write("service,stage,count," + ",".join(f"p{p}_ns" for p in percentiles))
+        f.write(",tracer_ns" if with_tracer else "")
+        f.write(",sched_count,oncpu_ns,runq_ns,sleep_ns\n" if with_sched else "\n")
+        for row in rows:
+            f.write(f"{row['service']},{row['stage']},{row['count']},")
+            f.write(",".join(f"{row[f'p{p}']:.0f}" for p in percentiles))
+            f.write(f",{row['tracer']:.0f}" if with_tracer else "")
+            f.write(f",{row['sched_count']},{row['oncpu']:.0f},{row['runq']:.0f},{row['sleep']:.0f}\n" if with_sched else "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage latency breakdown of all traced requests")
+    parser.add_argument("-d", type=str, dest="dir", help="Directory containing trace_output_*.log or .bin files")
+    parser.add_argument("-s", type=str, dest="store", help="Directory of an already converted trace store")
+    parser.add_argument("-o", type=str, dest="output", help="Write the breakdown to this csv file")
+    parser.add_argument("--rebuild", action="store_true", help="Convert the logs again even if a store exists")
+    parser.add_argument("--overhead", action="store_true",
+                        help="Subtract the tracer's own cost measured by envoy_trace.py --calibrate (trace_output_<pod>.overhead)")
+    parser.add_argument("--sched", action="store_true",
+                        help="Split every stage into on-CPU, run-queue and sleep time (traces of envoy_trace.py --sched)")
+    parser.add_argument("--tcp", action="store_true",
+                        help="Add the kernel TCP stages splitting Process Time (traces of envoy_trace.py --tcp)")
+    args = parser.parse_args()
+
+    if not args.dir and not args.store:
+        raise ValueError("Either -d or -s must be provided.")
+
+    store = load_store(args.store) if args.store else get_store(args.dir, args.rebuild)
+    overhead = None
+    if args.overhead:
+        # the calibration files sit next to the trace files the store was converted from
+        overhead_dir = args.dir or os.path.dirname(store.meta["source_files"][0])
+        overhead = load_overhead(overhead_dir, store.pods)
+    if args.sched and "runq_time_end" not in store.columns:
+        raise ValueError("The store has no sched columns, trace with envoy_trace.py --sched (or convert again with --rebuild)")
+    if args.tcp and "tcp_rcv_time" not in store.columns:
+        raise ValueError("The store has no tcp columns, trace with envoy_trace.py --tcp (or convert again with --rebuild)")
+    rows = stage_percentiles(store, overhead=overhead, sched=args.sched, tcp=args.tcp)
+    print_rows(rows)
+    if args.output:
+        write_csv(rows, args.output)
+        print(f"[*] Breakdown written to {args.output}")
@@ -5,58 +5,77 @@ from collections import defaultdict
 import matplotlib.colors as mcolors
 
 import argparse
+import json
 import os
 import re
 
+from exper.graph_gen.trace_index import load_index
+
 base_colors = ["#4caf50", "#2196f3","#ccc8c8", "#d8e91e", "#ff9800","#d8e91e", "#f44336", "#00bcd4"]
+# envoy_trace.py --tcp splits Process Time at the arrival of the response in the upstream socket
+tcp_colors = ["#4caf50", "#2196f3","#ccc8c8", "#d8e91e", "#ff9800", "#9c27b0", "#d8e91e", "#f44336", "#00bcd4"]
+
+stage_names = ["DownStream Http Parsing", "Request Filters", "Socket Waiting", "Write", "Process Time", "Read", "Upstream Http Parsing", "Response Filters"]
+tcp_stage_names = ["DownStream Http Parsing", "Request Filters", "Socket Waiting", "Write", "Upstream Round Trip", "Socket Queue", "Read", "Upstream Http Parsing", "Response Filters"]
+
+def get_boundaries(evt, with_tcp):
+    t = [
+        evt["http_start"],
+        evt["request_filter_start"],
+        evt["filter_end"],
+        evt["write_start"],
+        evt["process_start"],
+        evt["read_start"],
+        evt["upstream_http_start"],
+        evt["response_filter_start"],
+        evt["end"]
+    ]
+    if with_tcp:
+        t.insert(5, evt["tcp_rcv"])
+    return t
 
 def get_events_with_x_request_id(target_x_request_id, data_dir):
     process_timelines = defaultdict(list)
-    # traverse all files in the data_dir
-    for root, dirs, files in os.walk(data_dir):
-        for i, file in enumerate(files):
-            if file.endswith(".log"):
-                data_file = os.path.join(root, file)
-                service_name_re = re.match(r"trace_output_([^-]+)-", file)
-                service_name = service_name_re.group(1) if service_name_re else "unknown"
-                with open(data_file) as f:
-                    for lines in f:
-                        if target_x_request_id in lines:
-                            parts = lines.strip().split(", ")
-                            data = {}
-                            for p in parts:
-                                key, val = p.split(": ", 1)
-                                key = key.strip('"{}')
-                                val = val.strip('"{}')
-                                data[key] = val
-
-                            print(data)
-
-                            pid = i
-                            http_start = int(data["Time HTTP Start"])
-                            request_filter_start = int(data["Time Request Filter Start"])
-                            filter_end = int(data["Time Process Start"])
-                            write_start = int(data["Write Start Time"])
-                            process_start = int(data["Write End Time"])
-                            read_start = int(data["Read Start Time"])
-                            read_end = int(data["Read End Time"])
-                            upstream_http_start = int(data["Response Parse Start"])
-                            response_filter_start = int(data["Time Response Filter Start"])
-                            end = int(data["Time End"])
-
-                            process_timelines[pid].append({
-                                "service_name" : service_name, 
-                                "http_start": http_start,
-                                "request_filter_start": request_filter_start,
-                                "filter_end": filter_end,
-                                "write_start": write_start,
-                                "process_start": process_start,
-                                "read_start": read_start,
-                                "read_end": read_end,
-                                "upstream_http_start": upstream_http_start,
-                                "response_filter_start": response_filter_start,
-                                "end": end
-                            })
+    # locate every hop of the request through the x-request-id index instead of scanning all files
+    trace_index = load_index(data_dir)
+    for file_id, lines in trace_index.lookup(target_x_request_id):
+        file = os.path.basename(trace_index.files[file_id])
+        service_name_re = re.match(r"trace_output_([^-]+)-", file)
+        service_name = service_name_re.group(1) if service_name_re else "unknown"
+
+        # every record is one json line, --sched records carry lists
+        data = json.loads(lines)
+
+        print(data)
+
+        pid = file_id
+        http_start = int(data["Time HTTP Start"])
+        request_filter_start = int(data["Time Request Filter Start"])
+        filter_end = int(data["Time Process Start"])
+        write_start = int(data["Write Start Time"])
+        process_start = int(data["Write End Time"])
+        read_start = int(data["Read Start Time"])
+        read_end = int(data["Read End Time"])
+        upstream_http_start = int(data["Response Parse Start"])
+        response_filter_start = int(data["Time Response Filter Start"])
+        end = int(data["Time End"])
+        tcp_rcv = int(data.get("TCP Receive Time", 0))
+
+        process_timelines[pid].append({
+            "service_name" : service_name, 
+            "http_start": http_start,
+            "request_filter_start": request_filter_start,
+            "filter_end": filter_end,
+            "write_start": write_start,
+            "process_start": process_start,
+            "read_start": read_start,
+            "read_end": read_end,
+            "upstream_http_start": upstream_http_start,
+            "response_filter_start": response_filter_start,
+            "end": end,
+            "tcp_rcv": tcp_rcv
+        })
+    trace_index.close()
     
     # sort events by start time
     for pid, events in process_timelines.items():
@@ -77,7 +96,8 @@ def get_events_with_x_request_id(target_x_request_id, data_dir):
                 "read_end": evt["read_end"],
                 "upstream_http_start": evt["upstream_http_start"],
                 "response_filter_start": evt["response_filter_start"],
-                "end": evt["end"]
+                "end": evt["end"],
+                "tcp_rcv": evt["tcp_rcv"]
             })
 
     all_events.sort(key=lambda x: x["http_start"])
@@ -90,19 +110,13 @@ def generate_timeline_graph(all_events, process_timelines, target_x_request_id):
     gs = gridspec.GridSpec(2, 1, height_ratios=[3, 1])
     ax = plt.subplot(gs[0])
 
+    # only split Process Time when every hop has the kernel timestamp
+    with_tcp = bool(all_events) and all(evt["tcp_rcv"] for evt in all_events)
+    colors = tcp_colors if with_tcp else base_colors
+
     t_start = all_events[-1]["http_start"] if all_events else 0
     for i, evt in enumerate(all_events):
-        t = [
-            evt["http_start"], 
-            evt["request_filter_start"], 
-            evt["filter_end"],
-            evt["write_start"],
-            evt["process_start"], 
-            evt["read_start"],
-            evt["upstream_http_start"], 
-            evt["response_filter_start"], 
-            evt["end"]
-        ]
+        t = get_boundaries(evt, with_tcp)
         pid = evt['pid']
 
         y = i
@@ -110,7 +124,7 @@ def generate_timeline_graph(all_events, process_timelines, target_x_request_id):
         t_rel = [ti - t_start for ti in t]
 
         for j in range(len(t) - 1):
-            color = base_colors[j]
+            color = colors[j]
             elapsed = t_rel[j+1] - t_rel[j]
             if elapsed < 0:
                 print(f"[!] Negative elapsed time detected in {j}.")
@@ -126,43 +140,21 @@ def generate_timeline_graph(all_events, process_timelines, target_x_request_id):
     ax_table.axis("off")
 
     # table_header = ["Service", "DownStream Http Parsing", "Request Filters", "Process Time", "Upstream Http Parsing", "Response Filters", "Overhead Ratio"]
-    table_header = ["Service", "DownStream Http Parsing", "Request Filters", "Socket Waiting", "Write", "Process Time", "Read", "Upstream Http Parsing", "Response Filters"]
+    table_header = ["Service"] + (tcp_stage_names if with_tcp else stage_names)
     table_data = []
 
     legend_labels = table_header[1:]
-    legend_colors = base_colors[:len(legend_labels)] 
+    legend_colors = colors[:len(legend_labels)] 
     legend_patches = [mpatches.Patch(color=color, label=label) for color, label in zip(legend_colors, legend_labels)]
     ax.legend(handles=legend_patches, loc="upper right")
 
     for pid, events in process_timelines.items():
         for evt in events:
-            t = [
-                evt["http_start"], 
-                evt["request_filter_start"],  
-                evt["filter_end"],
-                evt["write_start"], 
-                evt["process_start"], 
-                evt["read_start"], 
-                evt["upstream_http_start"], 
-                evt["response_filter_start"], 
-                evt["end"]
-            ]
+            t = get_boundaries(evt, with_tcp)
             time_intervals = [(t[i+1] - t[i]) / 1e6 for i in range(len(t) - 1)]
             # other_time = time_intervals[0] + time_intervals[1] + time_intervals[3] + time_intervals[4] + time_intervals[5]
             # overhead_ratio =  other_time / time_intervals[2] if time_intervals[2] > 0 else 0
-            table_data.append([
-                str(evt['service_name']),
-                f"{time_intervals[0]:.2f} ms",
-                f"{time_intervals[1]:.2f} ms",
-                f"{time_intervals[2]:.2f} ms",
-                f"{time_intervals[3]:.2f} ms",
-                f"{time_intervals[4]:.2f} ms",
-                f"{time_intervals[5]:.2f} ms",
-                f"{time_intervals[6]:.2f} ms",
-                f"{time_intervals[7]:.2f} ms",
-                # f"{time_intervals[8]:.2f} ms",
-                # f"{overhead_ratio:.2%}"
-            ])
+            table_data.append([str(evt['service_name'])] + [f"{interval:.2f} ms" for interval in time_intervals])
 
     the_table = ax_table.table(cellText=table_data,
                             colLabels=table_header,
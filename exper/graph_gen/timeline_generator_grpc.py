@@ -9,39 +9,42 @@ import matplotlib.colors as mcolors
 import argparse
 import os
 import re
+from functools import partial
+
+from exper.graph_gen.trace_index import list_trace_files
+from exper.graph_gen.trace_loader import load_files
 
 base_colors = ["#4caf50", "#2196f3", "#ff9800"]
 
+def find_events_in_file(target_x_request_id, data_file):
+    events = []
+    with open(data_file) as f:
+        for lines in f:
+            if target_x_request_id in lines:
+                parts = lines.strip().split(", ")
+                data = {p.split(": ")[0]: p.split(": ")[1] for p in parts}
+
+                events.append({
+                    "stream_id": int(data["Stream ID"]),
+                    "start": int(data["Time Start"]),
+                    "filters_end": int(data["Time Request Filter End"]),
+                    "upstream": int(data["Time Upstream Recorded"]),
+                    "end": int(data["Time End"])
+                })
+    return events
+
 def get_events_with_x_request_id(target_x_request_id, data_dir):
     process_timelines = defaultdict(list)
-    # traverse all files in the data_dir
-    for root, dirs, files in os.walk(data_dir):
-        for i, file in enumerate(files):
-            if file.endswith(".log"):
-                service_name_re = re.match(r"trace_output_([^-]+)-", file)
-                service_name = service_name_re.group(1) if service_name_re else "unknown"
-                data_file = os.path.join(root, file)
-                with open(data_file) as f:
-                    for lines in f:
-                        if target_x_request_id in lines:
-                            parts = lines.strip().split(", ")
-                            data = {p.split(": ")[0]: p.split(": ")[1] for p in parts}
-
-                            stream_id = int(data["Stream ID"])
-                            pid = i
-                            start = int(data["Time Start"])
-                            request_filter_end = int(data["Time Request Filter End"])
-                            upstream = int(data["Time Upstream Recorded"])
-                            end = int(data["Time End"])
-
-                            process_timelines[pid].append({
-                                "service_name" : service_name, 
-                                "stream_id": stream_id,
-                                "start": start,
-                                "filters_end": request_filter_end,
-                                "upstream": upstream,
-                                "end": end
-                            })
+    # scan all files in the data_dir in parallel, one worker per file
+    data_files = [os.path.join(data_dir, file) for file in list_trace_files(data_dir)]
+    results = load_files(data_files, partial(find_events_in_file, target_x_request_id))
+    for i, (data_file, events) in enumerate(zip(data_files, results)):
+        file = os.path.basename(data_file)
+        service_name_re = re.match(r"trace_output_([^-]+)-", file)
+        service_name = service_name_re.group(1) if service_name_re else "unknown"
+        pid = i
+        for event in events:
+            process_timelines[pid].append({"service_name" : service_name, **event})
     
     # sort events by start time
     for pid, events in process_timelines.items():
@@ -0,0 +1,165 @@
+# build and query an on-disk x-request-id index over trace_output_*.log files
+
+import os
+import pickle
+import argparse
+from collections import defaultdict
+
+from exper.graph_gen.trace_loader import iter_files
+
+INDEX_FILE = ".trace_index.pkl"
+INDEX_VERSION = 1
+PREFIX_LEN = 16
+
+REQUEST_ID_KEY = b'"X-Request-ID": "'
+
+def list_trace_files(directory, extensions=(".log",)):
+    '''
+    return all trace files under the directory, relative to it and in a stable order
+    '''
+    trace_files = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(extensions):
+                trace_files.append(os.path.relpath(os.path.join(root, file), directory))
+    return trace_files
+
+def extract_request_id(line):
+    '''
+    extract the x-request-id from a raw trace line (bytes) without parsing the whole record
+    '''
+    start = line.find(REQUEST_ID_KEY)
+    if start < 0:
+        return None
+    start += len(REQUEST_ID_KEY)
+    end = line.find(b'"', start)
+    if end <= start:
+        return None
+    return line[start:end].decode(errors="replace")
+
+def file_signature(directory, trace_files):
+    signature = []
+    for file in trace_files:
+        stat = os.stat(os.path.join(directory, file))
+        signature.append((file, stat.st_size, stat.st_mtime_ns))
+    return signature
+
+def index_file(data_file):
+    '''
+    map every request id of one file to the byte offsets of its lines
+    '''
+    offsets = defaultdict(list)
+    offset = 0
+    with open(data_file, 'rb') as f:
+        for line in f:
+            x_request_id = extract_request_id(line)
+            if x_request_id:
+                offsets[x_request_id].append(offset)
+            offset += len(line)
+    return dict(offsets)
+
+def build_index(directory, workers=None):
+    '''
+    walk the directory once and map every request id (and its 16-char prefix) to (file_id, byte offset)
+    '''
+    trace_files = list_trace_files(directory)
+    file_ids = {os.path.join(directory, file): file_id for file_id, file in enumerate(trace_files)}
+
+    # every file is indexed by its own worker, the partial indexes are merged here
+    index = defaultdict(list)
+    for data_file, offsets in iter_files(list(file_ids), index_file, workers):
+        file_id = file_ids[data_file]
+        for x_request_id, file_offsets in offsets.items():
+            locations = [(file_id, offset) for offset in file_offsets]
+            index[x_request_id].extend(locations)
+            prefix = x_request_id[:PREFIX_LEN]
+            if prefix != x_request_id:
+                index[prefix].extend(locations)
+
+    data = {
+        "version": INDEX_VERSION,
+        "files": file_signature(directory, trace_files),
+        "index": dict(index),
+    }
+    with open(os.path.join(directory, INDEX_FILE), 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return data
+
+def load_index(directory, rebuild=False):
+    '''
+    load the persisted index, rebuilding it if it is missing or any trace file changed
+    '''
+    index_path = os.path.join(directory, INDEX_FILE)
+    if not rebuild and os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            data = pickle.load(f)
+        files = [file for file, _, _ in data.get("files", [])]
+        if data.get("version") == INDEX_VERSION and files == list_trace_files(directory) \
+                and data["files"] == file_signature(directory, files):
+            return TraceIndex(directory, data)
+        print("[*] Trace files changed, rebuilding the index...")
+    return TraceIndex(directory, build_index(directory))
+
+class TraceIndex:
+    def __init__(self, directory, data):
+        self.directory = directory
+        self.files = [file for file, _, _ in data["files"]]
+        self.index = data["index"]
+        self.handles = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def get_file_path(self, file_id):
+        return os.path.join(self.directory, self.files[file_id])
+
+    def read_line(self, file_id, offset):
+        f = self.handles.get(file_id)
+        if f is None:
+            f = open(self.get_file_path(file_id), 'rb')
+            self.handles[file_id] = f
+        f.seek(offset)
+        return f.readline().decode(errors="replace")
+
+    def lookup(self, key):
+        '''
+        return [(file_id, line)] for every hop of the request, key is a full request id or a prefix of it
+        '''
+        if key in self.index:
+            return [(file_id, self.read_line(file_id, offset)) for file_id, offset in self.index[key]]
+        if len(key) <= PREFIX_LEN:
+            return []
+
+        # longer than the prefix but not a full id, filter the prefix candidates
+        results = []
+        for file_id, offset in self.index.get(key[:PREFIX_LEN], []):
+            line = self.read_line(file_id, offset)
+            if key in line:
+                results.append((file_id, line))
+        return results
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the x-request-id index of a trace directory")
+    parser.add_argument("-d", type=str, dest="dir", required=True, help="Directory containing log files")
+    parser.add_argument("-x", type=str, dest="x_request_id", help="Print all records of this x-request-id")
+    parser.add_argument("--rebuild", action="store_true", help="Force rebuilding the index")
+    args = parser.parse_args()
+
+    trace_index = load_index(args.dir, args.rebuild)
+    print(f"[*] Indexed {len(trace_index.files)} files, {len(trace_index)} keys")
+    if args.x_request_id:
+        for file_id, line in trace_index.lookup(args.x_request_id):
+            print(f"{trace_index.files[file_id]}: {line.strip()}")
+    trace_index.close()
@@ -0,0 +1,105 @@
+# parallel ingestion of per-pod trace logs with a process pool
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+CHUNK_SIZE = 8 << 20
+
+def get_workers(workers=None):
+    # one worker per core by default
+    return workers or os.cpu_count() or 1
+
+def report_throughput(path, size, elapsed):
+    rate = size / elapsed / 1e6 if elapsed > 0 else float("inf")
+    print(f"[*] Loaded {os.path.basename(path)}: {size / 1e6:.1f} MB in {elapsed:.2f} s ({rate:.1f} MB/s)")
+
+def timed_parse(parse_file, path):
+    start = time.perf_counter()
+    result = parse_file(path)
+    return result, time.perf_counter() - start
+
+def iter_files(trace_files, parse_file, workers=None, report=True):
+    '''
+    parse every file in a worker process and yield (path, result) as soon as each file is done
+    parse_file must be a module-level function (or a functools.partial of one) so it can be pickled
+    '''
+    start = time.perf_counter()
+    total_size = 0
+    with ProcessPoolExecutor(max_workers=get_workers(workers)) as executor:
+        futures = {executor.submit(timed_parse, parse_file, path): path for path in trace_files}
+        for future in as_completed(futures):
+            path = futures[future]
+            result, elapsed = future.result()
+            size = os.path.getsize(path)
+            total_size += size
+            if report:
+                report_throughput(path, size, elapsed)
+            yield path, result
+
+    if report:
+        report_throughput(f"{len(trace_files)} files", total_size, time.perf_counter() - start)
+
+def load_files(trace_files, parse_file, workers=None, report=True):
+    '''
+    same as iter_files but return the results in the order of trace_files
+    '''
+    results = dict(iter_files(trace_files, parse_file, workers, report))
+    return [results[path] for path in trace_files]
+
+def split_chunks(path, chunk_size=CHUNK_SIZE):
+    '''
+    split a file into byte ranges which start and end on line boundaries
+    '''
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def parse_chunk(parse_line, path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    records = []
+    for line in data.decode(errors="replace").splitlines():
+        if not line.strip():
+            continue
+        record = parse_line(line)
+        if record is not None:
+            records.append(record)
+    return records
+
+def iter_ordered(executor, tasks, window):
+    '''
+    submit every (function, *args) of tasks to the pool and yield the results in task order
+    at most `window` tasks are in flight, so memory is bounded by the window and not by the input
+    '''
+    pending = deque()
+    for function, *args in tasks:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def iter_file_chunks(executor, path, parse_line, window=2, report=True):
+    '''
+    parse one file chunk by chunk in the pool and yield its records in file order
+    at most `window` chunks of the file are in flight, so memory stays bounded
+    '''
+    start = time.perf_counter()
+    tasks = ((parse_chunk, parse_line, path, chunk_start, chunk_end) for chunk_start, chunk_end in split_chunks(path))
+    for records in iter_ordered(executor, tasks, window):
+        yield from records
+
+    if report:
+        report_throughput(path, os.path.getsize(path), time.perf_counter() - start)
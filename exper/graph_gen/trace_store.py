@@ -0,0 +1,306 @@
+# convert trace_output_*.log/.bin files into a columnar store and load it back with np.memmap
+
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from exper.envoy.uprobe_script.trace_record import (LOG_KEYS, TCP_LOG_KEYS, SCHED_LOG_KEYS, SCHED_BOUNDARIES,
+                                                    decode_request_id, read_records)
+from exper.graph_gen.trace_index import list_trace_files, file_signature
+from exper.graph_gen.trace_loader import get_workers, iter_ordered, report_throughput, split_chunks, CHUNK_SIZE
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+
+# text log key -> column name, every column is a little-endian u64 file
+TIMESTAMP_COLUMNS = {
+    "Time HTTP Start": "time_http_start",
+    "Time Request Filter Start": "time_request_filter_start",
+    "Time Process Start": "time_process_start",
+    "Write Start Time": "write_start_time",
+    "Write End Time": "write_end_time",
+    "Read Start Time": "read_start_time",
+    "Read End Time": "read_end_time",
+    "Response Parse Start": "response_parse_start",
+    "Time Response Filter Start": "time_response_filter_start",
+    "Time End": "time_end",
+}
+
+# worker thread and cpu of a record, 0 in traces written before the tracer recorded them
+THREAD_COLUMNS = {
+    "Start TID": "start_tid",
+    "End TID": "end_tid",
+    "Start CPU": "start_cpu",
+    "End CPU": "end_cpu",
+}
+
+# envoy_trace.py --tcp: kernel timestamps of the upstream socket, only stored when at least one trace file has them
+TCP_COLUMNS = dict(TCP_LOG_KEYS)
+
+# envoy_trace.py --sched: run-queue / sleep ns of the worker at each stage boundary, runq_<column> and sleep_<column>
+# only stored when at least one trace file has them
+FIELD_COLUMNS = {dict(LOG_KEYS)[key]: name for key, name in TIMESTAMP_COLUMNS.items()}
+SCHED_COLUMNS = {field: [f"{prefix}_{FIELD_COLUMNS[boundary]}" for boundary in SCHED_BOUNDARIES]
+                 for (_, field), prefix in zip(SCHED_LOG_KEYS, ["runq", "sleep"])}
+
+U64 = np.dtype("<u8")
+REQUEST_ID_DTYPE = np.dtype("<u4")
+POD_DTYPE = np.dtype("<u2")
+
+def get_pod_name(file):
+    # trace_output_details-v1-6768f6584f-w9xx5.log -> details-v1-6768f6584f-w9xx5
+    # a rotated segment trace_output_<pod>.3.log belongs to the same pod
+    name = os.path.basename(file).split(".")[0]
+    if name.startswith("trace_output_"):
+        return name[len("trace_output_"):]
+    return name
+
+def get_service_name(pod_name):
+    # same rule as the timeline generator: the part before the first dash
+    service_name_re = re.match(r"([^-]+)-", pod_name)
+    return service_name_re.group(1) if service_name_re else pod_name
+
+TRACE_EXTENSIONS = (".log", ".bin")
+
+def split_records(data_file, chunk_size=CHUNK_SIZE):
+    '''
+    record ranges of a binary trace file of about chunk_size bytes each
+    '''
+    records = read_records(data_file)
+    step = max(1, chunk_size // records.dtype.itemsize)
+    return [(start, min(start + step, len(records))) for start in range(0, len(records), step)]
+
+def parse_binary_chunk(data_file, start, end):
+    '''
+    columns of records [start, end) of a binary trace file written by envoy_trace.py -f binary
+    '''
+    records = read_records(data_file)[start:end]
+    fields = dict(LOG_KEYS)
+    columns = {name: np.asarray(records[fields[key]], dtype=U64) for key, name in TIMESTAMP_COLUMNS.items()}
+    for name in THREAD_COLUMNS.values():
+        columns[name] = np.asarray(records[name], dtype=U64) if name in records.dtype.names else np.zeros(len(records), dtype=U64)
+    for name in TCP_COLUMNS.values():
+        if name in records.dtype.names:
+            columns[name] = np.asarray(records[name], dtype=U64)
+    for field, names in SCHED_COLUMNS.items():
+        if field in records.dtype.names:
+            for i, name in enumerate(names):
+                columns[name] = np.asarray(records[field][:, i], dtype=U64)
+    raw_ids, codes = np.unique(records["request_id"], return_inverse=True)
+    local_ids = [decode_request_id(raw) for raw in raw_ids]
+    return columns, local_ids, np.asarray(codes, dtype=REQUEST_ID_DTYPE), 0
+
+def parse_text_chunk(data_file, start, end):
+    '''
+    parse the lines in bytes [start, end) of a text trace file into numpy columns with a chunk-local request-id dictionary
+    '''
+    with open(data_file, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    values = {name: [] for name in list(TIMESTAMP_COLUMNS.values()) + list(THREAD_COLUMNS.values())}
+    tcp_values = {}
+    sched_values = {}
+    local_ids = {}
+    codes = []
+    skipped = 0
+    for line in chunk.decode(errors="replace").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+            record = [int(data[key]) for key in TIMESTAMP_COLUMNS]
+        except (ValueError, KeyError):
+            skipped += 1
+            continue
+        for name, value in zip(TIMESTAMP_COLUMNS.values(), record):
+            values[name].append(value)
+        for key, name in THREAD_COLUMNS.items():
+            values[name].append(int(data.get(key, 0)))
+        for key, name in TCP_COLUMNS.items():
+            if key in data:
+                tcp_values.setdefault(name, []).append(int(data[key]))
+        for key, field in SCHED_LOG_KEYS:
+            if key in data:
+                sched_values.setdefault(field, []).append(data[key])
+        codes.append(local_ids.setdefault(data.get("X-Request-ID", ""), len(local_ids)))
+
+    columns = {name: np.asarray(column, dtype=U64) for name, column in values.items()}
+    for name, column in tcp_values.items():
+        if len(column) == len(codes):
+            columns[name] = np.asarray(column, dtype=U64)
+    for field, snapshots in sched_values.items():
+        if len(snapshots) != len(codes):
+            continue
+        snapshots = np.asarray(snapshots, dtype=U64)
+        for i, name in enumerate(SCHED_COLUMNS[field]):
+            columns[name] = snapshots[:, i]
+    return columns, list(local_ids), np.asarray(codes, dtype=REQUEST_ID_DTYPE), skipped
+
+def split_trace_file(data_file):
+    # (parse function, file, start, end) of every chunk of a trace file
+    if data_file.endswith(".bin"):
+        return [(parse_binary_chunk, data_file, start, end) for start, end in split_records(data_file)]
+    return [(parse_text_chunk, data_file, start, end) for start, end in split_chunks(data_file)]
+
+def source_signature(trace_files):
+    # (absolute path, size, mtime) of every trace file, as json stores it
+    return [list(entry) for entry in file_signature("", sorted(os.path.abspath(file) for file in trace_files))]
+
+def convert_logs(trace_files, store_dir, workers=None):
+    '''
+    parse the trace files chunk by chunk in a process pool and append every chunk to the columnar store in store_dir
+    only a few chunks per worker are in memory at a time, however large the files are
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    # taken before parsing, a file written to meanwhile makes the next get_store convert again
+    signature = source_signature(trace_files)
+    column_names = list(TIMESTAMP_COLUMNS.values()) + list(THREAD_COLUMNS.values())
+    column_files = {name: open(os.path.join(store_dir, f"{name}.u64"), 'wb') for name in column_names}
+    request_id_file = open(os.path.join(store_dir, "request_id.u32"), 'wb')
+    pod_file = open(os.path.join(store_dir, "pod.u16"), 'wb')
+
+    # rotated segments of one pod share its pod code
+    pods = []
+    for data_file in trace_files:
+        if get_pod_name(data_file) not in pods:
+            pods.append(get_pod_name(data_file))
+    source_files = [os.path.abspath(data_file) for data_file in trace_files]
+    chunks = [chunk for data_file in trace_files for chunk in split_trace_file(data_file)]
+
+    request_ids = {}
+    num_records = 0
+    skipped = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=get_workers(workers)) as executor:
+        results = iter_ordered(executor, chunks, 2 * get_workers(workers))
+        for (_, data_file, _, _), (columns, local_ids, codes, chunk_skipped) in zip(chunks, results):
+            pod_code = pods.index(get_pod_name(data_file))
+            global_codes = np.asarray([request_ids.setdefault(x_request_id, len(request_ids)) for x_request_id in local_ids], dtype=REQUEST_ID_DTYPE)
+            # optional columns are opened when the first chunk has them, zero for the records of chunks which do not
+            for name in columns:
+                if name not in column_files:
+                    column_files[name] = open(os.path.join(store_dir, f"{name}.u64"), 'wb')
+                    column_names.append(name)
+                    np.zeros(num_records, dtype=U64).tofile(column_files[name])
+            for name, f in column_files.items():
+                column = columns.get(name)
+                (column if column is not None else np.zeros(codes.size, dtype=U64)).tofile(f)
+            global_codes[codes].tofile(request_id_file)
+            np.full(codes.size, pod_code, dtype=POD_DTYPE).tofile(pod_file)
+
+            num_records += codes.size
+            skipped += chunk_skipped
+    report_throughput(f"{len(trace_files)} files", sum(os.path.getsize(data_file) for data_file in trace_files),
+                      time.perf_counter() - start)
+
+    for f in list(column_files.values()) + [request_id_file, pod_file]:
+        f.close()
+
+    with open(os.path.join(store_dir, "request_ids.txt"), 'w') as f:
+        for x_request_id in request_ids:
+            f.write(x_request_id)
+            f.write("\n")
+
+    meta = {
+        "version": STORE_VERSION,
+        "num_records": int(num_records),
+        "columns": column_names,
+        "pods": pods,
+        "services": [get_service_name(pod) for pod in pods],
+        "source_files": source_files,
+        "files": signature,
+    }
+    with open(os.path.join(store_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    if skipped:
+        print(f"[!] Skipped {skipped} malformed lines")
+    print(f"[*] Converted {num_records} records from {len(trace_files)} files into {store_dir}")
+    return meta
+
+def open_column(path, dtype, num_records):
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(num_records,))
+
+class TraceStore:
+    '''
+    read-only view of a converted store, every column is a np.memmap so nothing is loaded up front
+    '''
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, META_FILE), 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported trace store version: {meta.get('version')}")
+
+        self.store_dir = store_dir
+        self.meta = meta
+        self.num_records = meta["num_records"]
+        self.pods = meta["pods"]
+        self.services = sorted(set(meta["services"]))
+
+        self.columns = {}
+        for name in meta["columns"]:
+            self.columns[name] = open_column(os.path.join(store_dir, f"{name}.u64"), U64, self.num_records)
+        self.request_id = open_column(os.path.join(store_dir, "request_id.u32"), REQUEST_ID_DTYPE, self.num_records)
+        self.pod = open_column(os.path.join(store_dir, "pod.u16"), POD_DTYPE, self.num_records)
+
+        self._request_ids = None
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def request_ids(self):
+        # the dictionary is only read when the caller needs the actual strings
+        if self._request_ids is None:
+            with open(os.path.join(self.store_dir, "request_ids.txt"), 'r') as f:
+                self._request_ids = [line.rstrip("\n") for line in f]
+        return self._request_ids
+
+    def service(self):
+        # map the pod column to service codes, index into self.services
+        service_of_pod = np.array([self.services.index(s) for s in self.meta["services"]], dtype=POD_DTYPE)
+        return service_of_pod[self.pod]
+
+    def prefix_codes(self, prefix_len=16):
+        '''
+        codes of the request-id prefix, records of the same multi-hop request share one code
+        '''
+        prefixes = {}
+        code_of_request = np.empty(len(self.request_ids), dtype=REQUEST_ID_DTYPE)
+        for code, x_request_id in enumerate(self.request_ids):
+            code_of_request[code] = prefixes.setdefault(x_request_id[:prefix_len], len(prefixes))
+        return code_of_request[self.request_id]
+
+def load_store(store_dir):
+    return TraceStore(store_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Envoy trace logs into a columnar store")
+    parser.add_argument("-d", type=str, dest="dir", help="Directory containing trace_output_*.log or .bin files")
+    parser.add_argument("-f", type=str, dest="file", help="A single trace file, e.g. /tmp/trace_output.log")
+    parser.add_argument("-o", type=str, dest="output", required=True, help="Output directory of the store")
+    parser.add_argument("-j", type=int, dest="workers", help="Number of worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    if not args.dir and not args.file:
+        raise ValueError("Either -d or -f must be provided.")
+
+    if args.dir:
+        trace_files = [os.path.join(args.dir, file) for file in list_trace_files(args.dir, TRACE_EXTENSIONS)]
+    else:
+        trace_files = [args.file]
+    convert_logs(trace_files, args.output, args.workers)
+
+    store = load_store(args.output)
+    print(f"[*] Store has {len(store)} records, {len(store.request_ids)} request ids, {len(store.pods)} pods")
@@ -0,0 +1,117 @@
+# load of every Envoy worker thread: requests, stage latency and cpu migrations per worker
+
+import argparse
+import numpy as np
+
+from exper.graph_gen.stage_breakdown import STAGES, compute_stage_durations, get_store
+from exper.graph_gen.trace_store import load_store
+
+PERCENTILES = [50, 99]
+
+def total_durations(store):
+    start = store["time_http_start"]
+    end = store["time_end"]
+    elapsed = end.astype(np.int64) - start.astype(np.int64)
+    return elapsed, (start != 0) & (end != 0) & (elapsed >= 0)
+
+def worker_rows(store, percentiles=PERCENTILES):
+    '''
+    return one row per (pod, worker tid) with its share of the pod's requests, the stage percentiles in ns
+    and how many of its requests ended on another cpu or another thread than they started on
+    '''
+    durations = compute_stage_durations(store)
+    durations["Total"] = total_durations(store)
+
+    start_tid = np.asarray(store["start_tid"])
+    end_tid = np.asarray(store["end_tid"])
+    start_cpu = np.asarray(store["start_cpu"])
+    end_cpu = np.asarray(store["end_cpu"])
+    pod = np.asarray(store.pod)
+    known = start_tid != 0
+
+    rows = []
+    for pod_code, pod_name in enumerate(store.pods):
+        in_pod = known & (pod == pod_code)
+        pod_requests = int(in_pod.sum())
+        for tid in np.unique(start_tid[in_pod]):
+            mask = in_pod & (start_tid == tid)
+            count = int(mask.sum())
+            row = {
+                "pod": pod_name,
+                "tid": int(tid),
+                "count": count,
+                "share": count / pod_requests,
+                "cpus": int(np.unique(start_cpu[mask]).size),
+                "cpu_migrations": int((start_cpu[mask] != end_cpu[mask]).sum()),
+                "thread_switches": int((end_tid[mask] != tid).sum()),
+            }
+            for stage, (elapsed, valid) in durations.items():
+                values = elapsed[mask & valid]
+                for p, v in zip(percentiles, np.percentile(values, percentiles) if values.size else [np.nan] * len(percentiles)):
+                    row[f"{stage} p{p}"] = float(v)
+            rows.append(row)
+    return rows
+
+def imbalance(rows):
+    '''
+    per pod: number of workers, busiest worker / mean worker requests, and coefficient of variation
+    '''
+    pods = {}
+    for row in rows:
+        pods.setdefault(row["pod"], []).append(row["count"])
+    summary = {}
+    for pod_name, counts in pods.items():
+        counts = np.asarray(counts, dtype=np.float64)
+        summary[pod_name] = {
+            "workers": len(counts),
+            "max_over_mean": float(counts.max() / counts.mean()),
+            "cv": float(counts.std() / counts.mean()),
+        }
+    return summary
+
+def print_report(rows, summary, percentiles=PERCENTILES):
+    header = f"    {'Worker':>10}{'Requests':>12}{'Share':>9}{'CPUs':>6}{'Migrated':>10}{'Switched':>10}"
+    header += "".join(f"{'Total p' + str(p):>14}" for p in percentiles)
+    for pod_name, pod_summary in summary.items():
+        print(f"[*] {pod_name}: {pod_summary['workers']} workers, busiest/mean {pod_summary['max_over_mean']:.2f}, cv {pod_summary['cv']:.2f}")
+        print(header)
+        for row in rows:
+            if row["pod"] != pod_name:
+                continue
+            line = f"    {row['tid']:>10}{row['count']:>12}{row['share'] * 100:>8.1f}%{row['cpus']:>6}"
+            line += f"{row['cpu_migrations'] / row['count'] * 100:>9.1f}%{row['thread_switches'] / row['count'] * 100:>9.1f}%"
+            line += "".join(f"{row[f'Total p{p}'] / 1e6:>11.3f} ms" for p in percentiles)
+            print(line)
+
+def write_csv(rows, output_file, percentiles=PERCENTILES):
+    stages = [stage for stage, _, _ in STAGES] + ["Total"]
+    stage_columns = [f"{stage} p{p}" for stage in stages for p in percentiles]
+    with open(output_file, 'w') as f:
+        f.write("pod,tid,count,share,cpus,cpu_migrations,thread_switches,")
+        f.write(",".join(f"{column.replace(' ', '_').lower()}_ns" for column in stage_columns) + "\n")
+        for row in rows:
+            f.write(f"{row['pod']},{row['tid']},{row['count']},{row['share']:.4f},{row['cpus']},{row['cpu_migrations']},{row['thread_switches']},")
+            f.write(",".join(f"{row[column]:.0f}" for column in stage_columns) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-worker load and latency of every traced Envoy")
+    parser.add_argument("-d", type=str, dest="dir", help="Directory containing trace_output_*.log or .bin files")
+    parser.add_argument("-s", type=str, dest="store", help="Directory of an already converted trace store")
+    parser.add_argument("-o", type=str, dest="output", help="Write one row per worker to this csv file")
+    parser.add_argument("--rebuild", action="store_true", help="Convert the logs again even if a store exists")
+    args = parser.parse_args()
+
+    if not args.dir and not args.store:
+        raise ValueError("Either -d or -s must be provided.")
+
+    store = load_store(args.store) if args.store else get_store(args.dir, args.rebuild)
+    if "start_tid" not in store.columns:
+        raise ValueError("The store has no thread columns, convert it again with --rebuild")
+    rows = worker_rows(store)
+    if not rows:
+        print("[!] No record carries a thread id, the traces were written by a tracer without worker attribution")
+    else:
+        print_report(rows, imbalance(rows))
+    if args.output:
+        write_csv(rows, args.output)
+        print(f"[*] Worker report written to {args.output}")
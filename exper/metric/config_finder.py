@@ -5,34 +5,14 @@ import time
 import argparse
 
 from exper.shell_helper import ShellHelper
-
-def get_achieved_RPS(output):
-    for line in output.splitlines():
-        if "Non-2xx or 3xx responses:" in line:
-            print("[!] Error responses detected during the benchmark. Please check the service health.")
-            exit(1)
-        if "Requests/sec:" in line:
-            parts = line.split("Requests/sec:")
-            if len(parts) > 1:
-                rps_value = parts[1].strip().split()[0]
-                return float(rps_value)
-    return 0.0
-
-def get_p50(output):
-    for line in output.splitlines():
-        if "50.000%" in line:
-            parts = line.split("50.000%")
-            if len(parts) > 1:
-                p50_value = parts[1].strip().split()[0]
-                if p50_value.endswith("ms"):
-                    p50_value = p50_value[:-2]
-                elif p50_value.endswith("s"):
-                    p50_value = float(p50_value[:-1]) * 1000
-                return float(p50_value)
-    return math.inf
+from exper.metric.wrk_parser import parse_wrk_output
+from exper.metric.rps_search import RPSSearch
+from exper.metric.knee import write_curve
+from exper.metric.result_store import ResultStore, RESULT_DB, git_revision
+from exper.metric.drift import DriftDetector, parse_tagged
 
 class KubeConfigFinder:
-    def __init__(self, core, namespace, config_file):
+    def __init__(self, core, namespace, config_file, db_file=RESULT_DB, tag=""):
         self.core = core
         self.thread = math.floor(core * 0.8)
         self.connection = self.thread
@@ -41,8 +21,9 @@ class KubeConfigFinder:
         self.duration = 30
 
         self.rps_start = 100
-        self.rps_step = 100
-        self.end_rps = 700
+        self.coarse_precision = 200     # rps, width of the knee's confidence interval with single 30s runs
+        self.rps_precision = 50         # rps, the same with batches of 3 longer runs around the coarse knee
+        self.max_probes = 12            # benchmark runs per pass before the search gives up on the precision
         
         self.base_p50 = 0
         self.count = 0
@@ -51,6 +32,16 @@ class KubeConfigFinder:
 
         self.shell_helper = ShellHelper(config_file)
         self.basepath = "~/meshtrek/exper/"
+        self.curve_file = f"{namespace}_curve.json"      # measured points and fitted latency curve of the last search
+
+        # runs already in the store are not measured again, a rerun replays the search up to where it stopped
+        self.result_store = ResultStore(db_file)
+        self.tag = tag
+        self.revision = git_revision()
+
+        # reset only when the cluster drifted from its state after the last reset, or every reset_every runs
+        self.probe_duration = 10
+        self.drift = DriftDetector(self.reset_cluster, self.probe_health, self.cluster_state)
 
     def check_p50(self, p50):
         self.count += 1
@@ -66,22 +57,88 @@ class KubeConfigFinder:
             else:
                 self.base_p50 = (self.base_p50 * (self.count - 1) + p50) / self.count
     
+    def run_key(self, rps):
+        return {
+            "mesh": "none",
+            "namespace": self.namespace,
+            "tag": self.tag,
+            "thread": self.thread,
+            "connection": self.connection,
+            "target_rps": rps,
+            "duration": self.duration,
+            "cpu_limit": 0,
+            "revision": self.revision,
+        }
+
     def execute_batch(self, rps):
-        avg_p50, avg_rps = 0, 0
+        avg_p50, avg_p99, avg_rps = 0, 0, 0
         script_path = os.path.join(self.basepath, "./overhead/benchmark.sh")
-        for _ in range(self.batch):
+        key = self.run_key(rps)
+        for i in range(self.batch):
+            run = self.result_store.lookup(key, i)
+            if run is not None:
+                print(f"[*] Reusing stored run {i} at {rps} RPS")
+            else:
+                output = self.shell_helper.execute_script(
+                    self.shell_helper.config["nodes"][0],
+                    self.shell_helper.config["nodes_user"],
+                    script_path,
+                    [str(self.namespace), str(self.thread), str(self.connection), str(rps), str(self.duration)]
+                )
+                report = parse_wrk_output(output)
+                if report.non_2xx:
+                    print(f"[!] {report.non_2xx} error responses detected during the benchmark. Please check the service health.")
+                    exit(1)
+                run = self.result_store.record(key, i, report)
+                self.drift.after_run(report)
+            avg_p50 += run["p50"]
+            avg_p99 += run["p99"]
+            avg_rps += run["achieved_rps"]
+        
+        return avg_p50 / self.batch, avg_rps / self.batch, avg_p99 / self.batch
+    
+    def probe_health(self):
+        # short low-rate run, its p50 is compared to the one right after the last reset
+        output = self.shell_helper.execute_script(
+            self.shell_helper.config["nodes"][0],
+            self.shell_helper.config["nodes_user"],
+            os.path.join(self.basepath, "./overhead/benchmark.sh"),
+            [str(self.namespace), "4", "4", str(self.rps_base), str(self.probe_duration)]
+        )
+        return parse_wrk_output(output)
+
+    def cluster_state(self):
+        # None if a script failed or printed no tagged line, the drift detector then resets the cluster
+        try:
             output = self.shell_helper.execute_script(
                 self.shell_helper.config["nodes"][0],
                 self.shell_helper.config["nodes_user"],
-                script_path,
-                [str(self.namespace), str(self.thread), str(self.connection), str(rps), str(self.duration)]
+                os.path.join(self.basepath, "./metric/script/cluster_operation.sh"),
+                [self.namespace, "health"]
             )
-            avg_p50 += get_p50(output)
-            avg_rps += get_achieved_RPS(output)
-            self.reset_cluster()
-        
-        return avg_p50 / self.batch, avg_rps / self.batch
-    
+            health = parse_tagged(output, "health", 2)
+            if health is None:
+                print(f"[!] Unexpected output of the health check: {output!r}")
+                return None
+            restarts, not_ready = health
+            # the databases live on the workers, reset_database_for_hotel.sh wipes them
+            db_bytes = 0
+            for node in self.shell_helper.config["nodes"][1:]:
+                output = self.shell_helper.execute_script(
+                    node,
+                    self.shell_helper.config["nodes_user"],
+                    os.path.join(self.basepath, "./metric/script/database_size.sh")
+                )
+                size = parse_tagged(output, "db_bytes", 1)
+                if size is None:
+                    print(f"[!] Unexpected output of the database size on {node}: {output!r}")
+                    return None
+                db_bytes += size[0]
+        except subprocess.CalledProcessError as e:
+            print(f"[!] Reading the cluster state failed: {e}")
+            return None
+        return restarts, not_ready, db_bytes
+
     def reset_cluster(self):
         print("[*] Resetting the cluster...")
 
@@ -107,63 +164,67 @@ class KubeConfigFinder:
         )
         time.sleep(30)
 
-    def find_best_RPS(self):
+    def find_best_RPS(self, precision, seeds=None):
+        '''
+        ramp up from rps_start (after the seed targets) until saturation, then measure around the latency knee
+        until its confidence interval is at most precision rps wide, or max_probes runs were spent
+        return the knee, the targets to seed a finer search with and whether the knee was narrowed down to precision,
+        the fitted curve goes to curve_file
+        '''
         print("[*] Testing best RPS without CPU limits...")
 
         # First get the base p50 with low RPS
-        base_p50, _ = self.execute_batch(self.rps_base)
+        base_p50, _, _ = self.execute_batch(self.rps_base)
 
         print(f"[*] Base p50 latency at {self.rps_base} RPS: {base_p50} ms")
         self.check_p50(base_p50)
         print("--------------------------------------------------")
 
-        current_rps = self.rps_start
-        while True:
-            p50, achieved_RPS = self.execute_batch(current_rps)
-
-            print(f"[*] Target RPS: {current_rps}, Achieved RPS: {achieved_RPS}, p50 latency: {p50} ms")
+        search = RPSSearch(self.execute_batch, max_probes=self.max_probes)
+        best_rps, seeds, converged = search.search(self.rps_start, precision, self.rps_base, seeds)
+        write_curve(self.curve_file, search.points(), search.analysis)
+        if converged:
+            print("[*] Finished testing best RPS, result is {} RPS, curve written to {}".format(best_rps, self.curve_file))
+        else:
+            print("[!] Best RPS not found within {} RPS, estimate is {} RPS, curve written to {}".format(precision, best_rps, self.curve_file))
+        return best_rps, seeds, converged
 
-            if achieved_RPS == 0:
-                print("[*] Achieved RPS is 0, stopping test.")
-                break
-
-            if p50 > self.base_p50 * 1.5:
-                print(f"[*] p50 latency {p50} ms exceeded base p50 latency threshold, stopping test.")
-                break
-            
-            current_rps += self.rps_step
-        
-        best_rps = math.floor(achieved_RPS/10) * 10
-        print("[*] Finished testing best RPS, result is {} RPS".format(best_rps))
-        return best_rps
+    def not_converged(self):
+        print(f"[!] The latency knee was not narrowed down to {self.rps_precision} RPS in {self.max_probes} benchmark runs, "
+              f"rerun with a larger --max-probes or --precision, stored runs are reused")
 
     def find_best_config(self):
         # clean up the environment first
         print("[*] Cleaning up the environment...")
-        self.reset_cluster()
+        self.drift.reset("clean start")
 
         # Find best RPS in coarse-grained
         print("[*] Finding best RPS in coarse-grained...")
-        best_rps = self.find_best_RPS()
+        # an unconverged coarse knee still tells the fine pass where to look
+        _, seeds, _ = self.find_best_RPS(self.coarse_precision)
 
         # Find best RPS in fine-grained
         print("[*] Finding best RPS in fine-grained...")
         self.batch = 3
         self.duration = 60
-        self.rps_start = best_rps - 100
-        self.rps_step = 10
-        best_rps = self.find_best_RPS()
+        best_rps, seeds, converged = self.find_best_RPS(self.rps_precision, seeds)
+        if not converged:
+            self.not_converged()
+            self.drift.print_summary()
+            return None
 
-        # Find best thread
+        # Find best thread, a knee that was not narrowed down cannot be compared and ends the search
         print("[*] Finding best thread...")
         best_thread = self.thread
         best_connection = self.connection
         while True:
-            self.rps_start = best_rps
             self.thread += 1
             self.connection = self.thread
             print(f"[*] Testing with thread={self.thread}, connection={self.connection}")
-            achieved_RPS = self.find_best_RPS()
+            achieved_RPS, seeds, converged = self.find_best_RPS(self.rps_precision, seeds)
+            if not converged:
+                self.not_converged()
+                break
             if achieved_RPS > best_rps:
                 best_rps = achieved_RPS
                 best_thread = self.thread
@@ -175,11 +236,13 @@ class KubeConfigFinder:
 
         # Find best connection
         print("[*] Finding best connection...")
-        while True:
-            self.rps_start = best_rps
+        while converged:
             self.connection += 2
             print(f"[*] Testing with thread={self.thread}, connection={self.connection}")
-            achieved_RPS = self.find_best_RPS()
+            achieved_RPS, seeds, converged = self.find_best_RPS(self.rps_precision, seeds)
+            if not converged:
+                self.not_converged()
+                break
             if achieved_RPS > best_rps:
                 best_rps = achieved_RPS
                 best_connection = self.connection
@@ -187,7 +250,12 @@ class KubeConfigFinder:
                 break
         self.connection = best_connection
 
-        print(f"[*] Best configuration found: thread={self.thread}, connection={self.connection}, best RPS={best_rps}")
+        if converged:
+            print(f"[*] Best configuration found: thread={self.thread}, connection={self.connection}, best RPS={best_rps}")
+        else:
+            print(f"[!] Best configuration among the converged searches: thread={self.thread}, connection={self.connection}, best RPS={best_rps}")
+        self.drift.print_summary()
+        return self.thread, self.connection, best_rps
 
     # def do_repeat_measurement(self):
     #     print("[*] Starting repeat measurements...")
@@ -219,9 +287,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find the best Kubernetes configuration")
     parser.add_argument("--core", type=int, required=True, help="Number of CPU cores available")
     parser.add_argument("--namespace", type=str, required=True, help="Kubernetes namespace to use")
+    parser.add_argument("--precision", type=int, default=50, help="Width in RPS of the confidence interval of the latency knee")
+    parser.add_argument("--max-probes", type=int, default=12, help="Benchmark runs per search pass before giving up on the precision")
+    parser.add_argument("--db", type=str, default=RESULT_DB, help="Result store to reuse and record benchmark runs in")
+    parser.add_argument("--tag", type=str, default="", help="Name of the deployment variant the runs are stored under")
+    parser.add_argument("--reset-every", type=int, default=10, help="Reset the cluster at least every this many runs, 1 resets after every run")
     args = parser.parse_args()
 
     config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../config.json")
-    config_finder = KubeConfigFinder(args.core, args.namespace, config_path)
+    config_finder = KubeConfigFinder(args.core, args.namespace, config_path, args.db, args.tag)
+    config_finder.rps_precision = args.precision
+    config_finder.max_probes = args.max_probes
+    config_finder.drift.reset_every = args.reset_every
     # config_finder.do_repeat_measurement()
     config_finder.find_best_config()
\ No newline at end of file
@@ -0,0 +1,121 @@
+# decide between benchmark runs whether the cluster has drifted from its freshly reset state
+
+import re
+import time
+
+def parse_tagged(output, tag, count):
+    '''
+    the count integers of the last "<tag>: ..." line in the output of a remote script, None if there is no such line
+    ssh, sudo and kubectl may print warnings around it
+    '''
+    values = None
+    for line in output.splitlines():
+        match = re.fullmatch(rf"\s*{tag}:((?:\s+\d+){{{count}}})\s*", line)
+        if match:
+            values = [int(value) for value in match.group(1).split()]
+    return values
+
+class DriftDetector:
+    '''
+    reset() resets the cluster and records a baseline, after_run(report) resets again only on drift or every reset_every runs
+    probe() runs a short low-rate benchmark and returns its WrkReport
+    cluster_state() returns (pod restarts, pods not running, database bytes or None if there is no database to watch),
+    or None if the cluster could not be read, which counts as drift
+    '''
+    def __init__(self, reset_cluster, probe, cluster_state, reset_every=10, p50_ratio=1.5, db_growth=1.25):
+        self.reset_cluster = reset_cluster
+        self.probe = probe
+        self.cluster_state = cluster_state
+        self.reset_every = reset_every
+        self.p50_ratio = p50_ratio          # probe p50 over the baseline probe p50
+        self.db_growth = db_growth          # database size over its size after the reset
+        self.baseline = None                # (probe p50, restarts, db bytes) right after the last reset
+        self.runs = 0                       # benchmark runs since the last reset
+
+        self.resets = 0
+        self.skipped = 0
+        self.reset_time = 0.0               # s spent in reset_cluster
+        self.check_time = 0.0               # s spent in probes and cluster state checks
+
+    def measure_baseline(self):
+        start = time.time()
+        report = self.probe()
+        state = self.cluster_state()
+        self.check_time += time.time() - start
+        if state is None:
+            # the next drift check resets again, as it cannot tell what changed since this one
+            print("[!] Could not read the cluster state right after the reset")
+            state = (None, 0, None)
+        restarts, not_ready, db_bytes = state
+        if not_ready or report.errors():
+            print(f"[!] {not_ready} pods not running and {report.errors()} errors right after the reset")
+        self.baseline = (report.percentile(50), restarts, db_bytes)
+        print(f"[*] Baseline after the reset: probe p50 {self.baseline[0]} ms"
+              + (f", {restarts} pod restarts" if restarts is not None else "")
+              + (f", database {db_bytes / (1 << 20):.1f} MB" if db_bytes is not None else ""))
+
+    def reset(self, reason):
+        print(f"[*] Resetting the cluster: {reason}")
+        start = time.time()
+        self.reset_cluster()
+        self.reset_time += time.time() - start
+        self.resets += 1
+        self.runs = 0
+        self.measure_baseline()
+
+    def drift(self, report):
+        '''
+        reasons the cluster drifted since the last reset, empty if it did not
+        '''
+        reasons = []
+        if report.non_2xx:
+            reasons.append(f"{report.non_2xx} non-2xx responses in the run")
+
+        start = time.time()
+        probe = self.probe()
+        state = self.cluster_state()
+        self.check_time += time.time() - start
+
+        base_p50, base_restarts, base_db_bytes = self.baseline
+        p50 = probe.percentile(50)
+        if p50 > base_p50 * self.p50_ratio:
+            reasons.append(f"probe p50 {p50} ms over {self.p50_ratio}x the baseline {base_p50} ms")
+        if probe.non_2xx:
+            reasons.append(f"{probe.non_2xx} non-2xx responses in the probe")
+        if state is None:
+            reasons.append("unreadable cluster state")
+            return reasons
+        if base_restarts is None:
+            reasons.append("no cluster state from the last reset")
+            return reasons
+        restarts, not_ready, db_bytes = state
+        if restarts > base_restarts:
+            reasons.append(f"{restarts - base_restarts} pod restarts")
+        if not_ready:
+            reasons.append(f"{not_ready} pods not running")
+        if db_bytes is not None and base_db_bytes and db_bytes > base_db_bytes * self.db_growth:
+            reasons.append(f"database grew from {base_db_bytes / (1 << 20):.1f} MB to {db_bytes / (1 << 20):.1f} MB")
+        return reasons
+
+    def after_run(self, report):
+        self.runs += 1
+        if self.baseline is None:
+            self.reset("no baseline yet")
+        elif self.runs >= self.reset_every:
+            self.reset(f"{self.runs} runs since the last reset")
+        else:
+            reasons = self.drift(report)
+            if reasons:
+                self.reset(", ".join(reasons))
+            else:
+                self.skipped += 1
+                print(f"[*] No drift after {self.runs} runs, reset skipped")
+
+    def print_summary(self):
+        # every skipped reset would have taken as long as the average of the ones that ran
+        if self.resets == 0:
+            return
+        per_reset = self.reset_time / self.resets
+        saved = self.skipped * per_reset - self.check_time
+        print(f"[*] {self.resets} resets ({per_reset:.0f}s each), {self.skipped} skipped, "
+              f"{self.check_time:.0f}s of health checks, {saved:.0f}s of wall-clock time saved")
@@ -0,0 +1,122 @@
+# latency-throughput knee of a service from a few benchmark points
+
+import json
+import numpy as np
+
+CAPACITY_GRID = 400         # candidate capacities between the highest achieved rps and 4x of it
+BOOTSTRAP_ROUNDS = 200
+CI_LEVEL = 95
+CURVE_POINTS = 200
+
+def fit_latency_curve(x, y):
+    '''
+    fit latency = a + b / (capacity - rps), a queue in front of a fixed latency, a, b >= 0
+    least squares on the relative error, so the few points far past the knee do not dominate
+    return (a, b, capacity), None if there are less than 3 distinct rps
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if np.unique(x).size < 3 or np.any(y <= 0):
+        return None
+
+    capacities = np.geomspace(x.max() * 1.001, x.max() * 4, CAPACITY_GRID)
+    z = 1.0 / (capacities[:, None] - x[None, :])      # capacity x point
+    w2 = 1.0 / (y * y)
+    # weighted normal equations of [1, z] . [a, b] ~ y for every capacity at once
+    s11 = np.sum(w2)
+    s12 = np.sum(w2 * z, axis=1)
+    s22 = np.sum(w2 * z * z, axis=1)
+    t1 = np.sum(w2 * y)
+    t2 = np.sum(w2 * z * y, axis=1)
+    det = s11 * s22 - s12 * s12
+    with np.errstate(divide="ignore", invalid="ignore"):
+        full = ((s22 * t1 - s12 * t2) / det, (s11 * t2 - s12 * t1) / det)
+    # when the full fit makes a or b negative, the best fit is on the boundary with a single parameter
+    candidates = [full, (np.zeros_like(s22), t2 / s22), (np.full_like(s22, t1 / s11), np.zeros_like(s22))]
+
+    best = None
+    for a, b in candidates:
+        error = np.sum(w2 * (a[:, None] + b[:, None] * z - y) ** 2, axis=1)
+        error = np.where(np.isfinite(error) & (a >= 0) & (b >= 0), error, np.inf)
+        i = int(np.argmin(error))
+        if np.isfinite(error[i]) and (best is None or error[i] < best[0]):
+            best = (error[i], float(a[i]), float(b[i]), float(capacities[i]))
+    return best[1:] if best else None
+
+def curve_latency(params, rps):
+    a, b, capacity = params
+    return a + b / (capacity - np.asarray(rps, dtype=np.float64))
+
+def power_knee(params):
+    '''
+    rps of maximum power (throughput / latency), the knee of the curve as Kleinrock and Jain define it
+    half the capacity for a pure queue, closer to the capacity the more of the latency is fixed
+    '''
+    a, b, capacity = params
+    if b == 0:
+        return capacity
+    if a == 0:
+        return capacity / 2
+    s = a * capacity + b
+    return (s - np.sqrt(b * s)) / a
+
+def bootstrap_knee(x, y, rounds=BOOTSTRAP_ROUNDS, level=CI_LEVEL, seed=0):
+    '''
+    (low, high) of the knee over refits on points resampled with replacement, None if no resample can be fitted
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    knees = []
+    for _ in range(rounds):
+        sample = rng.integers(0, x.size, x.size)
+        params = fit_latency_curve(x[sample], y[sample])
+        if params is not None:
+            knees.append(power_knee(params))
+    if not knees:
+        return None
+    tail = (100 - level) / 2
+    low, high = np.percentile(knees, [tail, 100 - tail])
+    return float(low), float(high)
+
+def analyze_curve(points, metrics=("p50", "p99")):
+    '''
+    points: [{"target", "achieved", "p50", "p99"}], latencies in ms
+    return {metric: {a, b, capacity, knee, ci}} plus the knee and ci of the metric with the lowest knee
+    every metric is fitted against the achieved rps, so points past saturation pin the capacity
+    '''
+    analysis = {"points": len(points)}
+    x = [point["achieved"] for point in points]
+    for metric in metrics:
+        y = [point[metric] for point in points]
+        params = fit_latency_curve(x, y)
+        if params is None:
+            continue
+        analysis[metric] = {
+            "a": params[0],
+            "b": params[1],
+            "capacity": params[2],
+            "knee": float(power_knee(params)),
+            "ci": bootstrap_knee(x, y),
+        }
+    fitted = [analysis[metric] for metric in metrics if metric in analysis]
+    if fitted:
+        limiting = min(fitted, key=lambda fit: fit["knee"])
+        analysis["knee"] = limiting["knee"]
+        analysis["ci"] = limiting["ci"]
+    return analysis
+
+def write_curve(output_file, points, analysis, metrics=("p50", "p99")):
+    '''
+    json with the measured points, the fits and the fitted curves up to the highest achieved rps
+    '''
+    curve = {}
+    if points:
+        rps = np.linspace(0, max(point["achieved"] for point in points), CURVE_POINTS)
+        curve["rps"] = rps.tolist()
+        for metric in metrics:
+            if metric in analysis:
+                fit = analysis[metric]
+                curve[metric] = curve_latency((fit["a"], fit["b"], fit["capacity"]), rps).tolist()
+    with open(output_file, 'w') as f:
+        json.dump({"points": points, "analysis": analysis, "curve": curve}, f, indent=4)
@@ -0,0 +1,55 @@
+# scatter of achieved rps against p50 of the runs the config finders stored, one series per mesh variant
+
+import argparse
+import matplotlib.pyplot as plt
+
+from exper.metric.result_store import ResultStore, RESULT_DB
+
+# (mesh, tag, label, color) of every series, mesh and tag are what the config finders stored the runs under
+SERIES = [
+    ("none", "", "No Mesh", "black"),
+    ("istio", "", "Istio", "green"),
+    ("istio", "no-egress", "Istio(no egress)", "red"),
+    ("ambient", "1P", "Ambient 1P", "orange"),
+    ("ambient", "3P", "Ambient 3P", "purple"),
+    ("ambient", "4P", "Ambient 4P", "brown"),
+    ("ambient", "each-service", "Ambient(each service)", "blue"),
+]
+
+# read achieved rps and p50 of every stored run
+def read_store(store, namespace, mesh, tag, revision=None):
+    filters = {"namespace": namespace, "mesh": mesh, "tag": tag}
+    if revision:
+        filters["revision"] = revision
+    rows = store.query(**filters)
+    return [row["achieved_rps"] for row in rows], [row["p50"] for row in rows]
+
+# Plotting scatter points of every series
+def plot_scatter(store, namespace, revision=None):
+    plt.figure(figsize=(10, 6))
+    plt.xlim(100, 350)
+    plt.ylim(25, 80)
+    for mesh, tag, label, color in SERIES:
+        rps, p50 = read_store(store, namespace, mesh, tag, revision)
+        if not rps:
+            print(f"[!] No runs of {label} ({mesh}, tag '{tag}') in the store")
+            continue
+        plt.scatter(rps, p50, color=color, label=label, alpha=0.8)
+
+    plt.xlabel('Achieved RPS')
+    plt.ylabel('P50 Latency (ms)')
+    plt.title('RPS vs P50 Latency')
+    plt.legend()
+    plt.grid(True)
+    plt.savefig('rps_vs_p50.png')
+    plt.show()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot the benchmark runs in a result store")
+    parser.add_argument("--db", type=str, default=RESULT_DB, help="Result store written by the config finders")
+    parser.add_argument("--namespace", type=str, default="bookinfo", help="Namespace the runs were measured on")
+    parser.add_argument("--revision", type=str, help="Only runs of this git revision")
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    plot_scatter(store, args.namespace, args.revision)
@@ -0,0 +1,122 @@
+# sqlite store of every benchmark run of the config finders, so reruns skip measured points and crashed searches resume
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import subprocess
+
+# at the repository root, whichever directory the config finders are started from
+RESULT_DB = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "meshtrek_results.db"))
+# a run is measured again only if one of these changes
+KEY_COLUMNS = ("mesh", "namespace", "tag", "thread", "connection", "target_rps", "duration", "cpu_limit", "revision")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    mesh TEXT NOT NULL,
+    namespace TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    thread INTEGER NOT NULL,
+    connection INTEGER NOT NULL,
+    target_rps INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    cpu_limit INTEGER NOT NULL,
+    revision TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    achieved_rps REAL NOT NULL,
+    p50 REAL NOT NULL,
+    p99 REAL NOT NULL,
+    non_2xx INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    report TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (mesh, namespace, tag, thread, connection, target_rps, duration, cpu_limit, revision, run)
+)
+'''
+
+def git_revision():
+    '''
+    commit of this checkout, "unknown" outside of a git repository
+    '''
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+class ResultStore:
+    '''
+    one row per wrk2 run, run is the index of the run in its batch
+    every row is committed as soon as it is recorded, a killed search loses at most the run in flight
+    '''
+    def __init__(self, db_file=RESULT_DB):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def lookup(self, key, run):
+        '''
+        stored row of run in the batch of key, None if it was not measured yet
+        '''
+        where = " AND ".join(f"{column} = ?" for column in KEY_COLUMNS)
+        row = self.conn.execute(f"SELECT * FROM runs WHERE {where} AND run = ?",
+                                [key[column] for column in KEY_COLUMNS] + [run]).fetchone()
+        return dict(row) if row else None
+
+    def record(self, key, run, report):
+        '''
+        store the WrkReport of run in the batch of key, replacing an older measurement, and return the row
+        '''
+        row = {column: key[column] for column in KEY_COLUMNS}
+        row.update({
+            "run": run,
+            "achieved_rps": report.requests_per_sec,
+            "p50": report.percentile(50),
+            "p99": report.percentile(99),
+            "non_2xx": report.non_2xx,
+            "errors": report.errors(),
+            "report": json.dumps(report.to_dict()),
+            "created": time.time(),
+        })
+        self.conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                          list(row.values()))
+        self.conn.commit()
+        return row
+
+    def query(self, **filters):
+        '''
+        rows matching every column = value in filters, ordered by target rps and time
+        '''
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+        rows = self.conn.execute(f"SELECT * FROM runs WHERE {where} ORDER BY target_rps, created",
+                                 list(filters.values())).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the benchmark runs in a result store")
+    parser.add_argument("--db", type=str, default=RESULT_DB, help="Result store written by the config finders")
+    parser.add_argument("--namespace", type=str, help="Only runs of this namespace")
+    parser.add_argument("--mesh", type=str, help="Only runs of this mesh type, none for no mesh")
+    parser.add_argument("--tag", type=str, help="Only runs with this tag")
+    parser.add_argument("--revision", type=str, help="Only runs of this git revision")
+    args = parser.parse_args()
+
+    filters = {column: getattr(args, column) for column in ("namespace", "mesh", "tag", "revision") if getattr(args, column) is not None}
+    store = ResultStore(args.db)
+    rows = store.query(**filters)
+    print(f"    {'Mesh':<10}{'Namespace':<12}{'Tag':<12}{'Thread':>7}{'Conn':>6}{'Target':>8}{'Dur':>5}{'CPU':>5}{'Rev':>9}{'Run':>4}"
+          f"{'Achieved':>10}{'p50 ms':>10}{'p99 ms':>10}{'Errors':>8}")
+    for row in rows:
+        print(f"    {row['mesh']:<10}{row['namespace']:<12}{row['tag']:<12}{row['thread']:>7}{row['connection']:>6}"
+              f"{row['target_rps']:>8}{row['duration']:>5}{row['cpu_limit']:>5}{row['revision']:>9}{row['run']:>4}"
+              f"{row['achieved_rps']:>10.2f}{row['p50']:>10.3f}{row['p99']:>10.3f}{row['errors']:>8}")
+    print(f"[*] {len(rows)} runs in {args.db}")
+    store.close()
@@ -0,0 +1,141 @@
+# find the saturation RPS with a handful of benchmark runs: exponential ramp-up, then runs around the fitted latency knee
+
+import math
+
+from exper.metric.knee import analyze_curve
+
+class RPSSearch:
+    '''
+    measure(rps) runs one benchmark batch at target rps and returns (p50 in ms, achieved rps, p99 in ms)
+    the ramp-up stops once wrk2 achieves less than min_ratio of a target, then the knee of the latency curve
+    (metric/knee.py) is measured around until its confidence interval is narrower than the precision
+    converged tells whether it got there within max_probes runs, the knee of a search that did not is only an estimate
+    '''
+    def __init__(self, measure, min_ratio=0.9, max_probes=12, rps_round=10, min_points=5):
+        self.measure = measure
+        self.min_ratio = min_ratio
+        self.max_probes = max_probes
+        self.rps_round = rps_round
+        self.min_points = min_points        # resampling a few points gives the same fit over and over, a too narrow interval
+        self.probes = {}        # target rps -> {target, achieved, p50, p99}
+        self.analysis = {}
+        self.converged = False
+
+    def round(self, rps):
+        return int(round(rps / self.rps_round)) * self.rps_round
+
+    def is_saturated(self, point):
+        return point["achieved"] == 0 or point["achieved"] < point["target"] * self.min_ratio
+
+    def probe(self, rps):
+        if rps not in self.probes:
+            p50, achieved_RPS, p99 = self.measure(rps)
+            self.probes[rps] = {"target": rps, "achieved": achieved_RPS, "p50": p50, "p99": p99}
+            print(f"[* Result] Target RPS: {rps}, Achieved RPS: {achieved_RPS}, p50 latency: {p50} ms, p99 latency: {p99} ms"
+                  + (" (saturated)" if self.is_saturated(self.probes[rps]) else ""))
+        return self.is_saturated(self.probes[rps])
+
+    def out_of_probes(self):
+        if len(self.probes) >= self.max_probes:
+            print(f"[!] Stopping the search after {self.max_probes} benchmark runs")
+            return True
+        return False
+
+    def points(self):
+        # runs wrk2 reported latencies for, in target order
+        return [point for _, point in sorted(self.probes.items()) if math.isfinite(point["p50"]) and math.isfinite(point["p99"])]
+
+    def bracket_saturation(self, rps_start, floor):
+        '''
+        double the target until one saturates, or halve it down to floor if the lowest one already does
+        the fit needs points on both sides of the knee
+        '''
+        rps = max(self.probes) * 2 if self.probes else rps_start
+        while not any(self.is_saturated(point) for point in self.probes.values()):
+            self.probe(rps)
+            if self.out_of_probes():
+                return
+            rps *= 2
+        rps = min(self.probes)
+        while all(self.is_saturated(point) for point in self.probes.values()) and rps // 2 > floor:
+            rps = self.round(rps // 2)
+            self.probe(rps)
+            if self.out_of_probes():
+                return
+        # three parameters need three points, fill the gap below the saturation
+        while len(self.points()) < 3 and not self.out_of_probes():
+            saturated = min(rps for rps, point in self.probes.items() if self.is_saturated(point))
+            below = [rps for rps in self.probes if rps < saturated]
+            rps = self.round((max(below) + saturated) / 2) if below else self.round(saturated / 2)
+            if rps in self.probes:
+                rps = self.round(min(self.probes) / 2)
+            if rps <= floor or rps in self.probes:
+                return
+            self.probe(rps)
+
+    def next_target(self):
+        # the knee first, then the ends of its interval, then the middle of the widest gap between measured targets
+        ci = self.analysis.get("ci") or ()
+        targets = sorted(self.probes)
+        gaps = sorted(zip([0] + targets, targets), key=lambda gap: gap[1] - gap[0], reverse=True)
+        for rps in [self.analysis["knee"], *ci] + [(low + high) / 2 for low, high in gaps]:
+            rps = self.round(rps)
+            if rps > 0 and rps not in self.probes:
+                return rps
+        return None
+
+    def refine(self, precision):
+        '''
+        refit after every run and stop once the confidence interval of the knee is at most precision rps wide
+        the next run goes to the knee or an end of its interval
+        '''
+        while True:
+            self.analysis = analyze_curve(self.points())
+            if "knee" not in self.analysis:
+                print("[!] Not enough points to fit the latency curve")
+                return False
+            ci = self.analysis["ci"]
+            if ci and ci[1] - ci[0] <= precision and self.analysis["points"] >= self.min_points:
+                return True
+            if self.out_of_probes():
+                return False
+            rps = self.next_target()
+            if rps is None:
+                return False
+            self.probe(rps)
+
+    def best_rps(self):
+        # the knee, or the highest achieved rps of an unsaturated run if no curve could be fitted
+        if "knee" in self.analysis:
+            rps = self.analysis["knee"]
+        else:
+            rps = max([point["achieved"] for point in self.probes.values() if not self.is_saturated(point)], default=0)
+        return math.floor(rps / self.rps_round) * self.rps_round
+
+    def seeds(self):
+        # knee, its interval and the lowest saturated target: where a finer search with longer runs starts
+        targets = set()
+        if "knee" in self.analysis:
+            targets.add(self.round(self.analysis["knee"]))
+            targets.update(self.round(rps) for rps in self.analysis["ci"] or ())
+        saturated = [rps for rps, point in self.probes.items() if self.is_saturated(point)]
+        if saturated:
+            targets.add(min(saturated))
+        return sorted(rps for rps in targets if rps > 0)
+
+    def search(self, rps_start, precision, floor=0, seeds=None):
+        '''
+        return (best rps, seeds for a finer search, whether the knee was narrowed down to precision)
+        seeds are measured first, floor is a target known to be unsaturated
+        '''
+        for rps in seeds or []:
+            self.probe(rps)
+        self.bracket_saturation(rps_start, floor)
+        self.converged = self.refine(precision)
+
+        if "knee" in self.analysis:
+            ci = self.analysis["ci"]
+            interval = f"{ci[0]:.0f}-{ci[1]:.0f}" if ci else "unknown"
+            print(f"[*] Latency knee at {self.analysis['knee']:.0f} RPS ({interval}) after {len(self.probes)} benchmark runs"
+                  + ("" if self.converged else f", not narrowed down to {precision} RPS"))
+        return self.best_rps(), self.seeds(), self.converged
@@ -56,10 +56,20 @@ delete() {
     sleep 5
 }
 
+health() {
+    # "health: <restarts> <pods not running>" of the namespace, e.g. "health: 3 1", nothing if kubectl fails
+    local pods
+    pods=$(kubectl get pods -n "$NAMESPACE" --no-headers 2>/dev/null) || return 1
+    printf '%s' "$pods" | \
+        awk '{restarts += $4; if ($3 != "Running") not_ready++} END {print "health:", restarts + 0, not_ready + 0}'
+}
+
 if [ "$OPERATION" == "launch" ]; then
     launch
 elif [ "$OPERATION" == "delete" ]; then
     delete
+elif [ "$OPERATION" == "health" ]; then
+    health
 else
     echo "Unsupported operation: $OPERATION"
     exit 1
@@ -0,0 +1,2 @@
+# "db_bytes: <bytes>" of the hotel databases on this node, 0 if they do not exist yet
+sudo du -sb /data/volumes 2>/dev/null | awk '{bytes = $1} END {print "db_bytes:", bytes + 0}'
@@ -0,0 +1,199 @@
+# parse the stdout of a wrk2 -L run (overhead/benchmark.sh) in one pass
+
+import re
+import json
+import math
+import argparse
+
+TIME_UNITS = {"us": 1e-3, "ms": 1.0, "s": 1e3, "m": 60e3, "h": 3600e3}     # -> ms
+SIZE_UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30, "TB": 1 << 40}     # -> bytes
+COUNT_UNITS = {"k": 1e3, "M": 1e6, "G": 1e9}
+
+VALUE_RE = re.compile(r"^(-?[\d.]+)([a-zA-Z]*)$")
+RUNNING_RE = re.compile(r"Running (\S+) test @ (\S+)")
+THREADS_RE = re.compile(r"(\d+) threads and (\d+) connections")
+SUMMARY_RE = re.compile(r"^\s*([\d.]+)%\s+(\S+)\s*$")
+SPECTRUM_RE = re.compile(r"^\s*([\d.]+)\s+([\d.]+)\s+(\d+)\s+(\S+)\s*$")
+HIST_RE = re.compile(r"(\w[\w ]*?)\s*=\s*([\d.]+)")
+TOTAL_RE = re.compile(r"(\d+) requests in (\S+), (\S+) read")
+SOCKET_RE = re.compile(r"(connect|read|write|timeout) (\d+)")
+
+def parse_value(text, units):
+    '''
+    "1.23ms" -> 1.23 with TIME_UNITS, "41.99KB" -> 42997.76 with SIZE_UNITS, a bare number is returned as it is
+    '''
+    match = VALUE_RE.match(text.strip())
+    if not match:
+        raise ValueError(f"Cannot parse wrk2 value {text}")
+    number, unit = match.groups()
+    if not unit:
+        return float(number)
+    if unit not in units:
+        raise ValueError(f"Unknown unit {unit} in wrk2 value {text}")
+    return float(number) * units[unit]
+
+class WrkReport:
+    '''
+    one wrk2 run, latencies in ms and sizes in bytes
+    percentiles / spectrum are the HdrHistogram recorded latency, which wrk2 corrects for coordinated omission
+    uncorrected_percentiles is only filled with --u_latency
+    '''
+    def __init__(self):
+        self.url = None
+        self.duration = None            # s, as requested with -d
+        self.threads = 0
+        self.connections = 0
+        self.latency = {}               # avg, stdev, max of the thread stats
+        self.req_per_thread = {}        # avg, stdev, max of Req/Sec per thread
+        self.percentiles = {}           # {percent: ms} of the latency distribution
+        self.uncorrected_percentiles = {}
+        self.spectrum = []              # [(ms, percentile in 0..1, total count)] of the detailed spectrum
+        self.histogram = {}             # mean, stddeviation, max, total count, buckets, subbuckets
+        self.requests = 0
+        self.elapsed = 0.0              # s
+        self.bytes_read = 0.0
+        self.socket_errors = {"connect": 0, "read": 0, "write": 0, "timeout": 0}
+        self.non_2xx = 0
+        self.requests_per_sec = 0.0
+        self.transfer_per_sec = 0.0
+
+    def percentile(self, p):
+        '''
+        latency in ms at percent p, math.inf if the run has no latency data
+        the summary lines are used when they have p, otherwise the smallest spectrum value reaching p as in HdrHistogram
+        '''
+        if p in self.percentiles:
+            return self.percentiles[p]
+        for value, percentile, _ in self.spectrum:
+            if percentile * 100 >= p:
+                return value
+        return math.inf
+
+    def errors(self):
+        return self.non_2xx + sum(self.socket_errors.values())
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "duration": self.duration,
+            "threads": self.threads,
+            "connections": self.connections,
+            "latency": self.latency,
+            "req_per_thread": self.req_per_thread,
+            "percentiles": self.percentiles,
+            "uncorrected_percentiles": self.uncorrected_percentiles,
+            "spectrum": self.spectrum,
+            "histogram": self.histogram,
+            "requests": self.requests,
+            "elapsed": self.elapsed,
+            "bytes_read": self.bytes_read,
+            "socket_errors": self.socket_errors,
+            "non_2xx": self.non_2xx,
+            "requests_per_sec": self.requests_per_sec,
+            "transfer_per_sec": self.transfer_per_sec,
+        }
+
+def parse_stats(parts, units):
+    # "Latency  1.23ms  456.78us  5.67ms  70.00%"
+    return {"avg": parse_value(parts[0], units), "stdev": parse_value(parts[1], units), "max": parse_value(parts[2], units)}
+
+def parse_line(report, line, section):
+    '''
+    fill report from one line and return the section the next line is in
+    '''
+    stripped = line.strip()
+    if not stripped:
+        return section
+
+    # the percentile lines only count inside their section, everything else is recognized by its prefix
+    if section in ("percentiles", "uncorrected"):
+        match = SUMMARY_RE.match(stripped)
+        if match:
+            target = report.percentiles if section == "percentiles" else report.uncorrected_percentiles
+            target[float(match.group(1))] = parse_value(match.group(2), TIME_UNITS)
+            return section
+    elif section == "spectrum":
+        match = SPECTRUM_RE.match(stripped)
+        if match:
+            # the spectrum is printed in ms
+            report.spectrum.append((float(match.group(1)), float(match.group(2)), int(match.group(3))))
+            return section
+
+    if stripped.startswith("Running"):
+        match = RUNNING_RE.search(stripped)
+        if match:
+            report.duration = parse_value(match.group(1), TIME_UNITS) / 1e3
+            report.url = match.group(2)
+    elif stripped.startswith("Latency Distribution"):
+        return "percentiles"
+    elif stripped.startswith("Uncorrected Latency"):
+        return "uncorrected"
+    elif stripped.startswith("Detailed Percentile spectrum"):
+        return "spectrum"
+    elif stripped.startswith("Latency "):
+        report.latency = parse_stats(stripped.split()[1:], TIME_UNITS)
+    elif stripped.startswith("Req/Sec"):
+        report.req_per_thread = parse_stats(stripped.split()[1:], COUNT_UNITS)
+    elif stripped.startswith("#["):
+        for key, value in HIST_RE.findall(stripped):
+            report.histogram[key.strip().lower()] = float(value)
+    elif stripped.startswith("Socket errors:"):
+        for name, count in SOCKET_RE.findall(stripped):
+            report.socket_errors[name] = int(count)
+    elif stripped.startswith("Non-2xx or 3xx responses:"):
+        report.non_2xx = int(stripped.split(":")[1])
+    elif stripped.startswith("Requests/sec:"):
+        report.requests_per_sec = float(stripped.split(":")[1])
+    elif stripped.startswith("Transfer/sec:"):
+        report.transfer_per_sec = parse_value(stripped.split(":")[1], SIZE_UNITS)
+    else:
+        match = THREADS_RE.search(stripped)
+        if match:
+            report.threads, report.connections = int(match.group(1)), int(match.group(2))
+        match = TOTAL_RE.search(stripped)
+        if match:
+            report.requests = int(match.group(1))
+            report.elapsed = parse_value(match.group(2), TIME_UNITS) / 1e3
+            report.bytes_read = parse_value(match.group(3), SIZE_UNITS)
+            return None
+    return section
+
+def parse_wrk_reports(output):
+    '''
+    return one WrkReport per "Running ... test" in the output, e.g. a log of several benchmark.sh runs
+    '''
+    reports = []
+    report = None
+    section = None
+    for line in output.splitlines():
+        if RUNNING_RE.search(line):
+            report = WrkReport()
+            reports.append(report)
+            section = None
+        if report is not None:
+            section = parse_line(report, line, section)
+    return reports
+
+def parse_wrk_output(output):
+    '''
+    WrkReport of the last run in the output, an empty report if there is none
+    '''
+    reports = parse_wrk_reports(output)
+    return reports[-1] if reports else WrkReport()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse the output of wrk2 -L")
+    parser.add_argument("-f", "--file", type=str, required=True, help="File with the output of one or more wrk2 runs")
+    parser.add_argument("-o", "--output", type=str, help="Write every run as one json line to this file")
+    args = parser.parse_args()
+
+    with open(args.file, "r") as f:
+        reports = parse_wrk_reports(f.read())
+    for i, report in enumerate(reports):
+        print(f"[*] Run {i}: {report.requests_per_sec:.2f} req/s, p50 {report.percentile(50):.3f} ms, "
+              f"p99 {report.percentile(99):.3f} ms, p99.9 {report.percentile(99.9):.3f} ms, {report.errors()} errors")
+    if args.output:
+        with open(args.output, "w") as f:
+            for report in reports:
+                f.write(json.dumps(report.to_dict()) + "\n")
+        print(f"[*] {len(reports)} runs written to {args.output}")
@@ -1,26 +1,29 @@
 import os
 import argparse
 
-# get line by keyword
+from exper.metric.wrk_parser import parse_wrk_reports
+
+# wrk2 lines the keyword can name besides a percentile such as "99.000%"
+KEYWORD_FIELDS = {
+    "Requests/sec:": "requests_per_sec",
+    "Transfer/sec:": "transfer_per_sec",
+    "Non-2xx or 3xx responses:": "non_2xx",
+}
+
+# get the value of the keyword in every wrk2 run of the file
 def get_line_by_keyword(file, keyword):
-    res_lines = []
     if not os.path.exists(file):
         print(f"File {file} does not exist")
         exit(1)
-    
+
     with open(file, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            if keyword in line:
-                # remove all the blank spaces before the keyword
-                line = line.split(keyword)[1].strip()
-                # get the number part of the line
-                if "ms" in line:
-                    line = line.split("ms")[0]
-                elif "s" in line:
-                    line = float(line.split("s")[0]) * 1000
-                res_lines.append(line)
-    return res_lines
+        reports = parse_wrk_reports(f.read())
+    if keyword.endswith("%"):
+        return [report.percentile(float(keyword[:-1])) for report in reports]
+    if keyword not in KEYWORD_FIELDS:
+        print(f"Unknown keyword {keyword}, expected a percentile like 99.000% or one of {list(KEYWORD_FIELDS)}")
+        exit(1)
+    return [getattr(report, KEYWORD_FIELDS[keyword]) for report in reports]
 
 def generate_result(datas):
     res = []
@@ -0,0 +1,111 @@
+from exper.metric.drift import DriftDetector, parse_tagged
+from exper.metric.wrk_parser import WrkReport
+
+def make_report(p50, non_2xx=0):
+    report = WrkReport()
+    report.percentiles = {50.0: p50}
+    report.non_2xx = non_2xx
+    return report
+
+class FakeCluster:
+    '''
+    the probe p50 and cluster state the detector sees next, and how often it reset
+    '''
+    def __init__(self):
+        self.p50 = 5.0
+        self.probe_non_2xx = 0
+        self.state = (0, 0, 100 << 20)
+        self.reset_state = self.state       # what a reset brings the cluster back to
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+        self.p50 = 5.0
+        self.state = self.reset_state
+
+    def probe(self):
+        return make_report(self.p50, self.probe_non_2xx)
+
+    def cluster_state(self):
+        return self.state
+
+def make_detector(cluster, reset_every=10):
+    detector = DriftDetector(cluster.reset, cluster.probe, cluster.cluster_state, reset_every=reset_every)
+    detector.reset("clean start")
+    return detector
+
+def test_parse_tagged():
+    assert parse_tagged("health: 3 1", "health", 2) == [3, 1]
+    assert parse_tagged("db_bytes: 4096\n", "db_bytes", 1) == [4096]
+    # warnings around the tagged line, the last one wins
+    output = "Warning: Permanently added '10.10.1.1'\nhealth: 0 0\nhealth: 2 1\nW1018 12:00:00 client-side throttling 5 6"
+    assert parse_tagged(output, "health", 2) == [2, 1]
+
+def test_parse_tagged_rejects_malformed_replies():
+    assert parse_tagged("", "health", 2) is None
+    assert parse_tagged("3 1", "health", 2) is None
+    assert parse_tagged("health: 3", "health", 2) is None
+    assert parse_tagged("health: 3 1 4", "health", 2) is None
+    assert parse_tagged("health: -1 x", "health", 2) is None
+    assert parse_tagged("db_bytes: 12", "health", 2) is None
+
+def test_no_drift_skips_the_reset():
+    cluster = FakeCluster()
+    detector = make_detector(cluster)
+    for _ in range(3):
+        detector.after_run(make_report(10.0))
+    assert cluster.resets == 1
+    assert detector.skipped == 3
+
+def test_resets_every_n_runs():
+    cluster = FakeCluster()
+    detector = make_detector(cluster, reset_every=3)
+    for _ in range(6):
+        detector.after_run(make_report(10.0))
+    assert cluster.resets == 3
+    assert detector.skipped == 4
+
+def test_drift_reasons():
+    cluster = FakeCluster()
+    detector = make_detector(cluster)
+    assert detector.drift(make_report(10.0)) == []
+    assert detector.drift(make_report(10.0, non_2xx=4)) == ["4 non-2xx responses in the run"]
+
+    cluster.p50 = 8.0
+    cluster.probe_non_2xx = 1
+    cluster.state = (2, 1, 200 << 20)
+    assert detector.drift(make_report(10.0)) == [
+        "probe p50 8.0 ms over 1.5x the baseline 5.0 ms",
+        "1 non-2xx responses in the probe",
+        "2 pod restarts",
+        "1 pods not running",
+        "database grew from 100.0 MB to 200.0 MB",
+    ]
+
+def test_drift_resets_and_takes_a_new_baseline():
+    cluster = FakeCluster()
+    detector = make_detector(cluster)
+    cluster.state = (1, 0, 100 << 20)
+    detector.after_run(make_report(10.0))
+    assert cluster.resets == 2
+    assert detector.baseline == (5.0, 0, 100 << 20)
+
+def test_unreadable_cluster_state_is_drift():
+    cluster = FakeCluster()
+    detector = make_detector(cluster)
+    cluster.state = cluster.reset_state = None
+    assert detector.drift(make_report(10.0)) == ["unreadable cluster state"]
+    # the reset cannot read it either, so the next check resets again
+    detector.after_run(make_report(10.0))
+    assert cluster.resets == 2
+    assert detector.baseline == (5.0, None, None)
+    cluster.state = (0, 0, 100 << 20)
+    assert detector.drift(make_report(10.0)) == ["no cluster state from the last reset"]
+
+def test_no_database_to_watch():
+    cluster = FakeCluster()
+    cluster.state = (0, 0, None)
+    detector = DriftDetector(cluster.reset, cluster.probe, cluster.cluster_state)
+    detector.measure_baseline()
+    cluster.state = (0, 0, None)
+    assert detector.drift(make_report(10.0)) == []
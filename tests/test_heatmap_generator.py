@@ -0,0 +1,63 @@
+from exper.graph_gen.heatmap_generator import group_by_request, summarize_requests
+
+ENTRY_FILE = 0
+
+def hop(request, hop_id, start, end):
+    # the hops of one request share the first 16 characters of their x-request-id
+    return {"x_request_id": f"{request:016d}-{hop_id}", "start": start, "end": end}
+
+def test_groups_hops_by_request_id_prefix():
+    records = [
+        (1, hop(1, "b", 20, 40)),
+        (ENTRY_FILE, hop(1, "a", 10, 50)),
+        (2, hop(2, "b", 60, 70)),
+        (ENTRY_FILE, hop(2, "a", 55, 80)),
+    ]
+    groups = dict(group_by_request(iter(records), ENTRY_FILE, horizon=1000))
+    assert list(groups) == [f"{1:016d}", f"{2:016d}"]
+    assert groups[f"{1:016d}"]["entry"] == records[1][1]
+    assert groups[f"{1:016d}"]["others"] == [records[0][1]]
+    assert groups[f"{2:016d}"]["last_seen"] == 80
+
+def test_second_entry_hop_is_another_hop():
+    # a request that passes the entry pod twice keeps its first hop there as the entry
+    records = [(ENTRY_FILE, hop(1, "b", 20, 30)), (ENTRY_FILE, hop(1, "a", 10, 50))]
+    (_, group), = group_by_request(iter(records), ENTRY_FILE, horizon=1000)
+    assert group["entry"]["end"] == 30
+    assert [entry["end"] for entry in group["others"]] == [50]
+
+def test_finalizes_requests_past_the_horizon():
+    seen = []
+    def records():
+        for record in [(ENTRY_FILE, hop(1, "a", 0, 10)), (ENTRY_FILE, hop(2, "a", 5, 15)), (ENTRY_FILE, hop(3, "a", 100, 120))]:
+            seen.append(record[1]["end"])
+            yield record
+
+    groups = group_by_request(records(), ENTRY_FILE, horizon=50)
+    # request 1 and 2 are out once a record more than 50 ns after their last hop arrives, before the stream ends
+    assert next(groups)[0] == f"{1:016d}"
+    assert next(groups)[0] == f"{2:016d}"
+    assert seen == [10, 15, 120]
+    assert [request for request, _ in groups] == [f"{3:016d}"]
+
+def test_late_hop_keeps_a_request_in_flight():
+    records = [
+        (ENTRY_FILE, hop(1, "a", 0, 10)),
+        (ENTRY_FILE, hop(2, "a", 5, 40)),
+        (1, hop(1, "b", 30, 45)),
+        (ENTRY_FILE, hop(3, "a", 50, 80)),
+    ]
+    groups = list(group_by_request(iter(records), ENTRY_FILE, horizon=50))
+    # the late hop moves request 1 behind request 2, requests come out ordered by their last hop
+    assert [request for request, _ in groups] == [f"{2:016d}", f"{1:016d}", f"{3:016d}"]
+    assert len(groups[1][1]["others"]) == 1
+
+def test_summarize_requests_keeps_entry_requests_in_the_window():
+    records = [
+        (ENTRY_FILE, hop(1, "a", 10, 50)),
+        (1, hop(2, "b", 60, 70)),
+        (ENTRY_FILE, hop(3, "a", 100, 300)),
+    ]
+    rows = list(summarize_requests(group_by_request(iter(records), ENTRY_FILE, horizon=1000), window=(0, 200)))
+    # request 2 never reached the entry pod, request 3 ended after the window
+    assert rows == [(f"{1:016d}", 40, 0)]
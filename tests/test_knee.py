@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+import pytest
+
+from exper.metric.knee import analyze_curve, bootstrap_knee, curve_latency, fit_latency_curve, power_knee, write_curve
+
+PARAMS = (20.0, 3000.0, 5300.0)     # a ms, b ms * rps, capacity rps
+
+def curve_points(params=PARAMS, rps=(200, 800, 1600, 3200, 4000, 4500, 5000, 5141)):
+    return np.array(rps, dtype=np.float64), curve_latency(params, rps)
+
+def test_fit_recovers_the_curve():
+    x, y = curve_points()
+    a, b, capacity = fit_latency_curve(x, y)
+    # the capacity comes from a geometric grid about 0.35% apart
+    assert capacity == pytest.approx(PARAMS[2], rel=5e-3)
+    assert a == pytest.approx(PARAMS[0], rel=0.05)
+    assert b == pytest.approx(PARAMS[1], rel=0.1)
+    assert np.allclose(curve_latency((a, b, capacity), x), y, rtol=0.01)
+
+def test_fit_needs_three_distinct_points():
+    assert fit_latency_curve([100, 100, 200], [10, 11, 12]) is None
+    assert fit_latency_curve([100, 200, 300], [10, 0, 12]) is None
+
+def test_fit_keeps_a_and_b_non_negative():
+    # latency falling with load would need b < 0
+    a, b, _ = fit_latency_curve([100, 200, 300, 400], [12, 11, 10, 9])
+    assert a >= 0 and b >= 0
+
+def test_power_knee_is_the_maximum_of_throughput_over_latency():
+    rps = np.linspace(1, PARAMS[2] - 1, 100000)
+    power = rps / curve_latency(PARAMS, rps)
+    assert power_knee(PARAMS) == pytest.approx(rps[np.argmax(power)], abs=1)
+
+def test_power_knee_limits():
+    # a pure queue peaks at half its capacity, a fixed latency at the capacity
+    assert power_knee((0.0, 3000.0, 5300.0)) == 2650
+    assert power_knee((20.0, 0.0, 5300.0)) == 5300
+
+def test_bootstrap_interval_contains_the_knee():
+    x, y = curve_points()
+    low, high = bootstrap_knee(x, y)
+    assert low <= power_knee(PARAMS) + 10 and high >= power_knee(PARAMS) - 10
+    assert high - low < 100
+    assert bootstrap_knee(x, y) == (low, high)
+
+def test_analyze_curve_takes_the_lower_knee():
+    # the p99 saturates earlier, the points stop below its capacity
+    x, p50s = curve_points(rps=(200, 800, 1600, 2400, 3200, 3600, 3900))
+    _, p99s = curve_points((20.0, 3000.0, 4000.0), x)
+    points = [{"target": rps, "achieved": rps, "p50": p50, "p99": p99} for rps, p50, p99 in zip(x, p50s, p99s)]
+    analysis = analyze_curve(points)
+    assert analysis["points"] == len(points)
+    assert analysis["p99"]["knee"] < analysis["p50"]["knee"]
+    assert analysis["knee"] == analysis["p99"]["knee"]
+    assert analysis["ci"] == analysis["p99"]["ci"]
+
+def test_analyze_curve_without_enough_points():
+    analysis = analyze_curve([{"target": 100, "achieved": 100, "p50": 10, "p99": 20}])
+    assert analysis == {"points": 1}
+
+def test_write_curve(tmp_path):
+    x, y = curve_points()
+    points = [{"target": rps, "achieved": rps, "p50": p50, "p99": p50 * 2} for rps, p50 in zip(x.tolist(), y.tolist())]
+    analysis = analyze_curve(points)
+    output_file = tmp_path / "curve.json"
+    write_curve(output_file, points, analysis)
+    with open(output_file) as f:
+        curve = json.load(f)
+    assert curve["points"] == points
+    assert curve["analysis"]["knee"] == analysis["knee"]
+    assert len(curve["curve"]["rps"]) == len(curve["curve"]["p50"]) == len(curve["curve"]["p99"])
@@ -0,0 +1,62 @@
+import json
+
+from exper.metric.result_store import ResultStore
+from exper.metric.wrk_parser import WrkReport
+
+KEY = {
+    "mesh": "istio", "namespace": "hotel", "tag": "", "thread": 25, "connection": 100,
+    "target_rps": 2000, "duration": 30, "cpu_limit": 100, "revision": "abc1234",
+}
+
+def make_report(rps, p50, p99, non_2xx=0):
+    report = WrkReport()
+    report.requests_per_sec = rps
+    report.percentiles = {50.0: p50, 99.0: p99}
+    report.non_2xx = non_2xx
+    report.socket_errors["timeout"] = 1
+    return report
+
+def test_record_and_lookup(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    assert store.lookup(KEY, 0) is None
+
+    row = store.record(KEY, 0, make_report(1990.5, 3.2, 12.5, non_2xx=2))
+    stored = store.lookup(KEY, 0)
+    assert stored == row
+    assert (stored["achieved_rps"], stored["p50"], stored["p99"]) == (1990.5, 3.2, 12.5)
+    assert (stored["non_2xx"], stored["errors"]) == (2, 3)
+    assert json.loads(stored["report"])["requests_per_sec"] == 1990.5
+    # another run of the batch, or any other key column, is a different run
+    assert store.lookup(KEY, 1) is None
+    assert store.lookup(dict(KEY, revision="def5678"), 0) is None
+    store.close()
+
+def test_record_replaces_an_older_measurement(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    store.record(KEY, 0, make_report(1990.5, 3.2, 12.5))
+    store.record(KEY, 0, make_report(1800.0, 4.0, 20.0))
+    assert store.lookup(KEY, 0)["achieved_rps"] == 1800.0
+    assert len(store.query()) == 1
+    store.close()
+
+def test_runs_survive_a_reopen(tmp_path):
+    db_file = str(tmp_path / "results.db")
+    store = ResultStore(db_file)
+    store.record(KEY, 0, make_report(1990.5, 3.2, 12.5))
+    store.close()
+
+    store = ResultStore(db_file)
+    assert store.lookup(KEY, 0)["p50"] == 3.2
+    store.close()
+
+def test_query_filters_and_orders_by_target(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    for target_rps in (3000, 1000, 2000):
+        store.record(dict(KEY, target_rps=target_rps), 0, make_report(target_rps, 3.0, 10.0))
+    store.record(dict(KEY, mesh="none"), 0, make_report(2000, 2.0, 8.0))
+
+    assert [row["target_rps"] for row in store.query(mesh="istio")] == [1000, 2000, 3000]
+    assert [row["p50"] for row in store.query(mesh="none", namespace="hotel")] == [2.0]
+    assert len(store.query()) == 4
+    assert store.query(tag="no-egress") == []
+    store.close()
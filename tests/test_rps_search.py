@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+
+from exper.metric.rps_search import RPSSearch
+
+class QueueService:
+    '''
+    p50 = fixed + queueing / (capacity - rps), wrk2 achieves at most 97% of the capacity
+    '''
+    def __init__(self, capacity=5300.0, fixed=20.0, queueing=3000.0, noise=0.0):
+        self.capacity = capacity
+        self.fixed = fixed
+        self.queueing = queueing
+        self.noise = noise          # relative stdev of the latency
+        self.rng = np.random.default_rng(0)
+        self.targets = []
+
+    def knee(self):
+        s = self.fixed * self.capacity + self.queueing
+        return (s - math.sqrt(self.queueing * s)) / self.fixed
+
+    def measure(self, rps):
+        self.targets.append(rps)
+        achieved = min(rps, self.capacity * 0.97)
+        p50 = (self.fixed + self.queueing / (self.capacity - achieved)) * (1 + self.rng.normal(0, self.noise))
+        return p50, achieved, p50 * 2.5
+
+def test_ramp_up_doubles_until_saturation():
+    service = QueueService()
+    search = RPSSearch(service.measure)
+    search.bracket_saturation(200, 0)
+    assert service.targets == [200, 400, 800, 1600, 3200, 6400]
+    assert [rps for rps, point in search.probes.items() if search.is_saturated(point)] == [6400]
+
+def test_halves_down_when_the_start_saturates():
+    service = QueueService(capacity=500)
+    search = RPSSearch(service.measure)
+    search.bracket_saturation(4000, 20)
+    assert service.targets[:4] == [4000, 2000, 1000, 500]
+    assert not search.is_saturated(search.probes[service.targets[-1]])
+    assert len(search.points()) >= 3
+
+def test_every_target_is_measured_once():
+    service = QueueService()
+    search = RPSSearch(service.measure)
+    search.probe(1000)
+    search.probe(1000)
+    assert service.targets == [1000]
+
+def test_gives_up_after_max_probes():
+    service = QueueService(capacity=1e9)
+    search = RPSSearch(service.measure, max_probes=5)
+    search.bracket_saturation(100, 0)
+    assert len(service.targets) == 5
+
+def test_converges_on_the_knee():
+    service = QueueService()
+    search = RPSSearch(service.measure)
+    best_rps, seeds, converged = search.search(200, 50, 20)
+    assert converged and search.converged
+    assert abs(best_rps - service.knee()) <= 50
+    assert best_rps % search.rps_round == 0
+    assert len(service.targets) <= search.max_probes
+    assert search.round(search.analysis["knee"]) in seeds
+
+def test_seeds_are_measured_first():
+    service = QueueService()
+    _, seeds, _ = RPSSearch(service.measure).search(200, 200, 20)
+    fine = QueueService()
+    _, _, converged = RPSSearch(fine.measure).search(200, 50, 20, seeds)
+    assert fine.targets[:len(seeds)] == seeds
+    assert converged
+
+def test_reports_an_unconverged_knee():
+    service = QueueService(noise=0.03)
+    search = RPSSearch(service.measure, max_probes=8)
+    best_rps, _, converged = search.search(200, 10, 20)
+    assert not converged and not search.converged
+    assert len(service.targets) == 8
+    assert best_rps > 0
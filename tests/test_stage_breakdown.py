@@ -0,0 +1,92 @@
+import json
+import math
+
+import numpy as np
+
+from exper.graph_gen.stage_breakdown import STAGES, compute_sched_split, compute_stage_durations, get_store, stage_percentiles
+from exper.graph_gen.trace_store import SCHED_COLUMNS, TIMESTAMP_COLUMNS
+
+class FakeStore:
+    '''
+    the parts of TraceStore the breakdown reads, one pod of service "productpage", every column zero unless given
+    '''
+    def __init__(self, num_records, **columns):
+        names = {column for _, start, end in STAGES for column in (start, end)}
+        names.update(column for sched_columns in SCHED_COLUMNS.values() for column in sched_columns)
+        self.columns = {name: np.zeros(num_records, dtype=np.uint64) for name in names}
+        for name, values in columns.items():
+            self.columns[name] = np.array(values, dtype=np.uint64)
+        self.services = ["productpage"]
+        self.pod = np.zeros(num_records, dtype=np.uint16)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def service(self):
+        return self.pod
+
+def test_sched_split_needs_snapshots_at_both_boundaries():
+    # Write runs from write_start_time to write_end_time, only the first record has both snapshots
+    store = FakeStore(3, write_start_time=[100, 100, 100], write_end_time=[1100, 1100, 1100],
+                      runq_write_start_time=[50, 0, 50], runq_write_end_time=[250, 300, 0],
+                      sleep_write_start_time=[10, 0, 10], sleep_write_end_time=[110, 400, 0])
+    runq, sleep, oncpu, valid = compute_sched_split(store)["Write"]
+    assert valid.tolist() == [True, False, False]
+    assert (runq[0], sleep[0], oncpu[0]) == (200, 100, 700)
+
+def test_sched_means_skip_records_without_snapshots():
+    store = FakeStore(3, write_start_time=[100, 100, 100], write_end_time=[1100, 2100, 1100],
+                      runq_write_start_time=[50, 50, 0], runq_write_end_time=[250, 650, 0],
+                      sleep_write_start_time=[0, 0, 0], sleep_write_end_time=[100, 300, 0])
+    rows = {(row["service"], row["stage"]): row for row in stage_percentiles(store, sched=True)}
+    row = rows[("all", "Write")]
+    # the third record counts for the percentiles but its zero snapshots are not averaged in
+    assert (row["count"], row["sched_count"]) == (3, 2)
+    assert row["runq"] == (200 + 600) / 2
+    assert row["sleep"] == (100 + 300) / 2
+    assert row["oncpu"] == (700 + 1100) / 2
+    assert rows[("productpage", "Write")]["sched_count"] == 2
+    # no record reached the other stages
+    assert rows[("all", "Read")]["sched_count"] == 0
+    assert math.isnan(rows[("all", "Read")]["runq"])
+
+def test_stage_durations():
+    store = FakeStore(4, time_http_start=[100, 100, 0, 500], time_request_filter_start=[130, 160, 40, 400],
+                      time_process_start=[200, 0, 90, 600])
+    durations = compute_stage_durations(store)
+    elapsed, valid = durations["DownStream Http Parsing"]
+    # a missing start boundary and a negative interval are not valid
+    assert valid.tolist() == [True, True, False, False]
+    assert elapsed[valid].tolist() == [30, 60]
+    elapsed, valid = durations["Request Filters"]
+    assert valid.tolist() == [True, False, True, True]
+    assert elapsed[valid].tolist() == [70, 50, 200]
+
+def test_stage_percentiles_per_service(tmp_path):
+    # productpage parses for 10, 20, 30 and 40 ns, details for 100 ns
+    lines = [{"X-Request-ID": f"{pod}-{i}", "Time HTTP Start": 1000 * (i + 1), "Time Request Filter Start": 1000 * (i + 1) + parsing}
+             for pod, parsings in [("productpage", [10, 20, 30, 40]), ("details", [100])] for i, parsing in enumerate(parsings)]
+    for pod in ["productpage", "details"]:
+        with open(tmp_path / f"trace_output_{pod}-v1-abc.log", "w") as f:
+            for line in lines:
+                if line["X-Request-ID"].startswith(pod):
+                    f.write(json.dumps(dict({key: 0 for key in TIMESTAMP_COLUMNS}, **line)) + "\n")
+    rows = {(row["service"], row["stage"]): row for row in stage_percentiles(get_store(str(tmp_path)), percentiles=[50, 100])}
+
+    row = rows[("productpage", "DownStream Http Parsing")]
+    assert (row["count"], row["p50"], row["p100"]) == (4, 25, 40)
+    row = rows[("all", "DownStream Http Parsing")]
+    assert (row["count"], row["p50"], row["p100"]) == (5, 30, 100)
+    assert rows[("details", "DownStream Http Parsing")]["p50"] == 100
+    assert rows[("all", "Request Filters")]["count"] == 0
+    assert math.isnan(rows[("all", "Request Filters")]["p50"])
+
+def test_get_store_converts_changed_traces_again(tmp_path):
+    line = dict({key: 0 for key in TIMESTAMP_COLUMNS}, **{"X-Request-ID": "a", "Time HTTP Start": 10})
+    path = tmp_path / "trace_output_productpage-v1-abc.log"
+    path.write_text(json.dumps(line) + "\n")
+    assert len(get_store(str(tmp_path))) == 1
+    assert len(get_store(str(tmp_path))) == 1
+    with open(path, "a") as f:
+        f.write(json.dumps(line) + "\n")
+    assert len(get_store(str(tmp_path))) == 2
@@ -0,0 +1,44 @@
+import json
+import os
+
+from exper.graph_gen.trace_index import INDEX_FILE, extract_request_id, list_trace_files, load_index
+
+def write_trace(path, ids):
+    with open(path, "w") as f:
+        for x_request_id in ids:
+            f.write(json.dumps({"X-Request-ID": x_request_id, "Time End": 1}) + "\n")
+
+def test_extract_request_id():
+    assert extract_request_id(b'{"X-Request-ID": "abc-1", "Time End": 1}\n') == "abc-1"
+    assert extract_request_id(b'{"X-Request-ID": "", "Time End": 1}\n') is None
+    assert extract_request_id(b'{"Time End": 1}\n') is None
+
+def test_lookup_by_id_and_prefix(tmp_path):
+    os.mkdir(tmp_path / "details")
+    write_trace(tmp_path / "trace_output_productpage.log", ["0000000000000001-a", "0000000000000002-a"])
+    write_trace(tmp_path / "details" / "trace_output_details.log", ["0000000000000001-b"])
+    # files of a directory come before its subdirectories
+    assert list_trace_files(str(tmp_path)) == ["trace_output_productpage.log", os.path.join("details", "trace_output_details.log")]
+
+    trace_index = load_index(str(tmp_path))
+    assert os.path.exists(tmp_path / INDEX_FILE)
+    hops = trace_index.lookup("0000000000000001")
+    assert sorted(file_id for file_id, _ in hops) == [0, 1]
+    assert [json.loads(line)["X-Request-ID"] for _, line in trace_index.lookup("0000000000000002-a")] == ["0000000000000002-a"]
+    # longer than the prefix but not a full id, the files are indexed in parallel so hops come in any order
+    assert sorted(json.loads(line)["X-Request-ID"] for _, line in trace_index.lookup("0000000000000001-")) == \
+        ["0000000000000001-a", "0000000000000001-b"]
+    assert trace_index.lookup("0000000000000003") == []
+    trace_index.close()
+
+def test_index_is_rebuilt_when_a_trace_changes(tmp_path):
+    write_trace(tmp_path / "trace_output_productpage.log", ["0000000000000001-a"])
+    load_index(str(tmp_path)).close()
+    with open(tmp_path / "trace_output_productpage.log", "a") as f:
+        f.write(json.dumps({"X-Request-ID": "0000000000000002-a"}) + "\n")
+    trace_index = load_index(str(tmp_path))
+    assert "0000000000000002-a" in trace_index
+    trace_index.close()
+
+    write_trace(tmp_path / "trace_output_details.log", ["0000000000000003-b"])
+    assert "0000000000000003-b" in load_index(str(tmp_path))
@@ -0,0 +1,57 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exper.graph_gen.trace_loader import iter_file_chunks, iter_ordered, load_files, split_chunks
+
+def count_lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+def parse_line(line):
+    return int(line) if line.strip() != "skip" else None
+
+def slow_square(n):
+    # later tasks finish first
+    time.sleep(0.01 * (5 - n))
+    return n * n
+
+def test_iter_ordered_keeps_task_order_and_window():
+    submitted = []
+    def tasks():
+        for n in range(5):
+            submitted.append(n)
+            yield slow_square, n
+
+    results = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for result in iter_ordered(executor, tasks(), window=2):
+            # no more than the window is submitted ahead of what was yielded
+            assert len(submitted) - len(results) <= 2
+            results.append(result)
+    assert results == [0, 1, 4, 9, 16]
+
+def test_split_chunks_ends_on_lines(tmp_path):
+    path = tmp_path / "trace.log"
+    path.write_text("".join(f"{n}\n" for n in range(1000)))
+    chunks = split_chunks(str(path), chunk_size=100)
+    assert chunks[0][0] == 0 and chunks[-1][1] == path.stat().st_size
+    with open(path, "rb") as f:
+        data = f.read()
+    assert all(data[end - 1:end] == b"\n" for _, end in chunks)
+    assert split_chunks(str(tmp_path / "trace.log"), chunk_size=1 << 20) == [(0, path.stat().st_size)]
+
+def test_iter_file_chunks_in_file_order(tmp_path):
+    path = tmp_path / "trace.log"
+    path.write_text("".join("skip\n" if n % 10 == 0 else f"{n}\n" for n in range(2000)))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        records = list(iter_file_chunks(executor, str(path), parse_line, report=False))
+    assert records == [n for n in range(2000) if n % 10]
+
+def test_load_files_in_the_given_order(tmp_path):
+    paths = []
+    for n in range(3):
+        path = tmp_path / f"trace_{n}.log"
+        path.write_text("x\n" * (n + 1))
+        paths.append(str(path))
+    assert load_files(paths[::-1], count_lines, workers=2, report=False) == [3, 2, 1]
@@ -0,0 +1,129 @@
+import ctypes
+import json
+
+import numpy as np
+import pytest
+
+from exper.envoy.uprobe_script.trace_record import (RECORD_DTYPE, LOG_KEYS, RecordBuffer, decode_request_id, read_header,
+                                                    read_records, record_dtype, records_to_lines, write_header)
+
+class RequestInfo(ctypes.Structure):
+    # struct request_info_t of http_uprobe.py, ctypes pads it like the C compiler does
+    _fields_ = [
+        ("request_id", ctypes.c_char * 37),
+        ("protocol", ctypes.c_uint8),
+        ("time_http_start", ctypes.c_uint64),
+        ("time_request_filters_start", ctypes.c_uint64),
+        ("time_process_start", ctypes.c_uint64),
+        ("time_response_filters_start", ctypes.c_uint64),
+        ("time_end", ctypes.c_uint64),
+        ("upstream_time_http_start", ctypes.c_uint64),
+        ("write_start_time", ctypes.c_uint64),
+        ("write_end_time", ctypes.c_uint64),
+        ("read_start_time", ctypes.c_uint64),
+        ("read_end_time", ctypes.c_uint64),
+        ("pid", ctypes.c_uint32),
+        ("start_tid", ctypes.c_uint32),
+        ("end_tid", ctypes.c_uint32),
+        ("start_cpu", ctypes.c_uint16),
+        ("end_cpu", ctypes.c_uint16),
+    ]
+
+class RequestInfoSched(ctypes.Structure):
+    # the same with -DTCP -DSCHED
+    _fields_ = RequestInfo._fields_ + [
+        ("tcp_send_time", ctypes.c_uint64),
+        ("tcp_rcv_time", ctypes.c_uint64),
+        ("tcp_read_time", ctypes.c_uint64),
+        ("runq_ns", ctypes.c_uint64 * 9),
+        ("sleep_ns", ctypes.c_uint64 * 9),
+    ]
+
+REQUEST_ID = b"6f1c2a9e-4b7d-4e0a-9c1f-2d3b4a5c6d7e"
+
+def make_event(struct=RequestInfo, index=0):
+    event = struct()
+    event.request_id = REQUEST_ID
+    event.protocol = 2
+    for i, (name, _) in enumerate(RequestInfo._fields_[2:12]):
+        setattr(event, name, 1_000_000 * (index + 1) + i)
+    event.pid, event.start_tid, event.end_tid = 4242, 4243 + index, 4244
+    event.start_cpu, event.end_cpu = 3, 7
+    return event
+
+@pytest.mark.parametrize("struct, dtype", [(RequestInfo, RECORD_DTYPE), (RequestInfoSched, record_dtype(sched=True, tcp=True))])
+def test_dtype_matches_the_c_layout(struct, dtype):
+    assert dtype.itemsize == ctypes.sizeof(struct)
+    for name, _ in struct._fields_:
+        assert dtype.fields[name][1] == getattr(struct, name).offset, name
+
+def test_record_buffer_copies_events():
+    buffer = RecordBuffer(4)
+    for index in range(2):
+        event = make_event(index=index)
+        assert not buffer.append(ctypes.addressof(event), ctypes.sizeof(event))
+    records = buffer.filled()
+    assert len(records) == 2
+    assert decode_request_id(records[0]["request_id"]) == REQUEST_ID.decode()
+    assert records[1]["time_http_start"] == 2_000_000
+    assert records[1]["read_end_time"] == 2_000_009
+    assert (records[1]["pid"], records[1]["start_tid"], records[1]["start_cpu"], records[1]["end_cpu"]) == (4242, 4244, 3, 7)
+
+def test_record_buffer_full_and_reset():
+    buffer = RecordBuffer(2)
+    event = make_event()
+    assert not buffer.append(ctypes.addressof(event), ctypes.sizeof(event))
+    assert buffer.append(ctypes.addressof(event), ctypes.sizeof(event))
+    buffer.reset()
+    assert buffer.count == 0
+    assert not buffer.records.view(np.uint8).any()
+
+def test_record_buffer_truncates_and_zero_fills():
+    # a longer event only fills one slot, a shorter one leaves the tail zeroed
+    buffer = RecordBuffer(2)
+    long_event = make_event(RequestInfoSched)
+    buffer.append(ctypes.addressof(long_event), ctypes.sizeof(long_event))
+    short_event = make_event()
+    buffer.append(ctypes.addressof(short_event), 40)
+    records = buffer.filled()
+    assert records[0]["end_cpu"] == 7
+    assert records[1]["time_http_start"] == 0
+
+def test_records_to_lines():
+    buffer = RecordBuffer(1, record_dtype(sched=True))
+    event = make_event()
+    buffer.append(ctypes.addressof(event), ctypes.sizeof(event))
+    buffer.records["runq_ns"][0] = np.arange(9)
+    log_data = json.loads(records_to_lines(buffer.filled())[0])
+    assert list(log_data)[:len(LOG_KEYS)] == [key for key, _ in LOG_KEYS]
+    assert log_data["X-Request-ID"] == REQUEST_ID.decode()
+    assert log_data["Time HTTP Start"] == 1_000_000
+    assert log_data["RunQ"] == list(range(9))
+    assert "TCP Send Time" not in log_data
+
+def test_binary_trace_file_round_trip(tmp_path):
+    dtype = record_dtype(sched=True, tcp=True)
+    records = np.zeros(3, dtype=dtype)
+    records["time_end"] = [10, 20, 30]
+    records["sleep_ns"][2] = np.arange(9)
+    path = tmp_path / "envoy.bin"
+    with open(path, "wb") as f:
+        write_header(f, dtype)
+        f.write(records.tobytes())
+
+    loaded = read_records(str(path))
+    assert loaded.dtype == dtype
+    assert loaded["time_end"].tolist() == [10, 20, 30]
+    assert loaded["sleep_ns"][2].tolist() == list(range(9))
+
+def test_empty_and_foreign_files(tmp_path):
+    path = tmp_path / "empty.bin"
+    with open(path, "wb") as f:
+        write_header(f)
+    assert len(read_records(str(path))) == 0
+
+    with open(tmp_path / "trace.log", "wb") as f:
+        f.write(b'{"X-Request-ID": ""}\n')
+    with open(tmp_path / "trace.log", "rb") as f:
+        with pytest.raises(ValueError):
+            read_header(f)
@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+
+from exper.envoy.uprobe_script.trace_record import SCHED_BOUNDARIES, record_dtype, records_to_lines, write_header
+from exper.graph_gen.trace_loader import split_chunks
+from exper.graph_gen.trace_store import (FIELD_COLUMNS, META_FILE, SCHED_COLUMNS, TCP_COLUMNS, convert_logs, load_store,
+                                         parse_text_chunk, split_records)
+
+TCP_NAMES = list(TCP_COLUMNS.values())
+SCHED_NAMES = [name for names in SCHED_COLUMNS.values() for name in names]
+
+def request_id(request, hop):
+    # hops of one request share the first 16 characters
+    return f"{request:08d}-0000-4000-8000-{hop:012d}"
+
+def make_records(ids, dtype, base=0):
+    records = np.zeros(len(ids), dtype=dtype)
+    records["request_id"] = [x_request_id.encode() for x_request_id in ids]
+    for i in range(len(ids)):
+        for j, field in enumerate(FIELD_COLUMNS):
+            records[field][i] = base + 1000 * (i + 1) + j
+        records["start_tid"][i], records["end_cpu"][i] = 100 + i, 3
+    for field in ["tcp_send_time", "tcp_rcv_time", "tcp_read_time"]:
+        if field in dtype.names:
+            records[field] = base + np.arange(len(ids)) + 7
+    for field in ["runq_ns", "sleep_ns"]:
+        if field in dtype.names:
+            records[field] = base + np.arange(len(ids) * 9).reshape(-1, 9) + 1
+    return records
+
+def write_text(path, records, extra_lines=()):
+    with open(path, "w") as f:
+        for line in records_to_lines(records) + list(extra_lines):
+            f.write(line + "\n")
+
+def write_binary(path, records):
+    with open(path, "wb") as f:
+        write_header(f, records.dtype)
+        f.write(records.tobytes())
+
+def convert(tmp_path, trace_files, name="store"):
+    convert_logs([str(tmp_path / file) for file in trace_files], str(tmp_path / name))
+    return load_store(str(tmp_path / name))
+
+def assert_columns(store, rows, records):
+    for field, name in FIELD_COLUMNS.items():
+        assert store[name][rows].tolist() == records[field].tolist(), name
+    assert store["start_tid"][rows].tolist() == records["start_tid"].tolist()
+    assert store["end_cpu"][rows].tolist() == records["end_cpu"].tolist()
+
+def test_round_trip_of_text_and_binary_traces(tmp_path):
+    plain, full = record_dtype(), record_dtype(sched=True, tcp=True)
+    productpage = make_records([request_id(1, 0), request_id(2, 0), request_id(3, 0)], plain)
+    rotated = make_records([request_id(4, 0)], plain, base=50_000)
+    details = make_records([request_id(1, 1), request_id(2, 1)], full, base=90_000)
+    write_text(tmp_path / "trace_output_productpage-v1-abc.log", productpage, ['{"X-Request-ID": "truncated'])
+    write_text(tmp_path / "trace_output_productpage-v1-abc.1.log", rotated)
+    write_binary(tmp_path / "trace_output_details-v1-xyz.bin", details)
+    # the files with tcp and sched columns come last, so the records before them are zero-filled
+    trace_files = [str(tmp_path / name) for name in ["trace_output_productpage-v1-abc.log", "trace_output_productpage-v1-abc.1.log",
+                                                     "trace_output_details-v1-xyz.bin"]]
+    store_dir = tmp_path / "store"
+    meta = convert_logs(trace_files, str(store_dir), workers=2)
+    store = load_store(str(store_dir))
+
+    assert len(store) == meta["num_records"] == 6
+    assert store.pods == ["productpage-v1-abc", "details-v1-xyz"]
+    assert store.services == ["details", "productpage"]
+    # the rotated segment shares the pod code of its pod
+    assert store.pod.tolist() == [0, 0, 0, 0, 1, 1]
+    assert [store.services[code] for code in store.service()] == ["productpage"] * 4 + ["details"] * 2
+
+    assert_columns(store, slice(0, 3), productpage)
+    assert_columns(store, slice(3, 4), rotated)
+    assert_columns(store, slice(4, 6), details)
+
+    ids = [request_id(1, 0), request_id(2, 0), request_id(3, 0), request_id(4, 0), request_id(1, 1), request_id(2, 1)]
+    assert [store.request_ids[code] for code in store.request_id] == ids
+    assert len(set(store.request_id.tolist())) == 6
+    # hops of one request share a prefix code
+    prefix_codes = store.prefix_codes().tolist()
+    assert prefix_codes[0] == prefix_codes[4] and prefix_codes[1] == prefix_codes[5]
+    assert len(set(prefix_codes)) == 4
+
+    assert set(TCP_NAMES + SCHED_NAMES) <= set(meta["columns"])
+    for name in TCP_NAMES + SCHED_NAMES:
+        assert not store[name][:4].any(), name
+    assert store["tcp_rcv_time"][4:].tolist() == details["tcp_rcv_time"].tolist()
+    for i, boundary in enumerate(SCHED_BOUNDARIES):
+        name = SCHED_COLUMNS["runq_ns"][i]
+        assert name == f"runq_{FIELD_COLUMNS[boundary]}"
+        assert store[name][4:].tolist() == details["runq_ns"][:, i].tolist()
+        assert store[SCHED_COLUMNS["sleep_ns"][i]][4:].tolist() == details["sleep_ns"][:, i].tolist()
+
+def test_text_and_binary_traces_give_the_same_columns(tmp_path):
+    records = make_records([request_id(request, 0) for request in range(5)], record_dtype(sched=True, tcp=True))
+    write_text(tmp_path / "trace_output_reviews-v2-abc.log", records)
+    write_binary(tmp_path / "trace_output_reviews-v2-abc.bin", records)
+    text = convert(tmp_path, ["trace_output_reviews-v2-abc.log"], "text")
+    binary = convert(tmp_path, ["trace_output_reviews-v2-abc.bin"], "binary")
+
+    assert text.meta["columns"] == binary.meta["columns"]
+    for name in text.meta["columns"]:
+        assert text[name].tolist() == binary[name].tolist(), name
+    assert text.request_ids == binary.request_ids
+    assert text.request_id.tolist() == binary.request_id.tolist()
+
+def test_traces_without_optional_columns(tmp_path):
+    write_text(tmp_path / "trace_output_ratings-v1-abc.log", make_records([request_id(1, 0)], record_dtype()))
+    store = convert(tmp_path, ["trace_output_ratings-v1-abc.log"])
+    with open(tmp_path / "store" / META_FILE) as f:
+        columns = json.load(f)["columns"]
+    assert not set(TCP_NAMES + SCHED_NAMES) & set(columns)
+    assert "runq_time_end" not in store.columns
+
+def test_empty_trace_file(tmp_path):
+    write_binary(tmp_path / "trace_output_ratings-v1-abc.bin", make_records([], record_dtype()))
+    store = convert(tmp_path, ["trace_output_ratings-v1-abc.bin"])
+    assert len(store) == 0
+    assert store.pods == ["ratings-v1-abc"]
+    assert len(store["time_end"]) == 0
+
+def test_chunks_cover_the_file(tmp_path):
+    ids = [request_id(request % 7, request) for request in range(40)]
+    records = make_records(ids, record_dtype(sched=True))
+    path = tmp_path / "trace_output_reviews-v2-abc.log"
+    write_text(path, records)
+
+    chunks = split_chunks(str(path), chunk_size=1000)
+    assert len(chunks) > 1
+    assert chunks[0][0] == 0 and chunks[-1][1] == path.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(chunks, chunks[1:]))
+    parsed = [parse_text_chunk(str(path), start, end) for start, end in chunks]
+    # every chunk starts on a line and has its own request-id dictionary
+    assert sum(skipped for _, _, _, skipped in parsed) == 0
+    assert [local_ids[code] for _, local_ids, codes, _ in parsed for code in codes] == ids
+    time_end = np.concatenate([columns["time_end"] for columns, _, _, _ in parsed])
+    assert time_end.tolist() == records["time_end"].tolist()
+
+    binary_path = tmp_path / "trace_output_reviews-v2-abc.bin"
+    write_binary(binary_path, records)
+    assert split_records(str(binary_path), chunk_size=15 * records.dtype.itemsize) == [(0, 15), (15, 30), (30, 40)]
@@ -0,0 +1,62 @@
+import os
+import threading
+
+from exper.envoy.uprobe_script.trace_writer import AsyncWriter, RotatingWriter
+
+def close_within(writer, timeout=10):
+    # a hanging close() fails the test instead of the whole run
+    thread = threading.Thread(target=writer.close, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def test_async_writer_writes_every_batch_in_order():
+    written, done = [], []
+    writer = AsyncWriter(written.append, done.append, queue_size=64)
+    for batch in range(10):
+        assert writer.submit(batch)
+    assert close_within(writer)
+    assert written == list(range(10))
+    assert done == list(range(10))
+    assert writer.dropped == 0
+
+def test_async_writer_survives_a_failing_write():
+    done = []
+    def write_batch(batch):
+        raise OSError(28, "No space left on device")
+
+    writer = AsyncWriter(write_batch, done.append, queue_size=2)
+    submitted = sum(writer.submit(batch) for batch in range(20))
+    assert close_within(writer)
+    assert writer.failed == submitted
+    assert writer.dropped == 20
+    # failed batches are still handed back, so their buffers are reused
+    assert len(done) == submitted
+
+def test_async_writer_keeps_writing_after_a_failure():
+    written = []
+    def write_batch(batch):
+        if batch == 1:
+            raise ValueError("zstd error")
+        written.append(batch)
+
+    writer = AsyncWriter(write_batch, queue_size=8)
+    for batch in range(4):
+        writer.submit(batch)
+    assert close_within(writer)
+    assert written == [0, 2, 3]
+    assert (writer.failed, writer.dropped) == (1, 1)
+
+def test_rotating_writer_continues_earlier_segments(tmp_path):
+    path = str(tmp_path / "trace_output.log")
+    for run in range(2):
+        writer = RotatingWriter(path, header=b"header\n", rotate_bytes=10)
+        for line in range(3):
+            writer.write(f"run {run} line {line}\n".encode())
+        writer.close()
+    # every rotation of the second run got a new number, nothing of the first run was overwritten
+    segments = sorted(os.listdir(tmp_path))
+    assert segments == ["trace_output.1.log", "trace_output.2.log", "trace_output.3.log", "trace_output.4.log", "trace_output.log"]
+    contents = b"".join(open(tmp_path / segment, "rb").read() for segment in segments)
+    assert contents.count(b"header\n") == 5
+    assert all(f"run {run} line {line}\n".encode() in contents for run in range(2) for line in range(3))
@@ -0,0 +1,88 @@
+import math
+
+import pytest
+
+from exper.metric.wrk_parser import TIME_UNITS, SIZE_UNITS, parse_value, parse_wrk_output, parse_wrk_reports
+
+# trimmed wrk2 -L output, the spectrum keeps a few lines around p50 and p99
+WRK_OUTPUT = '''Running 30s test @ http://10.10.1.1:30080/productpage
+  4 threads and 16 connections
+  Thread calibration: mean lat.: 2.345ms, rate sampling interval: 10ms
+  Thread Stats   Avg      Stdev     Max   +/- Stdev
+    Latency     2.41ms    1.02ms  15.23ms   81.20%
+    Req/Sec   263.45     55.12     1.11k    70.05%
+  Latency Distribution (HdrHistogram - Recorded Latency)
+ 50.000%    2.21ms
+ 75.000%    2.85ms
+ 90.000%    3.62ms
+ 99.000%    6.14ms
+ 99.900%   11.02ms
+ 99.990%   14.30ms
+ 99.999%   15.23ms
+100.000%   15.23ms
+
+  Detailed Percentile spectrum:
+       Value   Percentile   TotalCount 1/(1-Percentile)
+
+       0.512     0.000000            1         1.00
+       2.210     0.500000        14983         2.00
+       6.140     0.990000        29671       100.00
+      15.231     1.000000        29970          inf
+#[Mean    =        2.408, StdDeviation   =        1.021]
+#[Max     =       15.224, Total count    =        29970]
+#[Buckets =           27, SubBuckets     =         2048]
+----------------------------------------------------------
+  29973 requests in 30.00s, 41.99MB read
+  Socket errors: connect 0, read 2, write 0, timeout 3
+  Non-2xx or 3xx responses: 12
+Requests/sec:    999.08
+Transfer/sec:      1.40MB
+'''
+
+def test_parse_value_units():
+    assert parse_value("1.5ms", TIME_UNITS) == 1.5
+    assert parse_value("500us", TIME_UNITS) == pytest.approx(0.5)
+    assert parse_value("2s", TIME_UNITS) == 2000
+    assert parse_value("1KB", SIZE_UNITS) == 1024
+    assert parse_value("42", TIME_UNITS) == 42
+    with pytest.raises(ValueError):
+        parse_value("1.5xs", TIME_UNITS)
+
+def test_parse_wrk_output():
+    report = parse_wrk_output(WRK_OUTPUT)
+    assert report.url == "http://10.10.1.1:30080/productpage"
+    assert report.duration == 30
+    assert (report.threads, report.connections) == (4, 16)
+    assert report.latency == {"avg": 2.41, "stdev": 1.02, "max": 15.23}
+    assert report.req_per_thread["max"] == 1110
+    assert report.percentiles[50.0] == 2.21
+    assert report.percentiles[99.9] == 11.02
+    assert report.spectrum[1] == (2.21, 0.5, 14983)
+    assert report.histogram["total count"] == 29970
+    assert report.requests == 29973
+    assert report.elapsed == 30
+    assert report.bytes_read == pytest.approx(41.99 * (1 << 20))
+    assert report.socket_errors == {"connect": 0, "read": 2, "write": 0, "timeout": 3}
+    assert report.non_2xx == 12
+    assert report.errors() == 17
+    assert report.requests_per_sec == 999.08
+    assert report.transfer_per_sec == pytest.approx(1.40 * (1 << 20))
+
+def test_percentile_falls_back_to_spectrum():
+    report = parse_wrk_output(WRK_OUTPUT)
+    assert report.percentile(99) == 6.14
+    # not a summary line, the smallest spectrum value reaching it
+    assert report.percentile(95) == 6.14
+    assert report.percentile(10) == 2.21
+
+def test_last_of_several_runs():
+    second = WRK_OUTPUT.replace("Requests/sec:    999.08", "Requests/sec:    500.00")
+    reports = parse_wrk_reports(WRK_OUTPUT + "\n" + second)
+    assert [report.requests_per_sec for report in reports] == [999.08, 500.0]
+    assert parse_wrk_output(WRK_OUTPUT + second).requests_per_sec == 500.0
+
+def test_empty_output():
+    report = parse_wrk_output("ssh: connect to host 10.10.1.1 port 22: Connection refused\n")
+    assert report.requests_per_sec == 0
+    assert math.isinf(report.percentile(50))
+    assert report.errors() == 0
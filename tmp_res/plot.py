@@ -1,48 +1,5 @@
 import matplotlib.pyplot as plt
 
-# read rps and p50
-# the format is: [* Result] Achieved RPS: 570.17 p50 latency: 58.85
-def read_file(file_path):
-    rps = []
-    p50 = []
-    with open(file_path, "r") as f:
-        for line in f:
-            if "[* Result] Achieved" in line:
-                parts = line.split(" ")
-                # print(parts)
-                rps.append(float(parts[4]))
-                p50.append(float(parts[7]))
-    return rps, p50
-
-# Plotting scatter points of three different files
-def plot_scatter(file0, file1, file2, file3, file4, file5, file6):
-    rps0, p50_0 = read_file(file0)
-    rps1, p50_1 = read_file(file1)
-    rps2, p50_2 = read_file(file2)
-    rps3, p50_3 = read_file(file3)
-    rps4, p50_4 = read_file(file4)
-    rps5, p50_5 = read_file(file5)
-    rps6, p50_6 = read_file(file6)
-
-    plt.figure(figsize=(10, 6))
-    plt.xlim(100, 350)
-    plt.ylim(25, 80)
-    plt.scatter(rps0, p50_0, color='black', label='No Mesh', alpha=0.8)
-    plt.scatter(rps1, p50_1, color='green', label='Istio', alpha=0.8)
-    plt.scatter(rps2, p50_2, color='red', label='Istio(no egress)', alpha=0.8)
-    plt.scatter(rps3, p50_3, color='orange', label='Ambient 1P', alpha=0.8)
-    plt.scatter(rps4, p50_4, color='purple', label='Ambient 3P', alpha=0.8)
-    plt.scatter(rps5, p50_5, color='brown', label='Ambient 4P', alpha=0.8)
-    plt.scatter(rps6, p50_6, color='blue', label='Ambient(each service)', alpha=0.8)
-
-    plt.xlabel('Achieved RPS')
-    plt.ylabel('P50 Latency (ms)')
-    plt.title('RPS vs P50 Latency')
-    plt.legend()
-    plt.grid(True)
-    plt.savefig('rps_vs_p50.png')
-    plt.show()
-
 def histogram_mesh():
     mesh_types = ["No Mesh", "Istio", "Istio (no egress)", "Cilium", "Ambient 1 Proxy", "Ambient 3 Proxies", "Ambient 4 Proxies", "Ambient Each Service"]
     p50 = [5.83, 20.01, 12.6, 14.60, 21.73, 18.25, 18.24, 18.33]
@@ -81,12 +38,6 @@ def histogram_mesh():
     plt.savefig('mesh_comparison.png')
     plt.show()
 
-file0 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/no_mesh.log"
-file1 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/istio/mesh.log"
-file2 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/istio/mesh_ingress_only.log"
-file3 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/ambient/1P.log"
-file4 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/ambient/3P.log"
-file5 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/ambient/4P.log"
-file6 = "/Users/alicesong/Desktop/research/meshtrek/tmp_res/bookinfo/ambient/NP.log"
-plot_scatter(file0, file1, file2, file3, file4, file5, file6)
-# histogram_mesh()
\ No newline at end of file
+if __name__ == "__main__":
+    print("[*] The RPS / p50 scatter reads the result store now: python -m exper.metric.plot_results --namespace bookinfo")
+    # histogram_mesh()